@@ -0,0 +1,171 @@
+import os
+import math
+import time
+import threading
+import contextlib
+from collections import deque
+
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+
+# Admission control for run_ml_model
+#
+# At most max_concurrent pipeline runs execute at once. Further requests wait in a bounded
+# FIFO queue for up to timeout seconds. A request that finds the queue full is rejected
+# straight away with 429, one that times out in the queue with 503; both carry a
+# Retry-After estimated from the recent run time and the queue ahead. Under a burst the
+# instance keeps running max_concurrent pipelines at full speed instead of thrashing.
+#
+# Configuration (environment variables):
+# CWB_MAX_CONCURRENT_RUNS     concurrent pipeline runs, 0 disables admission control (default 0)
+# CWB_ADMISSION_QUEUE_SIZE    requests allowed to wait for a slot (default 8)
+# CWB_ADMISSION_TIMEOUT       seconds a request may wait before a 503 (default 60)
+
+MAX_CONCURRENT_RUNS = int(os.environ.get("CWB_MAX_CONCURRENT_RUNS", "0"))
+QUEUE_SIZE = int(os.environ.get("CWB_ADMISSION_QUEUE_SIZE", "8"))
+TIMEOUT_SECONDS = float(os.environ.get("CWB_ADMISSION_TIMEOUT", "60"))
+
+DEFAULT_RUN_SECONDS = 10.0
+RECENT_SAMPLES = 1000
+
+_admission_controller = None
+_admission_controller_lock = threading.Lock()
+
+
+class AdmissionRejected(Exception):
+    """Request not admitted: status is 429 (queue full) or 503 (timed out waiting)."""
+
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Concurrency cap with a bounded, timed FIFO wait queue.
+
+    Parameters:
+    max_concurrent (int): Pipeline runs allowed at once
+    queue_size (int): Requests allowed to wait for a slot
+    timeout (float): Seconds a request waits before it is rejected
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_RUNS, queue_size=QUEUE_SIZE, timeout=TIMEOUT_SECONDS):
+        self.max_concurrent = max(1, max_concurrent)
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        self._condition = threading.Condition()
+        self._waiters = deque()
+        self._running = 0
+        self._counters = {"admitted": 0, "completed": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+        self._waits = deque(maxlen=RECENT_SAMPLES)
+        self._run_times = deque(maxlen=RECENT_SAMPLES)
+
+    def retry_after(self):
+        """Seconds until a slot is likely free for a new request (at least 1)."""
+        run_seconds = float(np.mean(self._run_times)) if self._run_times else DEFAULT_RUN_SECONDS
+        return max(1, math.ceil(run_seconds * (len(self._waiters) + 1) / self.max_concurrent))
+
+    @contextlib.contextmanager
+    def admit(self):
+        """Hold a run slot for the enclosed block, waiting in the queue if needed. Raises AdmissionRejected."""
+        waiter = object()
+        queued = time.monotonic()
+
+        with self._condition:
+            if self._running >= self.max_concurrent or self._waiters:
+                if len(self._waiters) >= self.queue_size:
+                    self._counters["rejected_queue_full"] += 1
+                    raise AdmissionRejected(429, self.retry_after(), "Too many requests waiting, try again later")
+
+                self._waiters.append(waiter)
+                admitted = self._condition.wait_for(
+                    lambda: self._waiters[0] is waiter and self._running < self.max_concurrent,
+                    timeout=self.timeout,
+                )
+                self._waiters.remove(waiter)
+                self._condition.notify_all()  # the next waiter may now be at the head
+
+                if not admitted:
+                    self._counters["rejected_timeout"] += 1
+                    raise AdmissionRejected(503, self.retry_after(), f"No capacity within {self.timeout:.0f}s, try again later")
+
+            self._running += 1
+            self._counters["admitted"] += 1
+            self._waits.append(time.monotonic() - queued)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._counters["completed"] += 1
+                self._run_times.append(time.monotonic() - started)
+                self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            waits = np.array(self._waits) if self._waits else np.zeros(1)
+            return {
+                "max_concurrent": self.max_concurrent,
+                "running": self._running,
+                "queue_depth": len(self._waiters),
+                "queue_size": self.queue_size,
+                **self._counters,
+                "queue_wait_mean_seconds": float(waits.mean()),
+                "queue_wait_p95_seconds": float(np.percentile(waits, 95)),
+                "run_time_mean_seconds": float(np.mean(self._run_times)) if self._run_times else 0.0,
+            }
+
+
+def get_admission_controller():
+    """
+    Return the process-wide admission controller, creating it on first use.
+    Returns None when CWB_MAX_CONCURRENT_RUNS is 0.
+    """
+    global _admission_controller
+
+    if MAX_CONCURRENT_RUNS <= 0:
+        return None
+
+    with _admission_controller_lock:
+        if _admission_controller is None:
+            _admission_controller = AdmissionController()
+
+    return _admission_controller
+
+
+def admit_request():
+    """Admission for one pipeline run (no-op context when admission control is disabled)."""
+    admission_controller = get_admission_controller()
+    if admission_controller is None:
+        return contextlib.nullcontext()
+    return admission_controller.admit()
+
+
+def get_metrics_text():
+    """Admission metrics in the Prometheus text exposition format."""
+    admission_controller = get_admission_controller()
+    stats = admission_controller.stats() if admission_controller is not None else {}
+
+    metrics = [
+        ("cwb_admission_running", "gauge", "Pipeline runs in progress", stats.get("running", 0)),
+        ("cwb_admission_queue_depth", "gauge", "Requests waiting for a run slot", stats.get("queue_depth", 0)),
+        ("cwb_admission_max_concurrent", "gauge", "Configured concurrent run cap", stats.get("max_concurrent", 0)),
+        ("cwb_admission_admitted_total", "counter", "Requests admitted", stats.get("admitted", 0)),
+        ("cwb_admission_completed_total", "counter", "Admitted requests finished", stats.get("completed", 0)),
+        ("cwb_admission_rejected_queue_full_total", "counter", "Requests rejected with 429", stats.get("rejected_queue_full", 0)),
+        ("cwb_admission_rejected_timeout_total", "counter", "Requests rejected with 503", stats.get("rejected_timeout", 0)),
+        ("cwb_admission_queue_wait_p95_seconds", "gauge", "95th percentile queue wait (recent requests)", stats.get("queue_wait_p95_seconds", 0.0)),
+        ("cwb_admission_run_time_mean_seconds", "gauge", "Mean pipeline run time (recent requests)", stats.get("run_time_mean_seconds", 0.0)),
+    ]
+
+    lines = []
+    for name, metric_type, help_text, value in metrics:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
@@ -1,4 +1,14 @@
+import os
+
 import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+from functions.currency import get_currency_symbol
+
+# CWB_AFFORDABILITY_MODE: 'quantile' compares required_amount with the final-day p10/p90 (default),
+# 'empirical' uses the probability from the final-day sample distribution
+AFFORDABILITY_MODE = os.environ.get("CWB_AFFORDABILITY_MODE", "quantile")
 
 # Step 7: Affordability assessment
 
@@ -29,38 +39,153 @@ def assess_affordability(required_amount, conservative_forecast, optimistic_fore
         }
 
 
+def get_affordability_curve(final_day_samples, required_amounts):
+    """
+    Probability of the final-day balance meeting each required amount, from the empirical CDF
+    of the forecast samples. One sort of the samples answers any number of amounts.
+
+    Parameters:
+    final_day_samples (array): Final-day balance of every forecast sample path
+    required_amounts (array): Amounts to evaluate
+
+    Returns:
+    np.ndarray: P(balance >= amount) for each amount
+    """
+    sorted_samples = np.sort(np.asarray(final_day_samples, dtype=float))
+    amounts = np.asarray(required_amounts, dtype=float)
+
+    # Samples below the amount are the ones that miss it
+    return 1.0 - np.searchsorted(sorted_samples, amounts, side='left') / len(sorted_samples)
+
+
+def assess_affordability_from_samples(required_amount, final_day_samples):
+    """
+    Assess affordability from the exact probability of meeting required_amount,
+    bucketed like assess_affordability (90% and 50% thresholds)
+    """
+    probability = float(get_affordability_curve(final_day_samples, [required_amount])[0])
+    buffer = float(np.median(final_day_samples)) - required_amount
+
+    if probability >= 0.9:
+        assessment, recommendation = 'High confidence', 'Approve'
+    elif probability >= 0.5:
+        assessment, recommendation = 'Moderate confidence', 'Approve with monitoring'
+    else:
+        assessment, recommendation = 'Low confidence', 'Request additional financial guarantees'
+
+    return {
+        'assessment': assessment,
+        'probability': f"{probability:.1%}",
+        'probability_value': probability,
+        'recommendation': recommendation,
+        'buffer': buffer
+    }
+
+
+def get_schedule_due_days(schedule, forecast_dates):
+    """
+    Forecast day index of each instalment in a repayment schedule.
+
+    Parameters:
+    schedule (list): Instalments as {'date': 'YYYY-MM-DD', 'amount': ...} or {'day': 1..horizon, 'amount': ...}
+    forecast_dates (list): Dates of the forecast days
+
+    Returns:
+    tuple: (due_days, amounts) as NumPy arrays
+    """
+    forecast_dates = pd.to_datetime(pd.Series(forecast_dates)).dt.normalize().values
+    due_days, amounts = [], []
+
+    for instalment in schedule:
+        if 'date' in instalment:
+            due_date = pd.Timestamp(instalment['date']).normalize().to_datetime64()
+            matches = np.flatnonzero(forecast_dates == due_date)
+            if len(matches) == 0:
+                raise ValueError(f"Instalment date {instalment['date']} is outside the forecast period")
+            due_days.append(matches[0])
+        else:
+            day = int(instalment['day'])
+            if not 1 <= day <= len(forecast_dates):
+                raise ValueError(f"Instalment day {day} is outside the forecast period (1-{len(forecast_dates)})")
+            due_days.append(day - 1)
+        amounts.append(float(instalment['amount']))
+
+    return np.array(due_days, dtype=int), np.array(amounts, dtype=float)
+
+
+def simulate_repayment_schedule(sample_paths, due_days, amounts, overdraft_limit=0.0):
+    """
+    Evaluate a repayment schedule against every forecast sample path at once.
+
+    Each instalment is deducted from its due day onwards, so the balance on a due date
+    reflects every instalment paid up to and including it.
+
+    Parameters:
+    sample_paths (array): (num_samples, horizon) forecast balances in the original scale
+    due_days (array): Forecast day index of each instalment
+    amounts (array): Instalment amounts
+    overdraft_limit (float): Balance below which the applicant is overdrawn
+
+    Returns:
+    dict: Per instalment overdraft probability and expected shortfall, plus schedule-wide totals
+    """
+    sample_paths = np.asarray(sample_paths, dtype=float)
+
+    # Cumulative repayments by forecast day, subtracted from every path by broadcasting
+    repayments = np.zeros(sample_paths.shape[1])
+    np.add.at(repayments, due_days, amounts)
+    balances_after_repayment = sample_paths - np.cumsum(repayments)
+
+    # (num_samples, instalments) shortfall below the limit on each due date
+    shortfall = np.maximum(overdraft_limit - balances_after_repayment[:, due_days], 0.0)
+    overdrawn = shortfall > 0
+
+    return {
+        'due_days': due_days + 1,
+        'amounts': amounts,
+        'overdraft_probability': overdrawn.mean(axis=0),
+        'expected_shortfall': shortfall.mean(axis=0),
+        'probability_any_overdraft': float(overdrawn.any(axis=1).mean()),
+        'expected_max_shortfall': float(shortfall.max(axis=1).mean()) if len(due_days) else 0.0,
+        'min_balance_p10': float(np.percentile(balances_after_repayment.min(axis=1), 10)),
+    }
+
+
 #  Combine results and hyper parametres into a data frame
     
 def get_overall_assessment (experiment_id, required_amount, affordability_assessment, train_data, 
                             final_p10, final_median, final_p90, actual_final=None, error=None, 
-                            within_interval=None):
+                            within_interval=None, currency="GBP"):
+
+    # Amounts are in the applicant's own currency
+    symbol = get_currency_symbol(currency)
 
     # Create dictionaries for each section
     affordability_data = {
-        'Required amount': f"£{required_amount:.2f}",
+        'Required amount': f"{symbol}{required_amount:.2f}",
         'Assessment': affordability_assessment['assessment'],
         'Probability of meeting threshold': affordability_assessment['probability'],
         'Recommendation': affordability_assessment['recommendation'],
-        'Buffer amount (median forecast)': f"£{affordability_assessment['buffer']:.2f}"
+        'Buffer amount (median forecast)': f"{symbol}{affordability_assessment['buffer']:.2f}"
     }
 
     forecast_data = {
-        'Current balance': f"£{train_data['balance'].iloc[-1]:.2f}",
-        'Forecast for 30 days later (median)': f"£{final_median:.2f}",
-        'Conservative forecast (10th percentile)': f"£{final_p10:.2f}",
-        'Optimistic forecast (90th percentile)': f"£{final_p90:.2f}",
-        'Forecast range width': f"£{final_p90 - final_p10:.2f}"
+        'Current balance': f"{symbol}{train_data['balance'].iloc[-1]:.2f}",
+        'Forecast for 30 days later (median)': f"{symbol}{final_median:.2f}",
+        'Conservative forecast (10th percentile)': f"{symbol}{final_p10:.2f}",
+        'Optimistic forecast (90th percentile)': f"{symbol}{final_p90:.2f}",
+        'Forecast range width': f"{symbol}{final_p90 - final_p10:.2f}"
     }
 
     ###################### If block for when used for future forecasting when the actual future balance is not known ###################### 
     # Check if comparative metrics have data and format accordingly
     if actual_final is not None and not pd.isna(actual_final):
-        actual_final_value = f"£{actual_final:.2f}"
+        actual_final_value = f"{symbol}{actual_final:.2f}"
     else:
         actual_final_value = "No data"
 
     if error is not None and not pd.isna(error) and actual_final is not None and not pd.isna(actual_final):
-        error_value = f"£{error:.2f} ({100 * error / actual_final:.2f}%)"
+        error_value = f"{symbol}{error:.2f} ({100 * error / actual_final:.2f}%)"
     else:
         error_value = "No data"
 
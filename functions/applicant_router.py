@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+
+# Applicant-affinity routing across worker instances
+#
+# Per-instance state (history cache, worker pool, cached models) only pays off when an
+# applicant keeps landing on the same instance. HashRing maps applicant_id to a worker by
+# consistent hashing: every worker owns virtual_nodes points on a 64-bit ring and an
+# applicant goes to the owner of the first point clockwise from the applicant's hash. When
+# a worker joins or leaves only the applicants between its points and their predecessors
+# move (about 1/N of them), so the other workers keep their caches warm.
+#
+# create_router_app puts the ring behind a small flask app: POST requests are forwarded to
+# the applicant's worker, a worker that refuses or resets the connection before the request
+# is sent is taken off the ring (its applicants fail over to the next worker clockwise) and
+# put back once its health check passes again. A request that was sent is never re-sent -
+# it trains and writes to the database - so a timeout answers 504 and a connection lost
+# mid-response 502, and the worker stays on the ring. Workers can also join and leave
+# through /router/workers.
+#
+# GET /sketches goes to the worker owning its applicant_id query parameter, like a POST.
+# GET /metrics collects every member's metrics, adds a worker label to each sample and
+# appends the router's own per-worker counters, so the router is the cluster's single
+# front end for monitoring as well.
+#
+# Configuration (environment variables):
+# CWB_ROUTER_VIRTUAL_NODES    points per worker on the ring (default 160)
+# CWB_ROUTER_HEALTH_INTERVAL  seconds between health checks of removed workers (default 5)
+# CWB_ROUTER_TIMEOUT          seconds to wait for a worker's response (default 300)
+# CWB_ROUTER_METRICS_TIMEOUT  seconds to wait for each worker's /metrics (default 2)
+
+VIRTUAL_NODES = int(os.environ.get("CWB_ROUTER_VIRTUAL_NODES", "160"))
+HEALTH_INTERVAL_SECONDS = float(os.environ.get("CWB_ROUTER_HEALTH_INTERVAL", "5"))
+TIMEOUT_SECONDS = float(os.environ.get("CWB_ROUTER_TIMEOUT", "300"))
+METRICS_TIMEOUT_SECONDS = float(os.environ.get("CWB_ROUTER_METRICS_TIMEOUT", "2"))
+
+WORKER_HEADER = "X-CWB-Worker"
+FORWARDED_HEADERS = ["Content-Type", "Accept", "X-CWB-Profile", "X-Request-Id"]
+RETURNED_HEADERS = ["Content-Type", "Server-Timing", "Retry-After", "X-CWB-Profile-Id"]
+
+
+def hash_key(key):
+    """Stable 64-bit hash of a string (same on every process and machine, unlike hash())."""
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "little")
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes.
+
+    Parameters:
+    nodes (list): Initial node names (worker URLs)
+    virtual_nodes (int): Points per node; more points give a more even split
+    """
+
+    def __init__(self, nodes=(), virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self._ring = ((), np.empty(0, dtype=np.uint64), np.empty(0, dtype=int))  # (nodes, points, owners)
+        self._lock = threading.Lock()
+
+        for node in nodes:
+            self.add_node(node)
+
+    def _rebuild(self, nodes):
+        points = np.array(
+            [hash_key(f"{node}#{replica}") for node in nodes for replica in range(self.virtual_nodes)],
+            dtype=np.uint64,
+        )
+        owners = np.repeat(np.arange(len(nodes)), self.virtual_nodes)
+        order = np.argsort(points, kind="stable")
+
+        # Swap in the new ring as one immutable tuple so lookups never pair old and new parts
+        self._ring = (tuple(nodes), points[order], owners[order])
+
+    @property
+    def nodes(self):
+        return list(self._ring[0])
+
+    def add_node(self, node):
+        with self._lock:
+            if node not in self.nodes:
+                self._rebuild(self.nodes + [node])
+
+    def remove_node(self, node):
+        with self._lock:
+            if node in self.nodes:
+                self._rebuild([existing for existing in self.nodes if existing != node])
+
+    def get_node(self, key):
+        """Node that owns key, or None if the ring is empty."""
+        nodes, points, owners = self._ring
+        if not nodes:
+            return None
+        index = np.searchsorted(points, np.uint64(hash_key(key)), side="right") % len(points)
+        return nodes[owners[index]]
+
+    def get_nodes(self, keys):
+        """Owner of every key in one vectorized lookup."""
+        nodes, points, owners = self._ring
+        if not nodes:
+            return [None] * len(keys)
+        hashes = np.array([hash_key(key) for key in keys], dtype=np.uint64)
+        indexes = np.searchsorted(points, hashes, side="right") % len(points)
+        return [nodes[owner] for owner in owners[indexes]]
+
+    def get_distribution(self, keys):
+        """Number of keys owned by each node."""
+        nodes, points, owners = self._ring
+        counts = {node: 0 for node in nodes}
+        if nodes:
+            hashes = np.array([hash_key(key) for key in keys], dtype=np.uint64)
+            for owner in owners[np.searchsorted(points, hashes, side="right") % len(points)]:
+                counts[nodes[owner]] += 1
+        return counts
+
+
+def get_moved_keys(ring_before, ring_after, keys):
+    """Keys whose owner differs between two rings (the cost of a rebalance)."""
+    return [key for key, before, after in zip(keys, ring_before.get_nodes(keys), ring_after.get_nodes(keys)) if before != after]
+
+
+class ApplicantRouter:
+    """
+    Forward requests to the worker that owns the applicant, failing over around dead workers.
+
+    Parameters:
+    workers (list): Worker base URLs, e.g. http://127.0.0.1:8081/
+    virtual_nodes (int): Points per worker on the ring
+    """
+
+    def __init__(self, workers, virtual_nodes=VIRTUAL_NODES, timeout=TIMEOUT_SECONDS,
+                 health_interval=HEALTH_INTERVAL_SECONDS):
+        self.ring = HashRing(workers, virtual_nodes)
+        self.timeout = timeout
+        self.members = set(workers)  # workers that should be on the ring when healthy
+
+        self._lock = threading.Lock()
+        self._stats = {worker: {"routed": 0, "failed": 0} for worker in workers}
+
+        threading.Thread(target=self._check_health, args=(health_interval,), daemon=True).start()
+
+    def join(self, worker):
+        with self._lock:
+            self.members.add(worker)
+            self._stats.setdefault(worker, {"routed": 0, "failed": 0})
+        self.ring.add_node(worker)
+
+    def leave(self, worker):
+        with self._lock:
+            self.members.discard(worker)
+        self.ring.remove_node(worker)
+
+    def _check_health(self, interval):
+        """Put workers that were taken off the ring back once they answer again."""
+        while True:
+            time.sleep(interval)
+            for worker in set(self.members) - set(self.ring.nodes):
+                try:
+                    urllib.request.urlopen(worker, timeout=2)
+                except urllib.error.HTTPError:
+                    pass  # answered (400 for a GET), so it is up
+                except OSError:
+                    continue
+                print(f"Router: {worker} is healthy again, adding it back to the ring")
+                self.ring.add_node(worker)
+
+    def forward(self, applicant_id, body, headers, method="POST", path=""):
+        """
+        Send the request to the applicant's worker, failing over to the next owner.
+
+        Parameters:
+        applicant_id (str): Key the worker is chosen by
+        body (bytes): Request body (None for a GET)
+        headers (dict): Request headers to pass on
+        method (str): HTTP method
+        path (str): Path and query string relative to the worker URL, e.g. sketches?applicant_id=1
+
+        Returns:
+        tuple: (status, headers, body, worker) of the worker response
+        """
+        while True:
+            worker = self.ring.get_node(applicant_id)
+            if worker is None:
+                return 503, {"Retry-After": str(int(HEALTH_INTERVAL_SECONDS))}, b"No workers available", None
+
+            request = urllib.request.Request(urllib.parse.urljoin(worker, path), data=body, headers=headers, method=method)
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    status, response_headers, response_body = response.status, response.headers, response.read()
+            except urllib.error.HTTPError as error:
+                status, response_headers, response_body = error.code, error.headers, error.read()
+            except urllib.error.URLError as error:
+                # Raised while connecting and sending: refused or reset means the worker never got the request
+                if not isinstance(error.reason, ConnectionError):
+                    return self._failed(worker, error)
+                print(f"Router: {worker} failed ({error}), removing it from the ring")
+                self._count(worker, "failed")
+                self.ring.remove_node(worker)
+                continue
+            except OSError as error:
+                # Timed out or lost while the worker had the request: it may still be running, never re-send
+                return self._failed(worker, error)
+
+            self._count(worker, "routed")
+            returned = {name: response_headers[name] for name in RETURNED_HEADERS if response_headers.get(name)}
+            return status, returned, response_body, worker
+
+    def _count(self, worker, stat):
+        with self._lock:
+            self._stats[worker][stat] += 1
+
+    def _failed(self, worker, error):
+        """Response for a request the worker may have received: 504 on a timeout, 502 otherwise."""
+        self._count(worker, "failed")
+        timed_out = isinstance(error, TimeoutError) or isinstance(getattr(error, "reason", None), TimeoutError)
+        print(f"Router: request to {worker} failed ({error}), not retrying")
+        if timed_out:
+            return 504, {}, f"Worker {worker} did not respond within {self.timeout}s".encode(), worker
+        return 502, {}, f"Worker {worker} failed: {error}".encode(), worker
+
+    def metrics_text(self):
+        """Every member's /metrics with a worker label on each sample, plus the router's own counters."""
+        families, up = {}, {}  # metric name -> (HELP/TYPE lines, samples); Prometheus wants each family contiguous
+        for worker in sorted(self.members):
+            try:
+                with urllib.request.urlopen(urllib.parse.urljoin(worker, "metrics"), timeout=METRICS_TIMEOUT_SECONDS) as response:
+                    text = response.read().decode()
+            except OSError as error:
+                print(f"Router: could not collect metrics from {worker} ({error})")
+                up[worker] = 0
+                continue
+            up[worker] = 1
+
+            label = f'worker="{worker}"'
+            for line in text.splitlines():
+                if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                    header, _ = families.setdefault(line.split()[2], ([], []))
+                    if line not in header:
+                        header.append(line)
+                elif line.strip() and not line.startswith("#"):
+                    sample, value = line.rsplit(" ", 1)
+                    name = sample.split("{")[0]
+                    sample = f"{sample[:-1]},{label}}}" if sample.endswith("}") else f"{name}{{{label}}}"
+                    families.setdefault(name, ([], []))[1].append(f"{sample} {value}")
+
+        lines = [line for header, samples in families.values() for line in header + samples]
+        stats = self.stats()
+        metrics = [
+            ("cwb_router_worker_up", "gauge", "Worker answered /metrics", {worker: up.get(worker, 0) for worker in stats}),
+            ("cwb_router_worker_on_ring", "gauge", "Worker is on the hash ring",
+             {worker: int(counts["on_ring"]) for worker, counts in stats.items()}),
+            ("cwb_router_routed_total", "counter", "Requests answered by the worker",
+             {worker: counts["routed"] for worker, counts in stats.items()}),
+            ("cwb_router_failed_total", "counter", "Requests the worker failed or refused",
+             {worker: counts["failed"] for worker, counts in stats.items()}),
+        ]
+        for name, metric_type, help_text, values in metrics:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+            lines += [f'{name}{{worker="{worker}"}} {value}' for worker, value in values.items()]
+        return "\n".join(lines) + "\n"
+
+    def stats(self):
+        with self._lock:
+            return {
+                worker: {**counts, "on_ring": worker in self.ring.nodes, "member": worker in self.members}
+                for worker, counts in self._stats.items()
+            }
+
+
+def create_router_app(workers, **router_options):
+    """Flask app that routes run_ml_model requests by applicant_id over the given worker URLs."""
+    import flask
+
+    app = flask.Flask("cwb_applicant_router")
+    router = ApplicantRouter(workers, **router_options)
+    app.config["router"] = router
+
+    @app.route("/router/workers", methods=["GET", "POST", "DELETE"])
+    def workers_endpoint():
+        if flask.request.method == "POST":
+            router.join(flask.request.get_json()["url"])
+        elif flask.request.method == "DELETE":
+            router.leave(flask.request.get_json()["url"])
+        return flask.jsonify(router.stats())
+
+    @app.route("/", methods=["POST"])
+    def route_request():
+        body = flask.request.get_data()
+        try:
+            applicant_id = json.loads(body).get("applicant_id")
+        except (ValueError, AttributeError):
+            applicant_id = None  # let the worker answer the bad request
+
+        headers = {name: flask.request.headers[name] for name in FORWARDED_HEADERS if name in flask.request.headers}
+        status, response_headers, response_body, worker = router.forward(str(applicant_id), body, headers)
+        if worker is not None:
+            response_headers[WORKER_HEADER] = worker
+
+        return flask.Response(response_body, status=status, headers=response_headers)
+
+    @app.route("/sketches", methods=["GET"])
+    def route_sketches():
+        applicant_id = flask.request.args.get("applicant_id")
+        path = "sketches?" + flask.request.query_string.decode()
+        headers = {name: flask.request.headers[name] for name in FORWARDED_HEADERS if name in flask.request.headers}
+        status, response_headers, response_body, worker = router.forward(str(applicant_id), None, headers, "GET", path)
+        if worker is not None:
+            response_headers[WORKER_HEADER] = worker
+
+        return flask.Response(response_body, status=status, headers=response_headers)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return flask.Response(router.metrics_text(), mimetype="text/plain; version=0.0.4")
+
+    return app
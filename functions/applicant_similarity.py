@@ -0,0 +1,229 @@
+import os
+import time
+import threading
+
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+from functions.database import retrieve_data_from_sql
+from functions.forecast_sketches import SKETCH_TABLE_NAME, decode_sketches
+
+
+# Nearest-neighbour forecasts for applicants with too little history for DeepAR
+#
+# An applicant with fewer days than the model's context needs cannot be trained on. Instead
+# their history is summarised (balance level, volatility from rolling_7d_std, trend, major
+# expense rate and the day of month of salary and rent as points on a circle) and compared
+# with the same summary of every applicant that already has a stored forecast
+# (fin_history_enhanced plus cwb_validation_forecast_sketches). The forecasts of the k
+# nearest neighbours are re-anchored to the new applicant - each neighbour's change from
+# its last training balance, scaled by the ratio of volatilities, added to the applicant's
+# last balance - and pooled into one distribution per day. No model is trained.
+#
+# The index is one standardised (applicants, features) matrix; building it is a groupby
+# over the stored histories and a lookup is one broadcast distance computation.
+#
+# Configuration (environment variables):
+# CWB_COLD_START              1 to answer short-history applicants from neighbours (default 0)
+# CWB_COLD_START_NEIGHBOURS   neighbours pooled per forecast (default 5)
+# CWB_COLD_START_MIN_DAYS     shortest history answered from neighbours (default 14)
+# CWB_SIMILARITY_INDEX_TTL    seconds before the index is rebuilt from the database (default 300)
+
+COLD_START = os.environ.get("CWB_COLD_START", "0") == "1"
+NUM_NEIGHBOURS = int(os.environ.get("CWB_COLD_START_NEIGHBOURS", "5"))
+MIN_HISTORY_DAYS = int(os.environ.get("CWB_COLD_START_MIN_DAYS", "14"))
+INDEX_TTL_SECONDS = float(os.environ.get("CWB_SIMILARITY_INDEX_TTL", "300"))
+
+HISTORY_TABLE_NAME = "fin_history_enhanced"
+SUMMARY_FEATURES = ['balance_level', 'volatility_level', 'trend', 'major_expense_rate',
+                    'salary_day_cos', 'salary_day_sin', 'rent_day_cos', 'rent_day_sin']
+
+_similarity_index = None
+_similarity_index_built = 0.0
+_similarity_index_lock = threading.Lock()
+
+
+def _signed_log(values):
+    return np.sign(values) * np.log1p(np.abs(values))
+
+
+def summarise_histories(histories):
+    """
+    Feature summary of every applicant in histories (one groupby pass).
+
+    Parameters:
+    histories (DataFrame): fin_history rows, with an applicant_id column for several applicants
+
+    Returns:
+    DataFrame: SUMMARY_FEATURES plus volatility and last_balance, indexed by applicant_id
+    """
+    if 'applicant_id' not in histories.columns:
+        histories = histories.assign(applicant_id='')
+
+    angle = 2 * np.pi * histories['day_of_month'].to_numpy(dtype=float) / 31.0
+    is_salary_day = histories['is_salary_day'].to_numpy(dtype=float)
+    is_rent_day = histories['is_rent_day'].to_numpy(dtype=float)
+    frame = pd.DataFrame({
+        'applicant_id': histories['applicant_id'].astype(str).to_numpy(),
+        'balance': histories['balance'].to_numpy(dtype=float),
+        'volatility': histories['rolling_7d_std'].to_numpy(dtype=float),
+        'trend': histories['trend_7d'].to_numpy(dtype=float),
+        'major_expense_rate': histories['is_major_expense'].to_numpy(dtype=float),
+        'is_salary_day': is_salary_day,
+        'is_rent_day': is_rent_day,
+        'salary_day_cos': is_salary_day * np.cos(angle),
+        'salary_day_sin': is_salary_day * np.sin(angle),
+        'rent_day_cos': is_rent_day * np.cos(angle),
+        'rent_day_sin': is_rent_day * np.sin(angle),
+    })
+
+    grouped = frame.groupby('applicant_id', sort=False)
+    means = grouped[['balance', 'volatility', 'trend', 'major_expense_rate']].mean()
+    sums = grouped[['is_salary_day', 'is_rent_day', 'salary_day_cos', 'salary_day_sin', 'rent_day_cos', 'rent_day_sin']].sum()
+
+    summaries = pd.DataFrame(index=means.index)
+    summaries['balance_level'] = _signed_log(means['balance'])
+    summaries['volatility_level'] = np.log1p(means['volatility'].clip(lower=0))
+    summaries['trend'] = means['trend']
+    summaries['major_expense_rate'] = means['major_expense_rate']
+    # Mean direction of the salary / rent days on the month circle, zero when there were none
+    for event in ['salary_day', 'rent_day']:
+        count = sums[f'is_{event}'].where(sums[f'is_{event}'] > 0, 1)
+        summaries[f'{event}_cos'] = sums[f'{event}_cos'] / count
+        summaries[f'{event}_sin'] = sums[f'{event}_sin'] / count
+
+    summaries['volatility'] = means['volatility']
+    summaries['last_balance'] = grouped['balance'].last()
+    return summaries
+
+
+class SimilarityIndex:
+    """
+    Standardised feature summaries and stored forecasts of the applicants with a forecast.
+
+    Parameters:
+    summaries (DataFrame): summarise_histories output of the indexed applicants
+    anchors (np.ndarray): Last training balance each stored forecast starts from
+    sketches (np.ndarray): (applicants, days, size) stored forecast sketches
+    """
+
+    def __init__(self, summaries, anchors, sketches):
+        self.applicant_ids = summaries.index.to_numpy()
+        self.volatilities = summaries['volatility'].to_numpy(dtype=float)
+        self.anchors = np.asarray(anchors, dtype=float)
+        self.sketches = np.asarray(sketches, dtype=float)
+
+        features = summaries[SUMMARY_FEATURES].to_numpy(dtype=float)
+        self.mean = features.mean(axis=0)
+        std = features.std(axis=0)
+        self.std = np.where(std > 0, std, 1.0)
+        self.features = (features - self.mean) / self.std
+
+    def __len__(self):
+        return len(self.applicant_ids)
+
+    def has_neighbours(self, applicant_id=None):
+        """True when some indexed applicant other than applicant_id can be pooled."""
+        return bool(np.any(self.applicant_ids != str(applicant_id)))
+
+    def query(self, summaries, k=NUM_NEIGHBOURS, exclude=()):
+        """
+        k nearest indexed applicants of every summary row (one broadcast distance matrix).
+
+        Returns:
+        tuple: (indexes, distances), both (len(summaries), k), nearest first
+        """
+        queries = (summaries[SUMMARY_FEATURES].to_numpy(dtype=float) - self.mean) / self.std
+        distances = np.sqrt(((queries[:, None, :] - self.features[None, :, :]) ** 2).sum(axis=2))
+        distances[:, np.isin(self.applicant_ids, list(exclude))] = np.inf  # never match an applicant with itself
+
+        k = min(k, len(self))
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        return nearest, np.take_along_axis(distances, nearest, axis=1)
+
+    def forecast(self, history, applicant_id=None, k=NUM_NEIGHBOURS):
+        """
+        Pooled neighbour forecast for one applicant's (short) history.
+
+        Returns:
+        tuple: ((days, k * size) pooled balances per day, [{applicant_id, distance}, ...])
+        """
+        summary = summarise_histories(history)
+        nearest, distances = self.query(summary, k, exclude=[str(applicant_id)])
+        nearest, distances = nearest[0], distances[0]
+        nearest, distances = nearest[np.isfinite(distances)], distances[np.isfinite(distances)]
+        if len(nearest) == 0:
+            raise ValueError(f"No indexed applicants other than {applicant_id} to pool")
+
+        # Each neighbour's change from its anchor, rescaled to the applicant's volatility
+        volatility = summary['volatility'].iloc[0]
+        scale = volatility / np.where(self.volatilities[nearest] > 0, self.volatilities[nearest], volatility or 1.0)
+        changes = (self.sketches[nearest] - self.anchors[nearest, None, None]) * scale[:, None, None]
+        pooled = summary['last_balance'].iloc[0] + changes.transpose(1, 0, 2).reshape(changes.shape[1], -1)
+
+        neighbours = [
+            {"applicant_id": self.applicant_ids[index], "distance": float(distance)}
+            for index, distance in zip(nearest, distances)
+        ]
+        return pooled, neighbours
+
+
+def build_similarity_index():
+    """
+    Index every applicant with a stored history and forecast sketches.
+    Returns None when there are none yet (or either table does not exist).
+    """
+    histories = retrieve_data_from_sql(HISTORY_TABLE_NAME)
+    sketch_rows = retrieve_data_from_sql(SKETCH_TABLE_NAME)
+    if histories is None or sketch_rows is None or len(histories) == 0 or len(sketch_rows) == 0:
+        return None
+
+    histories = histories.astype({'applicant_id': str}).sort_values(['applicant_id', 'sn'])
+    sketch_rows = sketch_rows.astype({'applicant_id': str}).sort_values(['applicant_id', 'sn'])
+
+    applicant_ids, anchors, sketches = [], [], []
+    history_groups = dict(tuple(histories.groupby('applicant_id', sort=False)))
+    for applicant_id, rows in sketch_rows.groupby('applicant_id', sort=False):
+        history = history_groups.get(applicant_id)
+        if history is None or len(history) <= len(rows):
+            continue
+        # The stored validation forecast starts after the last training day
+        applicant_ids.append(applicant_id)
+        anchors.append(history['balance'].iloc[len(history) - len(rows) - 1])
+        sketches.append(decode_sketches(rows['sketch']))
+
+    # Only forecasts of the common shape can be pooled
+    if not sketches:
+        return None
+    shape = pd.Series([sketch.shape for sketch in sketches]).mode()[0]
+    keep = [index for index, sketch in enumerate(sketches) if sketch.shape == shape]
+
+    summaries = summarise_histories(histories[histories['applicant_id'].isin([applicant_ids[index] for index in keep])])
+    summaries = summaries.loc[[applicant_ids[index] for index in keep]]
+    print(f"Similarity index built over {len(keep)} applicants")
+    return SimilarityIndex(summaries, [anchors[index] for index in keep], np.stack([sketches[index] for index in keep]))
+
+
+def get_similarity_index():
+    """Return the process-wide similarity index, rebuilt when older than CWB_SIMILARITY_INDEX_TTL."""
+    global _similarity_index, _similarity_index_built
+
+    with _similarity_index_lock:
+        if _similarity_index is None or time.monotonic() - _similarity_index_built > INDEX_TTL_SECONDS:
+            _similarity_index = build_similarity_index()
+            _similarity_index_built = time.monotonic()
+
+    return _similarity_index
+
+
+def is_cold_start_candidate(history, errors):
+    """True when history is only rejected for being short and is long enough for a neighbour forecast."""
+    return (
+        COLD_START
+        and history is not None
+        and len(history) >= MIN_HISTORY_DAYS
+        and all(error['code'] == 'history_too_short' for error in errors)
+    )
@@ -0,0 +1,257 @@
+import os
+import tempfile
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+import torch
+
+from gluonts.dataset.common import ListDataset
+from gluonts.model.predictor import Predictor
+
+from functions.machinelearning import (
+    QUANTILES,
+    QUANTILE_NAMES,
+    get_dynamic_features,
+    limit_torch_threads,
+    prep_data_for_deep_ar_model,
+    create_model_and_train,
+    generate_forecasts,
+)
+from functions.ml_evaluation import (
+    FORECAST_HORIZON_NAMES,
+    compute_forecast_metrics,
+)
+from functions.torchscript_inference import (
+    compile_predictor,
+    load_compiled_predictor,
+)
+
+
+# Rolling-origin backtesting
+#
+# One model is trained on the history before the first forecast origin and reused
+# for every later origin. All origin windows are predicted as one multi-series
+# dataset, split into chunks across a process pool when more than one worker is used.
+
+PREDICTION_LENGTH = 30
+MIN_TRAIN_LENGTH = 90  # context_length (60) + prediction_length (30)
+
+# Predictor loaded once per pool worker by _init_worker
+_worker_predictor = None
+
+
+def get_backtest_cutoffs(n_rows, step=7, num_origins=None, min_train_length=MIN_TRAIN_LENGTH):
+    """
+    Return the row indices used as forecast origins, oldest first.
+
+    Each cutoff c forecasts rows c .. c + 30, so the last cutoff is len(data) - 30.
+    Cutoffs are spaced step days apart going back in time, stopping at
+    min_train_length or after num_origins cutoffs.
+    """
+    last_cutoff = n_rows - PREDICTION_LENGTH
+    if last_cutoff < min_train_length:
+        raise ValueError(
+            f"Not enough history to backtest: {n_rows} rows, need at least "
+            f"{min_train_length + PREDICTION_LENGTH}"
+        )
+
+    cutoffs = np.arange(last_cutoff, min_train_length - 1, -step)[::-1]
+    if num_origins is not None:
+        cutoffs = cutoffs[-num_origins:]
+
+    return cutoffs
+
+
+def prep_backtest_windows(data, cutoffs, scaler, volatility_max):
+    """
+    Build one GluonTS entry per cutoff, scaled with the training scaler.
+
+    Each entry holds the history up to cutoff + 30; make_evaluation_predictions
+    holds back the last 30 days and forecasts them from the rest.
+    """
+    dynamic_features = np.asarray(get_dynamic_features(data, volatility_max), dtype=np.float32)
+    scaled_balance = scaler.transform(data['balance'].values.reshape(-1, 1)).flatten()
+    start = pd.Timestamp(data['date'].iloc[0])
+
+    return [
+        {
+            "start": start,
+            "target": scaled_balance[:cutoff + PREDICTION_LENGTH],
+            "feat_dynamic_real": dynamic_features[:, :cutoff + PREDICTION_LENGTH],
+        }
+        for cutoff in cutoffs
+    ]
+
+
+def _init_worker(predictor_dir, num_threads, compiled):
+    global _worker_predictor
+    limit_torch_threads(num_threads)
+    _worker_predictor = Predictor.deserialize(Path(predictor_dir))
+    if compiled:
+        _worker_predictor = load_compiled_predictor(Path(predictor_dir) / "prediction_net.pt", _worker_predictor)
+
+
+def _predict_windows(windows, predictor=None):
+    """Forecast a list of window entries and return the scaled samples as (windows, samples, 30)."""
+    predictor = predictor if predictor is not None else _worker_predictor
+    forecasts, _ = generate_forecasts(predictor, ListDataset(windows, freq="D"))
+
+    return np.stack([forecast.samples for forecast in forecasts]).astype(np.float32)
+
+
+def predict_backtest_windows(predictor, windows, max_workers=1, compiled=False):
+    """
+    Predict all windows, inline for a single worker or in chunks across a process pool.
+    With compiled, sampling runs through the TorchScript module of the predictor.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(windows)))
+
+    compiled_predictor = None
+    if compiled:
+        compiled_predictor = compile_predictor(predictor, ListDataset(windows, freq="D"))
+
+    if max_workers == 1:
+        return _predict_windows(windows, compiled_predictor or predictor)
+
+    chunks = np.array_split(np.arange(len(windows)), max_workers)
+    threads_per_worker = max(1, (os.cpu_count() or 1) // max_workers)
+
+    with tempfile.TemporaryDirectory() as predictor_dir:
+        predictor.serialize(Path(predictor_dir))
+        if compiled:
+            torch.jit.save(compiled_predictor.prediction_net, str(Path(predictor_dir) / "prediction_net.pt"))
+
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(predictor_dir, threads_per_worker, compiled),
+        ) as executor:
+            results = executor.map(_predict_windows, [[windows[i] for i in chunk] for chunk in chunks])
+            return np.concatenate(list(results))
+
+
+def backtest_applicant(data, applicant_id=None, step=7, num_origins=None, max_workers=1, predictor=None, compiled=False):
+    """
+    Backtest one applicant's history over many forecast origins with a single model.
+
+    Parameters:
+    data (DataFrame): Applicant history as returned from fin_history
+    applicant_id (str): Identifier stored with the results
+    step (int): Days between forecast origins
+    num_origins (int): Keep only the most recent num_origins origins
+    max_workers (int): Processes used for prediction (1 predicts inline)
+    predictor: Already trained predictor, trained on the pre-origin history if not given
+    compiled (bool): Sample through the TorchScript-compiled network (see torchscript_inference)
+
+    Returns:
+    dict: Compact per-origin results (see the keys below), float32 arrays
+    """
+    data = data.reset_index(drop=True)
+    cutoffs = get_backtest_cutoffs(len(data), step=step, num_origins=num_origins)
+
+    # Train once on everything before the first origin
+    train_data = data.iloc[:cutoffs[0]]
+    training_data, scaler = prep_data_for_deep_ar_model(train_data)
+    if predictor is None:
+        predictor = create_model_and_train(training_data)
+
+    windows = prep_backtest_windows(data, cutoffs, scaler, train_data['rolling_7d_std'].max())
+    samples = predict_backtest_windows(predictor, windows, max_workers=max_workers, compiled=compiled)
+
+    # Back to the original scale, then quantiles over the sample axis -> (origins, quantiles, 30)
+    samples = scaler.inverse_transform(samples.reshape(-1, 1)).reshape(samples.shape)
+    forecasts = np.quantile(samples, QUANTILES, axis=1).transpose(1, 0, 2)
+
+    # Actuals for each window -> (origins, 30)
+    balance = data['balance'].values
+    actuals = balance[cutoffs[:, None] + np.arange(PREDICTION_LENGTH)]
+
+    # Metrics of each quantile at each horizon for all origins at once -> (origins, quantiles, horizons)
+    metrics = compute_forecast_metrics(forecasts, actuals)
+
+    return {
+        'applicant_id': applicant_id,
+        'origins': data['date'].values[cutoffs].astype('datetime64[D]'),
+        'cutoffs': cutoffs.astype(np.int32),
+        'quantiles': np.array(QUANTILES, dtype=np.float32),
+        'forecasts': forecasts.astype(np.float32),
+        'actuals': actuals.astype(np.float32),
+        'rmse': metrics['rmse'].astype(np.float32),
+        'mae': metrics['mae'].astype(np.float32),
+        'pinball': metrics['pinball'].astype(np.float32),
+        'coverage': metrics['coverage'].astype(np.float32),
+        'intervals': np.array(metrics['intervals'], dtype=np.float32),
+    }
+
+
+def _backtest_applicant_task(applicant_id, data, kwargs, num_threads):
+    limit_torch_threads(num_threads)
+    return backtest_applicant(data, applicant_id=applicant_id, max_workers=1, **kwargs)
+
+
+def backtest_book(histories, max_workers=None, **kwargs):
+    """
+    Backtest many applicants, one applicant per pool task.
+
+    Parameters:
+    histories (dict or DataFrame): {applicant_id: history} or a frame with an applicant_id column
+    max_workers (int): Processes in the pool (defaults to the CPU count)
+    **kwargs: Passed through to backtest_applicant (step, num_origins, compiled)
+
+    Returns:
+    dict: {applicant_id: results} as returned by backtest_applicant, or
+          {'applicant_id': ..., 'error': message} for an applicant that could not be
+          backtested (e.g. a history too short for a single origin)
+    """
+    if isinstance(histories, pd.DataFrame):
+        histories = {applicant_id: group for applicant_id, group in histories.groupby('applicant_id')}
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(histories)))
+    threads_per_worker = max(1, (os.cpu_count() or 1) // max_workers)
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            applicant_id: executor.submit(_backtest_applicant_task, applicant_id, data, kwargs, threads_per_worker)
+            for applicant_id, data in histories.items()
+        }
+        results = {}
+        for applicant_id, future in futures.items():
+            # One unusable history must not abort the rest of the book
+            try:
+                results[applicant_id] = future.result()
+            except ValueError as error:
+                print(f"Skipping backtest of applicant {applicant_id}: {error}")
+                results[applicant_id] = {'applicant_id': applicant_id, 'error': str(error)}
+        return results
+
+
+def get_backtest_summary(results):
+    """
+    Average RMSE across origins in the same layout as get_combined_rmse.
+    """
+    mean_rmse = results['rmse'].mean(axis=0)
+    summary = pd.DataFrame(mean_rmse, columns=FORECAST_HORIZON_NAMES)
+    summary.insert(0, 'quartiles', QUANTILE_NAMES)
+    summary['origins'] = len(results['origins'])
+
+    return summary
+
+
+def save_backtest_results(results, path):
+    """Write backtest results to a compressed .npz file."""
+    np.savez_compressed(path, **{key: np.asarray(value) for key, value in results.items() if value is not None})
+
+
+def load_backtest_results(path):
+    """Read backtest results written by save_backtest_results."""
+    with np.load(path, allow_pickle=False) as stored:
+        return {key: stored[key] for key in stored.files}
@@ -0,0 +1,200 @@
+import os
+import re
+import threading
+
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+
+# Currency conversion to GBP for histories and forecasts
+#
+# FX rates are GBP per unit of currency by date. The table is loaded once from the CSV
+# named by CWB_FX_RATES_PATH (date column plus one column per currency) into a dense
+# (days, currencies) matrix with one row per calendar day, weekends and holidays carrying
+# the last known rate. It is kept in memory and reloaded only when the file changes.
+# Without CWB_FX_RATES_PATH there is no conversion: forecasts stay in the applicant's
+# currency and nothing is written to the GBP tables. fx_rates_sample.csv next to this
+# module holds synthetic rates for offline tests (e.g. with CWB_DB_BACKEND=fake), never
+# for real assessments.
+#
+# A conversion looks up the rate rows by day offset and multiplies: for a batch of
+# forecasts that is one gather of a (applicants, days) rate matrix and one broadcast
+# multiply over (applicants, quantiles, days), however many applicants and currencies.
+# Dates outside the table use its first or last rate; such conversions are logged and
+# flagged (fx_rate_clipped) so stale rates are visible.
+#
+# Configuration (environment variables):
+# CWB_FX_RATES_PATH     rates CSV, required for conversion to GBP (default: not set, no conversion)
+# CWB_SOURCE_CURRENCY   currency of balances in histories without a currency column (default GBP)
+
+FX_RATES_PATH = os.environ.get("CWB_FX_RATES_PATH")
+GBP_CONVERSION = FX_RATES_PATH is not None
+SAMPLE_FX_RATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fx_rates_sample.csv")
+SOURCE_CURRENCY = os.environ.get("CWB_SOURCE_CURRENCY", "GBP").upper()
+
+BASE_CURRENCY = "GBP"
+CURRENCY_SYMBOLS = {"GBP": "£", "USD": "$", "EUR": "€", "NGN": "₦"}
+
+# Columns of a fin_history frame that scale with the balance (trend_7d is a balance difference / 1000)
+BALANCE_COLUMNS = ['balance', 'rolling_7d_std', 'trend_7d']
+
+_fx_rate_table = None
+_fx_rate_table_mtime = None
+_fx_rate_table_lock = threading.Lock()
+
+
+class FXRateTable:
+    """
+    Daily GBP rates as a dense (days, currencies) matrix.
+
+    Parameters:
+    rates (DataFrame): GBP per unit, indexed by date, one column per currency
+    """
+
+    def __init__(self, rates):
+        rates = rates.sort_index()
+        days = pd.date_range(rates.index.min(), rates.index.max(), freq="D")
+        rates = rates.reindex(days).ffill()
+        rates[BASE_CURRENCY] = 1.0
+
+        self.start = days[0].to_datetime64().astype("datetime64[D]")
+        self.end = days[-1].to_datetime64().astype("datetime64[D]")
+        self.currencies = list(rates.columns)
+        self.rates = rates.to_numpy(dtype=float)
+        self._currency_index = {currency: index for index, currency in enumerate(self.currencies)}
+
+    def currency_index(self, currencies):
+        """Column of each currency code (vectorized over an array of codes)."""
+        codes = np.char.upper(np.asarray(currencies, dtype=str))
+        unique_codes, positions = np.unique(codes, return_inverse=True)
+        unknown = [code for code in unique_codes if code not in self._currency_index]
+        if unknown:
+            raise ValueError(f"No FX rates for {', '.join(unknown)}")
+        return np.array([self._currency_index[code] for code in unique_codes])[positions].reshape(codes.shape)
+
+    def day_index(self, dates):
+        """Row of each date, clipped to the table's date range."""
+        offsets = (np.asarray(dates, dtype="datetime64[D]") - self.start).astype(np.int64)
+        return np.clip(offsets, 0, len(self.rates) - 1)
+
+    def is_clipped(self, dates):
+        """True for each date outside the table's date range (converted at its first or last rate)."""
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        return (dates < self.start) | (dates > self.end)
+
+    def get_rates(self, currencies, dates):
+        """
+        GBP per unit for every (currency, date) pair, broadcast against each other.
+        E.g. currencies (applicants, 1) and dates (applicants, days) give (applicants, days).
+        """
+        return self.rates[self.day_index(dates), self.currency_index(currencies)]
+
+
+def load_fx_rates(path=FX_RATES_PATH):
+    """FXRateTable from a CSV with a date column and one GBP-per-unit column per currency."""
+    rates = pd.read_csv(path, parse_dates=['date'], index_col='date')
+    rates.columns = [column.upper() for column in rates.columns]
+    return FXRateTable(rates)
+
+
+def get_fx_rate_table(path=FX_RATES_PATH):
+    """Return the process-wide rate table, reloading it when the file has changed."""
+    global _fx_rate_table, _fx_rate_table_mtime
+
+    if path is None:
+        raise ValueError("No FX rates configured: set CWB_FX_RATES_PATH to convert to GBP")
+
+    mtime = os.path.getmtime(path)
+    with _fx_rate_table_lock:
+        if _fx_rate_table is None or mtime != _fx_rate_table_mtime:
+            _fx_rate_table = load_fx_rates(path)
+            _fx_rate_table_mtime = mtime
+
+    return _fx_rate_table
+
+
+def get_history_currency(data):
+    """Currency of an applicant's balances: the history's currency column, else CWB_SOURCE_CURRENCY."""
+    if data is not None and 'currency' in data.columns and data['currency'].notna().any():
+        return str(data['currency'].dropna().iloc[-1]).upper()
+    return SOURCE_CURRENCY
+
+
+def get_unsupported_currency(currency):
+    """
+    Reason the applicant's currency cannot be converted to GBP, or None when it can
+    (GBP itself, conversion disabled, or a currency in the rate table).
+    """
+    if currency == BASE_CURRENCY or not GBP_CONVERSION:
+        return None
+    if currency not in get_fx_rate_table().currencies:
+        return f"No FX rates for {currency} in {FX_RATES_PATH}"
+    return None
+
+
+def get_currency_symbol(currency):
+    return CURRENCY_SYMBOLS.get(str(currency).upper(), f"{currency} ")
+
+
+def convert_to_gbp(values, dates, currencies, fx_rate_table=None):
+    """
+    Convert amounts dated along the last axis to GBP in one broadcast multiply.
+
+    Parameters:
+    values (np.ndarray): (..., days) amounts, e.g. (quantiles, days) for one forecast or
+                         (applicants, quantiles, days) for a batch
+    dates (array): (days,) dates shared by all rows, or (applicants, days) per applicant
+    currencies (str or array): One currency, or one per applicant (leading axis of values)
+
+    Returns:
+    np.ndarray: values in GBP, same shape
+    """
+    fx_rate_table = fx_rate_table or get_fx_rate_table()
+    values = np.asarray(values, dtype=float)
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    currencies = np.asarray(currencies, dtype=str)
+
+    clipped = int(fx_rate_table.is_clipped(dates).sum())
+    if clipped:
+        print(f"FX rates: {clipped} dates outside {fx_rate_table.start} to {fx_rate_table.end} use the nearest available rate")
+
+    if currencies.ndim == 0:
+        rates = fx_rate_table.get_rates(currencies, dates)  # (days,) or (applicants, days)
+    else:
+        rates = fx_rate_table.get_rates(currencies[:, None], np.atleast_2d(dates))  # (applicants, days)
+
+    # Line up the applicant axis with values' leading axis, the day axis with its last
+    if rates.ndim == 2:
+        rates = rates.reshape(rates.shape[0], *([1] * (values.ndim - 2)), rates.shape[1])
+    return values * rates
+
+
+def convert_history_to_gbp(data, currency=None, fx_rate_table=None):
+    """fin_history rows with the balance-scaled columns in GBP (each day at its own rate)."""
+    currency = currency or get_history_currency(data)
+    columns = [column for column in BALANCE_COLUMNS if column in data.columns]
+
+    result = data.copy()
+    result[columns] = convert_to_gbp(data[columns].to_numpy(dtype=float).T, pd.to_datetime(data['date']).to_numpy(),
+                                     currency, fx_rate_table).T
+    if 'currency' in result.columns:
+        result['currency'] = BASE_CURRENCY
+    return result
+
+
+def convert_forecast_frame_to_gbp(forecast_df, currency, fx_rate_table=None):
+    """
+    cwb_validation_forecasts rows (date, actual and quantile columns) in GBP, with the rate
+    used for each day and whether it was clipped to the table's range, for the
+    gbp_cwb_validation_forecasts table.
+    """
+    fx_rate_table = fx_rate_table or get_fx_rate_table()
+    columns = [column for column in forecast_df.columns if re.fullmatch(r'p\d+|actual', str(column))]
+    dates = pd.to_datetime(forecast_df['date']).to_numpy()
+
+    result = forecast_df.copy()
+    result[columns] = convert_to_gbp(forecast_df[columns].to_numpy(dtype=float).T, dates, currency, fx_rate_table).T
+    result['fx_rate'] = fx_rate_table.get_rates(currency, dates)
+    result['fx_rate_clipped'] = fx_rate_table.is_clipped(dates)
+    return result
@@ -1,3 +1,5 @@
+import os
+
 import psycopg2
 import pandas as pd
 import numpy as np
@@ -38,7 +40,10 @@ def get_column_name_and_datatype_dictionary(df):
         # Convert dtype to string and extract the type name
         dtype_str = str(dtype)
         # Map pandas dtype to SQL type
-        if dtype_str in sql_type_mapping:
+        non_null_values = df[column].dropna()
+        if dtype_str == 'object' and len(non_null_values) and isinstance(non_null_values.iloc[0], bytes):
+            sql_type = 'BYTEA'  # Binary payloads such as forecast sketches
+        elif dtype_str in sql_type_mapping:
             sql_type = sql_type_mapping[dtype_str]
         else:
             sql_type = 'VARCHAR(255)'  # Default fallback
@@ -213,7 +218,12 @@ def prepare_sql_queries_and_values(column_definitions, table_name, data):
 def get_db_connection():
     """
     Creates a database connection using environment variables
+    CWB_DB_BACKEND=fake returns an in-memory stand-in (functions.fake_database) for offline load tests
     """
+    if os.environ.get("CWB_DB_BACKEND") == "fake":
+        from functions import fake_database
+        return fake_database.connect()
+
     dbname='cwb-database'
     try:
         connection = psycopg2.connect(
@@ -289,8 +299,42 @@ def insert_data_into_sql_data_base(table_query, insert_query, values_list):
 
 
 
+def insert_batches_into_sql_data_base(statements):
+    """
+    Run several prepared inserts over one connection and commit them together.
+    
+    Unlike insert_data_into_sql_data_base, errors are raised to the caller so that
+    it can retry (used by the write-behind queue).
+    
+    Parameters:
+    statements (list): (table_query, insert_query, values_list) tuples
+    
+    Returns:
+    int: Number of rows written
+    """
+    connection = get_db_connection()
+    if not connection:
+        raise ConnectionError("Could not connect to the database")
 
-def retrieve_data_from_sql(table_name):
+    rows = 0
+    try:
+        cursor = connection.cursor()
+        for table_query, insert_query, values_list in statements:
+            cursor.execute(table_query)
+            cursor.executemany(insert_query, values_list)
+            rows += len(values_list)
+        connection.commit()
+        print(f"Inserted {rows} rows in {len(statements)} batched statements")
+        return rows
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+
+def retrieve_data_from_sql(table_name, applicant_id=None, after_date=None):
     """
     Retrieve data from a specified SQL table and return it as a pandas DataFrame.
     
@@ -302,6 +346,10 @@ def retrieve_data_from_sql(table_name):
     ----------
     table_name : str
         The name of the SQL table to retrieve data from
+    applicant_id : str, optional
+        Only return rows for this applicant (table must have an applicant_id column)
+    after_date : date-like, optional
+        Only return rows with date later than this (delta query for cached history)
         
     Returns:
     -------
@@ -315,6 +363,7 @@ def retrieve_data_from_sql(table_name):
     The function handles exceptions internally and prints error messages,
     but does not raise exceptions to the caller.
     """
+    df = None  # returned as None when the query fails (e.g. the table does not exist yet)
     try:
         # Create connection to the SQL database
         connection = get_db_connection()
@@ -326,9 +375,19 @@ def retrieve_data_from_sql(table_name):
         # Create a cursor
         cursor = connection.cursor()
         
-        # Retrieve Data from the table
+        # Retrieve Data from the table (optionally one applicant and/or only rows after a date)
+        conditions, params = [], []
+        if applicant_id is not None:
+            conditions.append("applicant_id = %s")
+            params.append(str(applicant_id))
+        if after_date is not None:
+            conditions.append("date > %s")
+            params.append(pd.Timestamp(after_date).to_pydatetime())
+
         table_query = f"SELECT * FROM {table_name}"
-        cursor.execute(table_query)
+        if conditions:
+            table_query += " WHERE " + " AND ".join(conditions)
+        cursor.execute(table_query, params)
         result = cursor.fetchall()
         
         # Convert the data from the SQL database to a dataframe
@@ -0,0 +1,141 @@
+import os
+import time
+import uuid
+import threading
+
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+from functions.training_scheduler import TrainingScheduler, get_available_cores
+
+
+# Parallel multi-seed ensemble for run_prediction
+#
+# A single DeepAR model depends on its random seed, so the quantiles (and with them the
+# affordability decision) move from run to run. In ensemble mode K members are trained
+# from different seeds, each on its own core set in a training-scheduler process, so they
+# run side by side instead of one after another. Every member trains disk-free (no
+# lightning_logs race between processes) and samples its forecast in the pool process;
+# only the sample paths come back. The paths of all members are pooled into one
+# SampleForecast, so the quantiles, affordability and repayment simulation downstream
+# work unchanged on K x 1000 paths.
+#
+# Members may also differ in their hyperparameters (members=[{...}, ...]), e.g. a deeper
+# DeepAR next to the default one.
+#
+# Configuration (environment variables):
+# CWB_ENSEMBLE_SIZE   members per forecast, 1 disables the ensemble (default 1)
+# CWB_ENSEMBLE_SEED   seed of the first member, member i uses seed + i (default 0)
+
+ENSEMBLE_SIZE = int(os.environ.get("CWB_ENSEMBLE_SIZE", "1"))
+ENSEMBLE_SEED = int(os.environ.get("CWB_ENSEMBLE_SEED", "0"))
+
+_ensemble_scheduler = None
+_ensemble_scheduler_lock = threading.Lock()
+
+
+def _train_member(training_data, seed, hyperparameters):
+    """
+    Runs in a pool process: train one seeded member and sample its validation forecast.
+
+    Returns:
+    dict: scaled sample paths, forecast start and item id, training record and timings
+    """
+    import lightning.pytorch as pl
+    from functions.machinelearning import train_model_in_memory, generate_forecasts
+
+    pl.seed_everything(seed, workers=True)
+
+    started = time.monotonic()
+    predictor, training_record = train_model_in_memory(training_data, hyperparameters)
+    trained = time.monotonic()
+    forecasts, _ = generate_forecasts(predictor, training_data)
+    finished = time.monotonic()
+
+    return {
+        "samples": forecasts[0].samples,
+        "start_date": forecasts[0].start_date,
+        "item_id": forecasts[0].item_id,
+        "training_record": training_record,
+        "timings": {"training": trained - started, "forecasting": finished - trained, "total": finished - started},
+        "pid": os.getpid(),
+    }
+
+
+def get_ensemble_scheduler(size=ENSEMBLE_SIZE):
+    """
+    Return the process-wide scheduler for ensemble members, creating it on first use.
+    The cores available to this process are split so that all members of one forecast run
+    at once; in a worker-pool process that is the worker's own share of the machine.
+    """
+    global _ensemble_scheduler
+
+    with _ensemble_scheduler_lock:
+        if _ensemble_scheduler is None:
+            _ensemble_scheduler = TrainingScheduler(threads_per_job=max(1, len(get_available_cores()) // max(1, size)))
+
+    return _ensemble_scheduler
+
+
+def pool_sample_paths(member_results):
+    """One SampleForecast holding the sample paths of every member."""
+    from gluonts.model.forecast import SampleForecast
+
+    samples = np.concatenate([result["samples"] for result in member_results], axis=0)
+    return SampleForecast(samples, start_date=member_results[0]["start_date"], item_id=member_results[0]["item_id"])
+
+
+def run_ensemble(training_data, size=ENSEMBLE_SIZE, seed=ENSEMBLE_SEED, members=None):
+    """
+    Train the ensemble members in parallel and pool their forecasts.
+
+    Parameters:
+    training_data (ListDataset): Scaled training data from prep_data_for_deep_ar_model
+    size (int): Members when members is not given
+    seed (int): Seed of the first member, member i uses seed + i
+    members (list): Hyperparameter overrides, one dict per member
+
+    Returns:
+    tuple: (pooled forecast, ensemble record) where the record holds a version id, the
+           shared hyperparameters and per-member seed, loss and timings
+    """
+    members = members if members is not None else [{}] * size
+    scheduler = get_ensemble_scheduler(len(members))
+
+    started = time.monotonic()
+    futures = [
+        scheduler.submit(_train_member, training_data, seed + index, hyperparameters or None)
+        for index, hyperparameters in enumerate(members)
+    ]
+    member_results = [future.result() for future in futures]
+    wall_seconds = time.monotonic() - started
+
+    member_reports = [
+        {
+            "member": index,
+            "seed": seed + index,
+            "hyperparameters": hyperparameters,
+            "best_epoch": result["training_record"]["best_epoch"],
+            "best_train_loss": result["training_record"]["best_train_loss"],
+            "num_samples": len(result["samples"]),
+            "pid": result["pid"],
+            **{f"{stage}_seconds": seconds for stage, seconds in result["timings"].items()},
+        }
+        for index, (hyperparameters, result) in enumerate(zip(members, member_results))
+    ]
+    serial_seconds = sum(report["total_seconds"] for report in member_reports)
+
+    ensemble_record = {
+        "version": f"ensemble_{uuid.uuid4().hex[:12]}",
+        "hyperparameters": {
+            **member_results[0]["training_record"]["hyperparameters"],
+            "ensemble_size": len(members),
+            "ensemble_seed": seed,
+        },
+        "members": member_reports,
+        "wall_seconds": wall_seconds,
+        "speedup": serial_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+    }
+    print(f"Ensemble of {len(members)} members in {wall_seconds:.1f}s ({ensemble_record['speedup']:.1f}x over serial)")
+
+    return pool_sample_paths(member_results), ensemble_record
@@ -0,0 +1,247 @@
+import os
+import re
+import time
+import zlib
+import threading
+
+import psycopg2
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+
+# In-memory stand-in for the Postgres database, used for offline load tests.
+#
+# get_db_connection returns a connection from this module when CWB_DB_BACKEND=fake,
+# so everything in functions.database runs unchanged against it. Only the SQL this
+# code base issues is understood: CREATE TABLE IF NOT EXISTS, INSERT ... ON CONFLICT
+# upserts, and SELECT * FROM table [WHERE col op %s AND ...]. Like Postgres, a WHERE
+# on a column the table does not have raises psycopg2.ProgrammingError, which
+# retrieve_data_from_sql reports as a failed query.
+#
+# With CWB_FIN_HISTORY_BY_APPLICANT=1 fin_history gets an applicant_id column and each
+# applicant's history is generated on the first query that filters on it (seeded from
+# the applicant id, so every applicant has a stable history of its own).
+#
+# Configuration (environment variables):
+# CWB_FAKE_DB_LATENCY_MS         simulated round trip added to every execute (default 0)
+# CWB_FAKE_DB_HISTORY_DAYS       length of the seeded fin_history (default 240)
+# CWB_FAKE_DB_SEED               random seed for the seeded fin_history (default 0)
+# CWB_FIN_HISTORY_BY_APPLICANT   1 to key fin_history by applicant_id (default 0, one shared history)
+
+LATENCY_SECONDS = float(os.environ.get("CWB_FAKE_DB_LATENCY_MS", "0")) / 1000.0
+HISTORY_DAYS = int(os.environ.get("CWB_FAKE_DB_HISTORY_DAYS", "240"))
+SEED = int(os.environ.get("CWB_FAKE_DB_SEED", "0"))
+BY_APPLICANT = os.environ.get("CWB_FIN_HISTORY_BY_APPLICANT", "0") == "1"
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+_CONDITION_OPERATORS = {
+    "=": lambda a, b: a == b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+
+
+def make_fin_history(num_days=HISTORY_DAYS, seed=SEED, start="2024-01-01", applicant_id=None):
+    """
+    Synthetic fin_history with the engineered columns the pipeline expects:
+    a monthly salary on the 25th, rent on the 1st, occasional major expenses and
+    daily spending noise. An applicant_id column is added when one is given.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods=num_days, freq="D")
+
+    is_salary_day = (dates.day == 25).astype(int)
+    is_rent_day = (dates.day == 1).astype(int)
+    is_major_expense = (rng.random(num_days) < 0.05).astype(int)
+
+    daily_flow = (
+        3000.0 * is_salary_day
+        - 1200.0 * is_rent_day
+        - is_major_expense * rng.uniform(100.0, 500.0, num_days)
+        - rng.uniform(10.0, 60.0, num_days)
+    )
+    balance = pd.Series(10000.0 + np.cumsum(daily_flow))
+
+    history = pd.DataFrame({
+        'date': dates,
+        'balance': balance.values,
+        'day_of_month': dates.day,
+        'day_of_week': dates.dayofweek,
+        'is_weekend': (dates.dayofweek >= 5).astype(int),
+        'rolling_7d_std': balance.rolling(7, min_periods=2).std().bfill().values,
+        'is_salary_day': is_salary_day,
+        'is_rent_day': is_rent_day,
+        'is_major_expense': is_major_expense,
+        'trend_7d': balance.diff(7).fillna(0.0).values / 1000.0,
+    })
+    if applicant_id is not None:
+        history.insert(0, 'applicant_id', str(applicant_id))
+    return history
+
+
+def seed_fin_history():
+    """Seed fin_history: one shared history, or an empty per-applicant table filled on demand."""
+    if BY_APPLICANT:
+        seed_table("fin_history", make_fin_history(num_days=0, applicant_id=""))
+    else:
+        seed_table("fin_history", make_fin_history())
+
+
+def _ensure_applicant_history(table, applicant_id):
+    """Generate an applicant's fin_history rows the first time they are queried (caller holds the lock)."""
+    position = table["columns"].index("applicant_id")
+    if any(row[position] == applicant_id for row in table["rows"]):
+        return
+
+    seed = SEED + zlib.crc32(str(applicant_id).encode())
+    history = make_fin_history(seed=seed, applicant_id=applicant_id)[table["columns"]]
+    table["rows"].extend(tuple(row) for row in history.itertuples(index=False, name=None))
+
+
+def seed_table(table_name, df):
+    """Replace the contents of a table with a DataFrame."""
+    with _tables_lock:
+        _tables[table_name] = {
+            "columns": list(df.columns),
+            "key": None,
+            "rows": [tuple(row) for row in df.itertuples(index=False, name=None)],
+        }
+
+
+def get_table(table_name):
+    """Return a copy of a table as a DataFrame (for inspecting load-test results)."""
+    with _tables_lock:
+        table = _tables[table_name]
+        return pd.DataFrame(list(table["rows"]), columns=table["columns"])
+
+
+def reset():
+    """Drop every table and reseed fin_history."""
+    with _tables_lock:
+        _tables.clear()
+    seed_fin_history()
+
+
+class FakeCursor:
+    def __init__(self):
+        self.description = None
+        self._result = []
+
+    def execute(self, query, params=None):
+        if LATENCY_SECONDS:
+            time.sleep(LATENCY_SECONDS)
+
+        statement = " ".join(query.split())
+        if statement.startswith("CREATE TABLE IF NOT EXISTS"):
+            self._create(statement)
+        elif statement.startswith("INSERT INTO"):
+            self._insert(statement, [params])
+        elif statement.startswith("SELECT * FROM"):
+            self._select(statement, params or ())
+        else:
+            raise psycopg2.ProgrammingError(f"Fake database does not support: {statement[:60]}")
+
+    def executemany(self, query, params_list):
+        if LATENCY_SECONDS:
+            time.sleep(LATENCY_SECONDS)
+        self._insert(" ".join(query.split()), params_list)
+
+    def _create(self, statement):
+        table_name = statement.split("CREATE TABLE IF NOT EXISTS ")[1].split("(")[0].strip()
+        body = statement[statement.index("(") + 1:statement.rindex(")")]
+        columns = [part.split()[0] for part in body.split("CONSTRAINT")[0].split(",") if part.strip()]
+        key = re.search(r"PRIMARY KEY \(([^)]*)\)", body)
+
+        with _tables_lock:
+            if table_name not in _tables:
+                _tables[table_name] = {
+                    "columns": columns,
+                    "key": [column.strip() for column in key.group(1).split(",")] if key else None,
+                    "rows": [],
+                }
+
+    def _insert(self, statement, params_list):
+        match = re.match(r"INSERT INTO (\w+) \(([^)]*)\)", statement)
+        table_name = match.group(1)
+        columns = [column.strip() for column in match.group(2).split(",")]
+
+        with _tables_lock:
+            if table_name not in _tables:
+                raise psycopg2.ProgrammingError(f'relation "{table_name}" does not exist')
+            table = _tables[table_name]
+            positions = [table["columns"].index(column) for column in columns]
+            key_positions = [table["columns"].index(column) for column in table["key"] or []]
+            index = {tuple(row[i] for i in key_positions): n for n, row in enumerate(table["rows"])} if key_positions else {}
+
+            for params in params_list:
+                row = [None] * len(table["columns"])
+                for position, value in zip(positions, params):
+                    row[position] = value
+                row = tuple(row)
+
+                key = tuple(row[i] for i in key_positions)
+                if key_positions and key in index:
+                    table["rows"][index[key]] = row  # ON CONFLICT ... DO UPDATE
+                else:
+                    index[key] = len(table["rows"])
+                    table["rows"].append(row)
+
+    def _select(self, statement, params):
+        match = re.match(r"SELECT \* FROM (\w+)(?: WHERE (.*))?$", statement)
+        table_name, where = match.group(1), match.group(2)
+
+        with _tables_lock:
+            if table_name not in _tables:
+                raise psycopg2.ProgrammingError(f'relation "{table_name}" does not exist')
+            table = _tables[table_name]
+            columns = table["columns"]
+            conditions = [(*condition.split()[:2], value) for condition, value in zip(where.split(" AND "), params)] if where else []
+
+            for column, operator, value in conditions:
+                if column not in columns:
+                    raise psycopg2.ProgrammingError(f'column "{column}" does not exist')
+                if table_name == "fin_history" and column == "applicant_id" and operator == "=":
+                    _ensure_applicant_history(table, value)
+            rows = list(table["rows"])
+
+        for column, operator, value in conditions:
+            position, compare = columns.index(column), _CONDITION_OPERATORS[operator]
+            rows = [row for row in rows if row[position] is not None and compare(row[position], value)]
+
+        self.description = [(column,) for column in columns]
+        self._result = rows
+
+    def fetchall(self):
+        return list(self._result)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def connect():
+    """Open a connection to the in-memory database (seeding fin_history on first use)."""
+    with _tables_lock:
+        seeded = "fin_history" in _tables
+    if not seeded:
+        seed_fin_history()
+
+    return FakeConnection()
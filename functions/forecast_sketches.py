@@ -0,0 +1,135 @@
+import os
+
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+from functions.database import retrieve_data_from_sql
+
+
+# Compact per-day distribution sketches of the forecast sample paths
+#
+# cwb_validation_forecasts keeps 14 fixed quantiles per day and the 1000 sample paths are
+# discarded, so a new quantile or probability question used to need a rerun. A sketch is
+# the sample distribution of one forecast day summarised on a fixed probability grid:
+# the values at quantiles 0, 1/(n-1), ..., 1 (the first and last are the sample minimum
+# and maximum), stored as n float32 values in a BYTEA column of
+# cwb_validation_forecast_sketches, one row per day. With the default 101 points a 30-day
+# forecast takes 12 KB instead of 120 KB of raw float32 samples.
+#
+# Any quantile is read back by linear interpolation along the grid, and the exceedance
+# probability P(balance > x) by inverting it; both are answered for all days at once
+# and are accurate to within half a grid step (0.5 percentage points by default).
+#
+# Configuration (environment variables):
+# CWB_SKETCH_SIZE   grid points per sketch (default 101)
+
+SKETCH_SIZE = int(os.environ.get("CWB_SKETCH_SIZE", "101"))
+SKETCH_TABLE_NAME = "cwb_validation_forecast_sketches"
+SKETCH_DTYPE = np.float32
+
+
+def get_sketch_grid(size=SKETCH_SIZE):
+    """Probabilities of the sketch points: 0, 1/(size-1), ..., 1."""
+    return np.linspace(0.0, 1.0, size)
+
+
+def build_sketches(sample_paths, size=SKETCH_SIZE):
+    """
+    Sketch of every forecast day.
+
+    Parameters:
+    sample_paths (np.ndarray): (num_samples, prediction_length) balances from get_sample_paths
+    size (int): Grid points per sketch
+
+    Returns:
+    np.ndarray: (prediction_length, size) float32, row d holds the grid quantiles of day d
+    """
+    return np.quantile(sample_paths, get_sketch_grid(size), axis=0).T.astype(SKETCH_DTYPE)
+
+
+def encode_sketch(sketch):
+    """Bytes of one day's sketch for the BYTEA column."""
+    return np.asarray(sketch, dtype=SKETCH_DTYPE).tobytes()
+
+
+def decode_sketches(blobs):
+    """(days, size) float32 sketches from the stored bytes (memoryview or bytes per day)."""
+    return np.stack([np.frombuffer(bytes(blob), dtype=SKETCH_DTYPE) for blob in blobs])
+
+
+def get_sketch_data_frame(sample_paths, forecast_dates, size=SKETCH_SIZE):
+    """Rows for cwb_validation_forecast_sketches: date, sketch_size and the encoded sketch per day."""
+    sketches = build_sketches(sample_paths, size)
+    return pd.DataFrame({
+        'date': pd.to_datetime(pd.Series(forecast_dates)).dt.date,
+        'sketch_size': np.full(len(sketches), sketches.shape[1], dtype=np.int64),
+        'sketch': [encode_sketch(sketch) for sketch in sketches],
+    })
+
+
+def sketch_quantiles(sketches, quantiles):
+    """
+    Quantiles of every day from its sketch.
+
+    Returns:
+    np.ndarray: (days, len(quantiles)) balances
+    """
+    quantiles = np.clip(np.asarray(quantiles, dtype=float), 0.0, 1.0)
+    grid = get_sketch_grid(sketches.shape[1])
+
+    # Position of each quantile on the grid, then interpolate between neighbouring points of all days at once
+    position = quantiles * (len(grid) - 1)
+    lower = np.minimum(np.floor(position).astype(int), len(grid) - 2)
+    weight = position - lower
+    sketches = sketches.astype(float)
+    return sketches[:, lower] * (1 - weight) + sketches[:, lower + 1] * weight
+
+
+def sketch_exceedance_probabilities(sketches, thresholds):
+    """
+    P(balance > threshold) of every day from its sketch.
+
+    Returns:
+    np.ndarray: (days, len(thresholds)) probabilities
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    grid = get_sketch_grid(sketches.shape[1])
+
+    # The sketch is the inverse CDF, so the CDF at x is the grid probability interpolated at x
+    return np.stack([1.0 - np.interp(thresholds, sketch, grid, left=0.0, right=1.0) for sketch in sketches.astype(float)])
+
+
+def get_forecast_sketches(applicant_id):
+    """
+    Stored sketches of the applicant's latest forecast.
+
+    Returns:
+    tuple: (dates, (days, size) sketches), or (None, None) when nothing is stored
+    """
+    rows = retrieve_data_from_sql(SKETCH_TABLE_NAME, applicant_id=applicant_id)
+    if rows is None or len(rows) == 0:
+        return None, None
+
+    rows = rows.sort_values('sn')
+    return pd.to_datetime(rows['date']).dt.strftime('%Y-%m-%d').tolist(), decode_sketches(rows['sketch'])
+
+
+def query_quantiles(applicant_id, quantiles):
+    """Arbitrary quantiles of the applicant's stored forecast, one row per day (None if not stored)."""
+    dates, sketches = get_forecast_sketches(applicant_id)
+    if sketches is None:
+        return None
+
+    return pd.DataFrame(sketch_quantiles(sketches, quantiles), index=pd.Index(dates, name='date'),
+                        columns=[f'q{quantile:g}' for quantile in quantiles])
+
+
+def query_exceedance_probabilities(applicant_id, thresholds):
+    """P(balance > threshold) of the applicant's stored forecast, one row per day (None if not stored)."""
+    dates, sketches = get_forecast_sketches(applicant_id)
+    if sketches is None:
+        return None
+
+    return pd.DataFrame(sketch_exceedance_probabilities(sketches, thresholds), index=pd.Index(dates, name='date'),
+                        columns=[f'p_above_{threshold:g}' for threshold in thresholds])
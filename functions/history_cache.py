@@ -0,0 +1,294 @@
+import os
+import json
+import fcntl
+import hashlib
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+from functions.database import retrieve_data_from_sql
+
+
+# Read-through local cache of fin_history
+#
+# Past balances never change, so each applicant's history is kept on local disk as one
+# typed column file per column (date as datetime64[ns], balance and engineered features as
+# their numeric dtypes) plus a meta.json with the dtypes, the row count and the high-water
+# mark (latest cached date). A request reads meta.json, fetches only the rows after the
+# high-water mark from fin_history, appends them to the column files and returns the whole
+# history as a DataFrame over read-only memory maps of the files - no copy is made on the
+# way to prep_data_for_deep_ar_model.
+#
+# Appends are crash safe: column bytes are written and fsynced before meta.json is
+# atomically replaced, and readers only map the rows meta.json counts. A file lock
+# serialises writers across worker processes. If a delta no longer fits the cached schema
+# (new column, wider strings, dtype change) the history is reloaded in full into a new
+# generation of files.
+#
+# Each history lives in a subdirectory named by a blake2b digest of the applicant id, so
+# ids never become path components and cannot reach outside the cache directory.
+#
+# Configuration (environment variables):
+# CWB_HISTORY_CACHE               1 to read fin_history through the cache (default 0)
+# CWB_HISTORY_CACHE_DIR           cache directory (default cwb_history_cache in the temp directory)
+# CWB_FIN_HISTORY_BY_APPLICANT    1 if fin_history has an applicant_id column to filter on (default 0,
+#                                 the table then holds a single shared history)
+
+ENABLED = os.environ.get("CWB_HISTORY_CACHE", "0") == "1"
+CACHE_DIR = os.environ.get("CWB_HISTORY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "cwb_history_cache"))
+BY_APPLICANT = os.environ.get("CWB_FIN_HISTORY_BY_APPLICANT", "0") == "1"
+
+DATE_COLUMN = "date"
+SHARED_HISTORY_KEY = "_all"
+MIN_STRING_WIDTH = 64
+
+_history_cache = None
+_history_cache_lock = threading.Lock()
+
+
+class SchemaMismatch(Exception):
+    """New rows do not fit the cached column dtypes; the history has to be reloaded."""
+
+
+def to_column_array(series):
+    """Typed NumPy array for a column as fetched from the database (dates, numbers, bools or strings)."""
+    if series.name == DATE_COLUMN or pd.api.types.is_datetime64_any_dtype(series):
+        dates = pd.to_datetime(series)
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_convert("UTC").dt.tz_localize(None)
+        return dates.values.astype("datetime64[ns]")
+
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return series.values
+
+    try:
+        return pd.to_numeric(series).values  # NUMERIC columns arrive as Decimal objects
+    except (TypeError, ValueError):
+        strings = series.astype(str).values
+        width = max(MIN_STRING_WIDTH, max((len(value) for value in strings), default=0))
+        return strings.astype(f"<U{width}")
+
+
+class HistoryCache:
+    """
+    Memory-mapped columnar cache of one table's history per applicant.
+
+    Parameters:
+    cache_dir (str): Directory holding one subdirectory per cached history
+    table_name (str): Table the history is read from
+    by_applicant (bool): Filter the table by applicant_id (see CWB_FIN_HISTORY_BY_APPLICANT)
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, table_name="fin_history", by_applicant=BY_APPLICANT):
+        self.cache_dir = cache_dir
+        self.table_name = table_name
+        self.by_applicant = by_applicant
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "full_loads": 0, "delta_queries": 0, "rows_fetched": 0, "rows_served": 0}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _count(self, stat, amount=1):
+        with self._stats_lock:
+            self._stats[stat] += amount
+
+    def _key(self, applicant_id):
+        """One cached history per applicant when filtering by applicant, otherwise one shared history."""
+        if not self.by_applicant or applicant_id is None:
+            return SHARED_HISTORY_KEY
+        return hashlib.blake2b(str(applicant_id).encode(), digest_size=16).hexdigest()
+
+    def _directory(self, key):
+        cache_dir = os.path.realpath(self.cache_dir)
+        directory = os.path.realpath(os.path.join(cache_dir, key))
+        if os.path.dirname(directory) != cache_dir:
+            raise ValueError(f"History cache key {key!r} resolves outside {cache_dir}")
+        return directory
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self._directory(key), "meta.json")) as meta_file:
+                return json.load(meta_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_meta(self, key, meta):
+        directory = self._directory(key)
+        temporary_path = os.path.join(directory, "meta.json.tmp")
+        with open(temporary_path, "w") as meta_file:
+            json.dump(meta, meta_file)
+            meta_file.flush()
+            os.fsync(meta_file.fileno())
+        os.replace(temporary_path, os.path.join(directory, "meta.json"))
+
+    def _column_path(self, key, meta, column):
+        return os.path.join(self._directory(key), f"{column}.{meta['generation']}.bin")
+
+    def _fetch(self, applicant_id, after_date=None):
+        applicant_filter = applicant_id if self.by_applicant else None
+        delta = retrieve_data_from_sql(self.table_name, applicant_id=applicant_filter, after_date=after_date)
+        if delta is None:
+            raise ConnectionError(f"Could not read {self.table_name} from the database")
+
+        self._count("rows_fetched", len(delta))
+        return delta.sort_values(DATE_COLUMN, kind="mergesort") if len(delta) else delta
+
+    def _append(self, key, meta, delta):
+        """Append delta's rows to the column files, then commit them by replacing meta.json."""
+        if list(delta.columns) != meta["columns"]:
+            raise SchemaMismatch(f"columns changed: {list(delta.columns)}")
+
+        arrays = {}
+        for column in meta["columns"]:
+            array, dtype = to_column_array(delta[column]), np.dtype(meta["dtypes"][column])
+            if not np.can_cast(array.dtype, dtype, casting="safe"):
+                raise SchemaMismatch(f"{column}: {array.dtype} does not fit cached {dtype}")
+            arrays[column] = np.ascontiguousarray(array, dtype=dtype)
+
+        for column, array in arrays.items():
+            with open(self._column_path(key, meta, column), "r+b") as column_file:
+                column_file.truncate(meta["rows"] * array.dtype.itemsize)  # drop bytes of an interrupted append
+                column_file.seek(0, os.SEEK_END)
+                column_file.write(array.tobytes())
+                column_file.flush()
+                os.fsync(column_file.fileno())
+
+        meta = {**meta, "rows": meta["rows"] + len(delta), "high_water_mark": str(arrays[DATE_COLUMN][-1])}
+        self._write_meta(key, meta)
+        return meta
+
+    def _rebuild(self, key, previous_meta, history):
+        """Write a complete history into a new generation of column files."""
+        arrays = {column: np.ascontiguousarray(to_column_array(history[column])) for column in history.columns}
+        meta = {
+            "generation": (previous_meta or {}).get("generation", 0) + 1,
+            "table_name": self.table_name,
+            "columns": list(history.columns),
+            "dtypes": {column: array.dtype.str for column, array in arrays.items()},
+            "rows": len(history),
+            "high_water_mark": str(arrays[DATE_COLUMN][-1]),
+        }
+
+        for column, array in arrays.items():
+            with open(self._column_path(key, meta, column), "wb") as column_file:
+                column_file.write(array.tobytes())
+                column_file.flush()
+                os.fsync(column_file.fileno())
+        self._write_meta(key, meta)
+
+        # Files of the old generation can go; open memory maps stay valid until they are closed
+        if previous_meta is not None:
+            for column in previous_meta["columns"]:
+                try:
+                    os.remove(self._column_path(key, previous_meta, column))
+                except FileNotFoundError:
+                    pass
+
+        self._count("full_loads")
+        return meta
+
+    def _map(self, key, meta):
+        """The cached history as a DataFrame over read-only memory maps (no copy)."""
+        columns = {}
+        for column in meta["columns"]:
+            dtype = np.dtype(meta["dtypes"][column])
+            if meta["rows"] == 0:
+                columns[column] = np.empty(0, dtype=dtype)
+            else:
+                columns[column] = np.memmap(self._column_path(key, meta, column), dtype=dtype, mode="r", shape=(meta["rows"],))
+        return pd.DataFrame(columns, copy=False)
+
+    def refresh(self, applicant_id=None):
+        """Bring the cached history up to date with one delta query and return its meta."""
+        key = self._key(applicant_id)
+        meta = self._read_meta(key)
+
+        # Fetch outside the lock, a concurrent writer may have appended some of the rows already
+        after_date = meta["high_water_mark"] if meta is not None else None
+        delta = self._fetch(applicant_id, after_date)
+        if after_date is not None:
+            self._count("delta_queries")
+
+        if meta is not None and len(delta) == 0:
+            return key, meta
+
+        os.makedirs(self._directory(key), exist_ok=True)
+        with open(os.path.join(self._directory(key), "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            meta = self._read_meta(key)
+            if meta is None:
+                if len(delta) == 0 or after_date is not None:
+                    delta = self._fetch(applicant_id)
+                if len(delta) == 0:
+                    return key, None
+                return key, self._rebuild(key, None, delta)
+
+            delta = delta[to_column_array(delta[DATE_COLUMN]) > np.datetime64(meta["high_water_mark"])] if len(delta) else delta
+            if len(delta) == 0:
+                return key, meta
+
+            try:
+                return key, self._append(key, meta, delta)
+            except SchemaMismatch as mismatch:
+                print(f"History cache {key}: {mismatch}, reloading the full history")
+                return key, self._rebuild(key, meta, self._fetch(applicant_id))
+
+    def get(self, applicant_id=None):
+        """
+        Applicant history with rows newer than the cache fetched from the database.
+
+        Returns:
+        DataFrame: Read-only, memory-mapped history sorted by date
+        """
+        key, meta = self.refresh(applicant_id)
+        self._count("requests")
+        if meta is None:
+            return self._fetch(applicant_id)  # nothing to cache yet
+
+        history = self._map(key, meta)
+        self._count("rows_served", len(history))
+        return history
+
+    def clear(self, applicant_id=None):
+        """Remove one cached history, or all of them when applicant_id is None."""
+        if applicant_id is None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        else:
+            shutil.rmtree(self._directory(self._key(applicant_id)), ignore_errors=True)
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+def get_history_cache():
+    """
+    Return the process-wide history cache, creating it on first use.
+    Returns None when CWB_HISTORY_CACHE is not enabled.
+    """
+    global _history_cache
+
+    if not ENABLED:
+        return None
+
+    with _history_cache_lock:
+        if _history_cache is None:
+            _history_cache = HistoryCache()
+
+    return _history_cache
+
+
+def retrieve_history(applicant_id=None):
+    """fin_history for an applicant, through the local cache when it is enabled."""
+    history_cache = get_history_cache()
+    if history_cache is not None:
+        return history_cache.get(applicant_id)
+
+    return retrieve_data_from_sql("fin_history", applicant_id=applicant_id if BY_APPLICANT else None)
@@ -0,0 +1,226 @@
+import os
+import math
+import random
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+from gluonts.dataset.common import ListDataset
+
+from functions.database import (
+    get_column_name_and_datatype_dictionary,
+    prepare_sql_queries_and_values,
+    insert_data_into_sql_data_base,
+    add_metadata_columns,
+)
+from functions.machinelearning import (
+    DEFAULT_HYPERPARAMETERS,
+    limit_torch_threads,
+    prep_data_for_deep_ar_model,
+    create_model_and_train,
+    generate_forecasts,
+)
+from functions.ml_evaluation import (
+    compute_forecast_metrics,
+    get_hyperparameters_from_dict,
+)
+from functions.backtesting import (
+    PREDICTION_LENGTH,
+    prep_backtest_windows,
+)
+
+
+# Parallel hyperparameter sweep with successive halving
+#
+# Every trial trains on all but the last 30 days and is scored on those 30 held-out
+# days by mean pinball loss across the forecast quantiles. Trials run in a process
+# pool, each worker limited to threads_per_trial torch threads. After every rung
+# the best 1/eta of the configurations survive and are retrained with eta times
+# more epochs.
+
+# Estimator settings reported under model_kwargs, matching the lightning hparams.yaml layout
+MODEL_KWARGS = ["prediction_length", "context_length", "num_layers", "hidden_size", "dropout_rate"]
+
+cwb_validation_assessment_table_name = 'cwb_validation_assessment'
+
+
+def sample_configurations(search_space, num_trials=None, seed=0):
+    """
+    Expand a search space {name: [values]} into a list of hyperparameter dictionaries.
+    Returns the full grid, or num_trials configurations drawn from it without replacement.
+    """
+    names = list(search_space.keys())
+    grid = [dict(zip(names, values)) for values in itertools.product(*search_space.values())]
+
+    if num_trials is not None and num_trials < len(grid):
+        grid = random.Random(seed).sample(grid, num_trials)
+
+    return grid
+
+
+def get_successive_halving_rungs(num_configurations, min_epochs=1, max_epochs=10, eta=3):
+    """
+    Return [(configurations_kept, epochs)] for each rung, starting with all configurations
+    at min_epochs and keeping ceil(n / eta) with eta times the epochs until one is left
+    or max_epochs is reached.
+    """
+    rungs = []
+    kept, epochs = num_configurations, min_epochs
+
+    while True:
+        rungs.append((kept, min(epochs, max_epochs)))
+        if kept == 1 or epochs >= max_epochs:
+            return rungs
+        kept, epochs = max(1, math.ceil(kept / eta)), epochs * eta
+
+
+def get_trial_hparams(hyperparameters):
+    """Nest a flat trial configuration the way lightning writes hparams.yaml."""
+    hparams = {"model_kwargs": {}}
+    for key, value in hyperparameters.items():
+        if key in MODEL_KWARGS:
+            hparams["model_kwargs"][key] = value
+        else:
+            hparams[key] = value
+
+    return hparams
+
+
+def _init_trial_worker(num_threads):
+    limit_torch_threads(num_threads)
+
+
+def run_trial(data, hyperparameters):
+    """
+    Train one configuration and return its validation loss on the last 30 days.
+    """
+    train_data = data.iloc[:len(data) - PREDICTION_LENGTH]
+    training_data, scaler = prep_data_for_deep_ar_model(train_data)
+    predictor = create_model_and_train(training_data, hyperparameters)
+
+    # Forecast the held-out days from the full history, scaled like the training data
+    cutoff = np.array([len(data) - PREDICTION_LENGTH])
+    validation_window = prep_backtest_windows(data, cutoff, scaler, train_data['rolling_7d_std'].max())
+    forecasts, _ = generate_forecasts(predictor, ListDataset(validation_window, freq="D"))
+
+    samples = forecasts[0].samples
+    samples = scaler.inverse_transform(samples.reshape(-1, 1)).reshape(samples.shape)
+    quantile_levels = np.linspace(0.05, 0.95, 19)
+    quantile_forecasts = np.quantile(samples, quantile_levels, axis=0)
+
+    actuals = data['balance'].values[-PREDICTION_LENGTH:]
+    metrics = compute_forecast_metrics(quantile_forecasts, actuals, quantiles=list(quantile_levels), horizons=[PREDICTION_LENGTH])
+
+    return float(metrics['pinball'].mean())
+
+
+def run_hyperparameter_sweep(data, search_space, num_trials=None, min_epochs=1, max_epochs=10, eta=3,
+                             threads_per_trial=1, max_workers=None, sweep_id=None, write_to_database=True, seed=0):
+    """
+    Tune the DeepAR estimator on one history with successive halving across a process pool.
+
+    Parameters:
+    data (DataFrame): History as returned from fin_history (last 30 days are held out)
+    search_space (dict): {hyperparameter: [values]} using DEFAULT_HYPERPARAMETERS names (not prediction_length)
+    num_trials (int): Number of configurations sampled from the grid (all if None)
+    min_epochs, max_epochs, eta (int): Successive halving schedule
+    threads_per_trial (int): Torch threads per trial
+    max_workers (int): Concurrent trials (defaults to cpu_count // threads_per_trial)
+    sweep_id (str): Stored as applicant_id in cwb_validation_assessment
+    write_to_database (bool): Write the results to cwb_validation_assessment
+
+    Returns:
+    DataFrame: One row per trial and rung with the configuration, epochs and validation loss
+    """
+    unknown = set(search_space) - set(DEFAULT_HYPERPARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown hyperparameters in search space: {sorted(unknown)}")
+    if "max_epochs" in search_space:
+        raise ValueError("max_epochs is set by the successive halving schedule, use min_epochs/max_epochs")
+    if "prediction_length" in search_space:
+        raise ValueError(f"prediction_length is fixed at {PREDICTION_LENGTH} by the held-out validation window")
+
+    data = data.reset_index(drop=True)
+    configurations = sample_configurations(search_space, num_trials, seed)
+    rungs = get_successive_halving_rungs(len(configurations), min_epochs, max_epochs, eta)
+
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) // threads_per_trial)
+    if sweep_id is None:
+        sweep_id = f"sweep_{pd.Timestamp.now():%Y%m%d%H%M%S}"
+
+    results = []
+    survivors = list(range(len(configurations)))
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_trial_worker,
+        initargs=(threads_per_trial,),
+    ) as executor:
+        for rung, (_, epochs) in enumerate(rungs):
+            print(f"Sweep {sweep_id} rung {rung}: {len(survivors)} configurations x {epochs} epochs")
+
+            futures = {
+                trial: executor.submit(run_trial, data, {**configurations[trial], "max_epochs": epochs})
+                for trial in survivors
+            }
+            losses = {trial: future.result() for trial, future in futures.items()}
+
+            for trial, loss in losses.items():
+                results.append({"trial": trial, "rung": rung, "max_epochs": epochs,
+                                "val_loss": loss, **configurations[trial]})
+
+            # Keep the best 1/eta for the next rung
+            if rung + 1 < len(rungs):
+                survivors = sorted(survivors, key=losses.get)[:rungs[rung + 1][0]]
+
+    results_df = pd.DataFrame(results)
+    best = results_df[results_df["rung"] == results_df["rung"].max()].sort_values("val_loss").to_dict("records")[0]
+    print(f"Best configuration: trial {best['trial']} with validation loss {best['val_loss']:.4f}")
+
+    if write_to_database:
+        write_sweep_results(results_df, sweep_id)
+
+    return results_df
+
+
+def get_sweep_assessment(results_df, sweep_id):
+    """
+    Hyperparameter rows for every trial in the get_hyperparameters format, followed by
+    a Validation category holding each trial's rung, epochs and loss.
+    """
+    frames = []
+    final_rung = results_df["rung"].max()
+
+    for trial, trial_results in results_df.groupby("trial"):
+        last = trial_results.sort_values("rung").to_dict("records")[-1]
+        experiment_id = f"{sweep_id}_trial_{trial}"
+
+        hyperparameters = {**DEFAULT_HYPERPARAMETERS, **{
+            key: last[key] for key in DEFAULT_HYPERPARAMETERS if key in last
+        }}
+        hyperparameters["max_epochs"] = last["max_epochs"]
+        frames.append(get_hyperparameters_from_dict(get_trial_hparams(hyperparameters), experiment_id))
+
+        validation = {
+            "val_loss": last["val_loss"],
+            "rung": last["rung"],
+            "pruned": bool(last["rung"] < final_rung),
+        }
+        frames.append(get_hyperparameters_from_dict(validation, experiment_id, category="Validation"))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_sweep_results(results_df, sweep_id):
+    """Write the sweep results to cwb_validation_assessment under applicant_id = sweep_id."""
+    sweep_assessment_df = add_metadata_columns(get_sweep_assessment(results_df, sweep_id), applicant_id=sweep_id)
+
+    sweep_dict = get_column_name_and_datatype_dictionary(sweep_assessment_df)
+    sweep_sql_queries_and_values = prepare_sql_queries_and_values(sweep_dict, cwb_validation_assessment_table_name, sweep_assessment_df)
+    insert_data_into_sql_data_base(*sweep_sql_queries_and_values)
@@ -2,8 +2,17 @@ from gluonts.dataset.common import ListDataset
 from gluonts.torch.model.deepar import DeepAREstimator
 from gluonts.evaluation.backtest import make_evaluation_predictions
 from gluonts.evaluation import Evaluator
+from gluonts.env import env as gluonts_env
 
+import os
+import uuid
 import warnings
+from collections import deque
+
+import torch
+import lightning.pytorch as pl
+from lightning.pytorch.loggers import Logger
+from lightning.pytorch.utilities import rank_zero_only
 from sklearn.preprocessing import RobustScaler
 
 import pandas as pd
@@ -11,21 +20,55 @@ import numpy as np
 np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
 
 
+# Quantiles reported for every forecast (column names are p1, p5, ... p99)
+QUANTILES = [0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.92, 0.95, 0.99]
+QUANTILE_NAMES = [f'p{int(q*100)}' for q in QUANTILES]
 
 
-def prep_data_for_deep_ar_model(model_data):
-    # Prepare dynamic features
-    dynamic_features = [
+def get_dynamic_features(model_data, volatility_max=None):
+    """
+    Build the DeepAR dynamic feature arrays from the engineered columns.
+
+    volatility_max is the value used to normalise rolling_7d_std. It defaults to
+    the maximum of model_data, pass the training value when building features
+    for windows that extend past the training data.
+    """
+    if volatility_max is None:
+        volatility_max = model_data['rolling_7d_std'].max()
+
+    return [
         model_data['day_of_month'].values / 31.0,  # Normalize to [0,1]
         model_data['day_of_week'].values / 6.0,    # Normalize to [0,1]
         model_data['is_weekend'].values,
-        model_data['rolling_7d_std'].values / model_data['rolling_7d_std'].max(),  # Normalize volatility
+        model_data['rolling_7d_std'].values / volatility_max,  # Normalize volatility
         model_data['is_salary_day'].values,
         model_data['is_rent_day'].values,
         model_data['is_major_expense'].values,
         model_data['trend_7d'].values
     ]
 
+
+def limit_torch_threads(num_threads):
+    """
+    Cap the threads torch (and the BLAS/OpenMP libraries under it) may use in this process.
+    Used by worker processes so that parallel jobs don't oversubscribe the machine's cores.
+    """
+    num_threads = max(1, int(num_threads))
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(num_threads)
+
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:
+        # Inter-op threads can only be set once, before any parallel work has run
+        pass
+
+
+def prep_data_for_deep_ar_model(model_data):
+    # Prepare dynamic features
+    dynamic_features = get_dynamic_features(model_data)
+
     # After generating data but before preparing for DeepAR
 
     # Step 2.1: Scale the target variable
@@ -50,32 +93,201 @@ def prep_data_for_deep_ar_model(model_data):
 
 # Step 3: Configure and train DeepAR model
 
-def create_model_and_train(data_gluonts_fmt):
+# Tunable DeepAR settings - override any of them per call with create_model_and_train(..., hyperparameters)
+DEFAULT_HYPERPARAMETERS = {
+    "prediction_length": 30,  # Forecast one month ahead
+    "context_length": 60,     # Use 3 months of history
+    "num_layers": 1,
+    "hidden_size": 40,
+    "dropout_rate": 0.1,
+    "lr": 1e-3,
+    "batch_size": 16,
+    "num_batches_per_epoch": 12,
+    "max_epochs": 10,
+}
+
+# Hyperparameters that belong to the Lightning trainer rather than the estimator
+TRAINER_HYPERPARAMETERS = ["max_epochs"]
+
+# Disk-free training (CWB_DISK_FREE_TRAINING=1): no lightning_logs/version_N directory,
+# checkpoint or metrics.csv per model; the best weights, metrics and hyperparameters are
+# kept in memory and returned as a training record. CWB_TRAINING_METRICS_MAX bounds the
+# metric rows kept per run, RECENT_TRAINING_RECORDS the records kept per process.
+DISK_FREE_TRAINING = os.environ.get("CWB_DISK_FREE_TRAINING", "0") == "1"
+MAX_METRIC_RECORDS = int(os.environ.get("CWB_TRAINING_METRICS_MAX", "10000"))
+RECENT_TRAINING_RECORDS = 20
+
+_recent_training_records = deque(maxlen=RECENT_TRAINING_RECORDS)
+
+
+def create_estimator(hyperparameters=None):
     
+    params = {**DEFAULT_HYPERPARAMETERS, **(hyperparameters or {})}
+    trainer_kwargs = {key: params.pop(key) for key in TRAINER_HYPERPARAMETERS}
+
     # Configure the DeepAR model
     estimator = DeepAREstimator(
         freq="D",
-        prediction_length=30,  # Forecast one month ahead
-        context_length=60,     # Use 3 months of history
-        num_layers=1,
-        hidden_size=40,
-        dropout_rate=0.1,
         num_feat_dynamic_real=8,  # Number of dynamic features in your dataset
         scaling=False,
         num_parallel_samples=100,
-        batch_size=16,
-        num_batches_per_epoch=12,
-        trainer_kwargs={
-            "max_epochs": 10,
-            # "learning_rate": 1e-3,
-        }
+        trainer_kwargs=trainer_kwargs,
+        **params
     )
 
-    # Train the model
+    return estimator
+
+
+def create_model_and_train(data_gluonts_fmt, hyperparameters=None):
+    
+    # Configure the DeepAR model
+    estimator = create_estimator(hyperparameters)
+
+    # Train the model (without writing lightning_logs when disk-free training is enabled)
+    if DISK_FREE_TRAINING:
+        predictor, _ = train_model_in_memory(data_gluonts_fmt, hyperparameters)
+        return predictor
+
     predictor = estimator.train(data_gluonts_fmt)
 
     return predictor
 
+
+class InMemoryLogger(Logger):
+    """Lightning logger that keeps hyperparameters and a bounded list of metric rows in memory."""
+
+    def __init__(self, max_records=MAX_METRIC_RECORDS):
+        super().__init__()
+        self._version = uuid.uuid4().hex[:12]
+        self.hyperparameters = {}
+        self.metrics = deque(maxlen=max_records)
+
+    @property
+    def name(self):
+        return "in_memory"
+
+    @property
+    def version(self):
+        return self._version
+
+    @rank_zero_only
+    def log_hyperparams(self, params, *args, **kwargs):
+        self.hyperparameters = dict(vars(params) if hasattr(params, "__dict__") and not isinstance(params, dict) else params)
+
+    @rank_zero_only
+    def log_metrics(self, metrics, step=None):
+        self.metrics.append({"step": step, **{name: float(value) for name, value in metrics.items()}})
+
+
+class InMemoryCheckpoint(pl.callbacks.Checkpoint):
+    """
+    Keeps a copy of the weights with the lowest monitored loss, like the ModelCheckpoint
+    GluonTS adds, but in memory. Being the trainer's checkpoint callback it also stops
+    Lightning from adding its default ModelCheckpoint.
+    """
+
+    def __init__(self, monitor="train_loss"):
+        self.monitor = monitor
+        self.best_score = None
+        self.best_epoch = None
+        self.best_state = None
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        score = trainer.callback_metrics.get(self.monitor)
+        if score is None:
+            return
+
+        score = float(score)
+        if self.best_score is None or score < self.best_score:
+            self.best_score, self.best_epoch = score, trainer.current_epoch
+            self.best_state = {name: tensor.detach().clone() for name, tensor in pl_module.state_dict().items()}
+
+
+def train_model_in_memory(data_gluonts_fmt, hyperparameters=None):
+    """
+    Train like DeepAREstimator.train, but with the checkpoint, metrics and hyperparameters
+    held in memory instead of under lightning_logs.
+
+    Returns:
+    tuple: (predictor, training record) where the record holds the run's version id,
+           hyperparameters, per-epoch loss curve, best epoch and raw metric rows
+    """
+    estimator = create_estimator(hyperparameters)
+    transformation = estimator.create_transformation()
+
+    with gluonts_env._let(max_idle_transforms=max(len(data_gluonts_fmt), 100)):
+        transformed_data = transformation.apply(data_gluonts_fmt, is_train=True)
+        training_network = estimator.create_lightning_module()
+        training_data_loader = estimator.create_training_data_loader(transformed_data, training_network)
+
+    checkpoint = InMemoryCheckpoint()
+    logger = InMemoryLogger()
+    trainer = pl.Trainer(**{
+        "accelerator": "auto",
+        "callbacks": [checkpoint],
+        "logger": logger,
+        **estimator.trainer_kwargs,
+    })
+    trainer.fit(model=training_network, train_dataloaders=training_data_loader)
+
+    if checkpoint.best_state is not None:
+        training_network.load_state_dict(checkpoint.best_state)
+
+    training_record = {
+        "version": logger.version,
+        "hyperparameters": logger.hyperparameters,
+        "loss_curve": [
+            {"epoch": int(row["epoch"]), "train_loss": row["train_loss"]}
+            for row in logger.metrics if "train_loss" in row and "epoch" in row
+        ],
+        "best_epoch": checkpoint.best_epoch,
+        "best_train_loss": checkpoint.best_score,
+        "metrics": list(logger.metrics),
+    }
+    _recent_training_records.append(training_record)
+
+    return estimator.create_predictor(transformation, training_network), training_record
+
+
+def get_recent_training_records():
+    """Training records of the most recent disk-free runs in this process, oldest first."""
+    return list(_recent_training_records)
+
+
+def make_dummy_history(num_days=120):
+    """Synthetic history with the fin_history columns, used to warm up the ML stack."""
+    dates = pd.date_range("2024-01-01", periods=num_days, freq="D")
+    days = np.arange(num_days)
+
+    return pd.DataFrame({
+        'date': dates,
+        'balance': 1000.0 + 100.0 * np.sin(days / 7.0),
+        'day_of_month': dates.day,
+        'day_of_week': dates.dayofweek,
+        'is_weekend': (dates.dayofweek >= 5).astype(int),
+        'rolling_7d_std': 50.0 + 10.0 * np.cos(days / 7.0),
+        'is_salary_day': (dates.day == 25).astype(int),
+        'is_rent_day': (dates.day == 1).astype(int),
+        'is_major_expense': np.zeros(num_days, dtype=int),
+        'trend_7d': np.zeros(num_days),
+    })
+
+
+def warm_up_forecast():
+    """
+    Run one forecast through an untrained DeepAR network so imports, torch kernels and
+    the GluonTS transformation chain are initialised before the first real request.
+    Nothing is trained and nothing is written to lightning_logs.
+    """
+    training_data, _ = prep_data_for_deep_ar_model(make_dummy_history())
+
+    estimator = create_estimator()
+    transformation = estimator.create_transformation()
+    predictor = estimator.create_predictor(transformation, estimator.create_lightning_module())
+
+    generate_forecasts(predictor, training_data)
+
+
 # Step 4.1: Generate forecasts
 # Step 4.1: Generate forecasts
 
@@ -99,7 +311,7 @@ def inverse_transform_forecasts(forecast, scaler):
     result = {}
     
     # Transform common quantiles
-    for q in [0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.92, 0.95, 0.99]:
+    for q, name in zip(QUANTILES, QUANTILE_NAMES):
         try: 
             # Get the forecast for this quantile
             forecast_values = forecast.quantile(q)
@@ -109,13 +321,24 @@ def inverse_transform_forecasts(forecast, scaler):
             original_values = scaler.inverse_transform(forecast_values.reshape(-1, 1)).flatten()
             
             # Store the transformed values
-            result[f'p{int(q*100)}'] = original_values
+            result[name] = original_values
         except Exception as e:
             print(f"Warning: Could not transform quantile {q}: {str(e)}")
     
     return result
 
 
+def get_sample_paths(forecast, scaler):
+    """
+    All forecast sample paths in the original scale.
+
+    Returns:
+    np.ndarray: (num_samples, prediction_length) balances, one row per sample path
+    """
+    samples = forecast.samples
+    return scaler.inverse_transform(samples.reshape(-1, 1)).reshape(samples.shape)
+
+
 
 def get_forecast_data_frames (transformed_forecast_values, original_data_frame):
   
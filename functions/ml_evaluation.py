@@ -7,6 +7,8 @@ np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-a
 from gluonts.evaluation.backtest import make_evaluation_predictions
 from gluonts.evaluation import Evaluator
 
+from functions.machinelearning import QUANTILES, QUANTILE_NAMES
+
 
 
 # Run evaluation on the scaled forecasts
@@ -62,22 +64,12 @@ def calculate_rmse(df, target_col='actual'):
     """
 
 
-    rmse_values = {}
-    
     # Get all columns except date and target
     pred_columns = [col for col in df.columns if col != 'date' and col != target_col]
     
-    for col in pred_columns:
-        # Calculate squared differences
-        squared_diff = (df[col] - df[target_col]) ** 2
-        
-        # Calculate mean of squared differences
-        mean_squared_diff = squared_diff.mean()
-        
-        # Calculate root of mean squared differences
-        rmse = np.sqrt(mean_squared_diff)
-        
-        rmse_values[col] = rmse
+    # Squared differences for all columns at once, then root of the column means
+    squared_diff = df[pred_columns].sub(df[target_col], axis=0) ** 2
+    rmse_values = np.sqrt(squared_diff.mean()).to_dict()
     
     return rmse_values
 
@@ -98,6 +90,103 @@ def get_combined_rmse (forecast_7days, forecast_14days, forecast_30days):
     return combined_rmse
 
 
+# Vectorized forecast metrics for every quantile and horizon cut
+
+FORECAST_HORIZONS = [7, 14, 30]
+FORECAST_HORIZON_NAMES = ['seven_day_forecast', 'fourteen_day_forecast', 'thirty_day_forecast']
+
+
+def compute_forecast_metrics(forecasts, actuals, quantiles=QUANTILES, horizons=FORECAST_HORIZONS):
+    """
+    Compute RMSE, MAE, pinball loss and interval coverage for every horizon cut at once.
+
+    Each metric is a running mean over the forecast days, so all horizon cuts are read
+    off a single cumulative sum instead of re-slicing the forecast for 7/14/30 days.
+
+    Parameters:
+    forecasts (ndarray): Quantile forecasts shaped (..., quantiles, days), e.g. (14, 30)
+        for one applicant or (applicants, 14, 30) for a stacked batch
+    actuals (ndarray): Actual balances shaped (..., days)
+    quantiles (list): Quantile level of each forecast row
+    horizons (list): Number of leading days in each horizon cut
+
+    Returns:
+    dict: 'rmse', 'mae' and 'pinball' shaped (..., quantiles, horizons),
+          'coverage' shaped (..., intervals, horizons) and the matching
+          'intervals' list of (lower, upper) quantile pairs
+    """
+    forecasts = np.asarray(forecasts, dtype=np.float64)
+    actuals = np.asarray(actuals, dtype=np.float64)
+    levels = np.asarray(quantiles, dtype=np.float64)[:, None]
+    cuts = np.asarray(horizons)
+
+    # Symmetric prediction intervals available in the quantile set, e.g. (0.1, 0.9)
+    lower_idx = [i for i, q in enumerate(quantiles) if q < 0.5 and np.isclose(quantiles, 1 - q).any()]
+    upper_idx = [int(np.argmin(np.abs(np.asarray(quantiles) - (1 - quantiles[i])))) for i in lower_idx]
+    intervals = [(quantiles[lo], quantiles[hi]) for lo, hi in zip(lower_idx, upper_idx)]
+
+    # residual is (..., quantiles, days)
+    residual = actuals[..., None, :] - forecasts
+    inside = (
+        (actuals[..., None, :] >= forecasts[..., lower_idx, :])
+        & (actuals[..., None, :] <= forecasts[..., upper_idx, :])
+    )
+
+    # Stack the per-day terms, take one cumulative sum and read every cut off it
+    per_day = np.stack([
+        residual ** 2,
+        np.abs(residual),
+        np.maximum(levels * residual, (levels - 1) * residual),
+    ])
+    running = np.cumsum(per_day, axis=-1)[..., cuts - 1] / cuts
+    coverage = np.cumsum(inside, axis=-1)[..., cuts - 1] / cuts
+
+    return {
+        'rmse': np.sqrt(running[0]),
+        'mae': running[1],
+        'pinball': running[2],
+        'coverage': coverage,
+        'intervals': intervals,
+    }
+
+
+def get_forecast_metrics_df(metrics, quantile_names=QUANTILE_NAMES, horizon_names=FORECAST_HORIZON_NAMES):
+    """
+    Flatten the metrics of a single forecast into a long DataFrame
+    (Metric, quartiles, one column per horizon cut).
+    """
+    frames = []
+    for metric in ['rmse', 'mae', 'pinball']:
+        frame = pd.DataFrame(metrics[metric], columns=horizon_names)
+        frame.insert(0, 'quartiles', quantile_names)
+        frame.insert(0, 'Metric', metric.upper())
+        frames.append(frame)
+
+    coverage = pd.DataFrame(metrics['coverage'], columns=horizon_names)
+    coverage.insert(0, 'quartiles', [f'p{int(lo*100)}-p{int(hi*100)}' for lo, hi in metrics['intervals']])
+    coverage.insert(0, 'Metric', 'COVERAGE')
+    frames.append(coverage)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_combined_rmse_from_forecast(transformed_forecast_values, actuals):
+    """
+    Same table as get_combined_rmse, computed straight from the inverse transformed
+    forecast dictionary and the actual balances without building the 7/14/30 day frames.
+    """
+    quantile_names = list(transformed_forecast_values.keys())
+    forecasts = np.stack([transformed_forecast_values[name] for name in quantile_names])
+    quantiles = [int(name[1:]) / 100 for name in quantile_names]
+
+    metrics = compute_forecast_metrics(forecasts, np.asarray(actuals), quantiles=quantiles)
+
+    combined_rmse = pd.DataFrame(metrics['rmse'], columns=FORECAST_HORIZON_NAMES)
+    combined_rmse.insert(0, 'quartiles', quantile_names)
+
+    return combined_rmse
+
+
 def get_experiment_number (logs_dir):
     
     # Get all subdirectories in the lightning_logs folder
@@ -204,4 +293,27 @@ def get_hyperparameters(file_path, experiment_id):
         'ExperimentID': experiment_ids  # New column for experiment IDs
     })
     
-    return df
\ No newline at end of file
+    return df
+
+def get_hyperparameters_from_dict(hyperparameters, experiment_id, category="Hyperparameter"):
+    """
+    Same table as get_hyperparameters, built from an in-memory (possibly nested)
+    dictionary instead of an hparams.yaml file. Nested keys are joined with '.'
+    and values that are not plain scalars are skipped, like the !!python/ entries.
+    """
+    rows = []
+
+    def flatten(params, path):
+        for key, value in params.items():
+            full_key = '.'.join(path + [str(key)])
+            if isinstance(value, dict):
+                flatten(value, path + [str(key)])
+            elif value is None or isinstance(value, (bool, int, float, str, np.number, np.bool_)):
+                rows.append((category, full_key, value.item() if isinstance(value, np.generic) else value, experiment_id))
+
+    flatten(hyperparameters, [])
+
+    df = pd.DataFrame(rows, columns=['Category', 'Metric', 'Value', 'ExperimentID'])
+    df['Value'] = pd.Series([row[2] for row in rows], dtype=object)  # keep ints as ints next to floats
+
+    return df
@@ -0,0 +1,313 @@
+import os
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+
+# Stage-graph runner for run_prediction
+#
+# A pipeline is a list of Stages, each a function with named inputs and outputs. A
+# PipelineRun holds the values produced so far; execute(stages) starts every stage whose
+# inputs are available on a thread pool, so stages that don't depend on each other (the
+# hyperparameter lookup next to sampling, the table writes next to each other) overlap.
+# Stage exceptions are raised unchanged to the caller once running stages have finished.
+#
+# Memoization: every value has a fingerprint. Run inputs and the outputs of stages that
+# are not memoized are hashed by content (or get a fresh id when they cannot be hashed);
+# a memoized stage's key is the hash of its name and input fingerprints, and its outputs
+# are fingerprinted by that key, so a chain of memoized stages is looked up without
+# hashing models or forecasts. Hits come from a process-wide LRU cache.
+#
+# After a run, critical_path() walks back from the last stage to finish through the
+# dependency that finished last at each step: the chain of stages that set the wall-clock
+# time, and the place to cut it.
+#
+# Configuration (environment variables):
+# CWB_PIPELINE_WORKERS      stages run at once, 1 runs them in order on the calling thread (default 4)
+# CWB_PIPELINE_CACHE_SIZE   memoized stage results kept, 0 disables memoization (default 0)
+
+PIPELINE_WORKERS = int(os.environ.get("CWB_PIPELINE_WORKERS", "4"))
+CACHE_SIZE = int(os.environ.get("CWB_PIPELINE_CACHE_SIZE", "0"))
+
+_stage_cache = None
+_stage_cache_lock = threading.Lock()
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    Parameters:
+    name (str): Stage name, used for timings and the report
+    function (callable): Called with the inputs as keyword arguments, returns {output: value}
+    inputs (list): Names of the values the stage reads
+    outputs (list): Names of the values the stage produces
+    memoize (bool): Reuse the outputs for identical inputs (pure stages only)
+    """
+
+    def __init__(self, name, function, inputs=(), outputs=(), memoize=False):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.memoize = memoize
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={self.inputs}, outputs={self.outputs})"
+
+
+class StageCache:
+    """Bounded LRU of memoized stage outputs, keyed by stage input hash."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, outputs):
+        with self._lock:
+            self._entries[key] = outputs
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def get_stage_cache():
+    """
+    Return the process-wide stage cache, creating it on first use.
+    Returns None when CWB_PIPELINE_CACHE_SIZE is 0.
+    """
+    global _stage_cache
+
+    if CACHE_SIZE <= 0:
+        return None
+
+    with _stage_cache_lock:
+        if _stage_cache is None:
+            _stage_cache = StageCache()
+
+    return _stage_cache
+
+
+def _update_hash(digest, value):
+    """Feed value into digest; False when the value has no content hash."""
+    if value is None or isinstance(value, (bool, int, float, str, np.number, np.bool_)):
+        digest.update(f"{type(value).__name__}:{value!r};".encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(f"ndarray:{value.dtype}:{value.shape};".encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        labels = list(value.columns) if isinstance(value, pd.DataFrame) else [value.name]
+        digest.update(f"{type(value).__name__}:{labels};".encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}:{len(value)};".encode())
+        return all(_update_hash(digest, item) for item in value)
+    elif isinstance(value, dict):
+        digest.update(f"dict:{len(value)};".encode())
+        return all(_update_hash(digest, key) and _update_hash(digest, value[key]) for key in sorted(value, key=str))
+    else:
+        return False
+    return True
+
+
+def fingerprint(value):
+    """Content hash of a value, or a fresh unique id when it cannot be hashed."""
+    digest = hashlib.blake2b(digest_size=16)
+    if _update_hash(digest, value):
+        return digest.hexdigest()
+    return uuid.uuid4().hex
+
+
+def validate_stages(stages, available):
+    """
+    Check the graph: unique outputs, every input available or produced, no cycles.
+
+    Returns:
+    dict: {output: producing stage name}
+    """
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers or output in available:
+                raise ValueError(f"Pipeline value {output!r} is produced twice ({stage.name})")
+            producers[output] = stage.name
+
+    for stage in stages:
+        missing = [name for name in stage.inputs if name not in producers and name not in available]
+        if missing:
+            raise ValueError(f"Stage {stage.name!r} needs {missing}, which nothing produces")
+
+    # Kahn's algorithm over the stage dependencies
+    dependencies = {stage.name: {producers[name] for name in stage.inputs if name in producers} for stage in stages}
+    done = set()
+    while len(done) < len(stages):
+        ready = [name for name, needs in dependencies.items() if name not in done and needs <= done]
+        if not ready:
+            raise ValueError(f"Pipeline has a cycle among {sorted(set(dependencies) - done)}")
+        done.update(ready)
+
+    return producers
+
+
+class PipelineRun:
+    """
+    Values, timings and stage records of one pipeline run. execute() may be called several
+    times (e.g. once per phase); the records and the report cover all of them.
+
+    Parameters:
+    inputs (dict): Initial values, e.g. the request parameters
+    max_workers (int): Stages run at once; 1 runs them in order on the calling thread
+    cache (StageCache): Memoized stage results, None disables memoization
+    """
+
+    def __init__(self, inputs, max_workers=PIPELINE_WORKERS, cache=None):
+        self.values = dict(inputs)
+        self.fingerprints = {name: fingerprint(value) for name, value in self.values.items()}
+        self.max_workers = max_workers
+        self.cache = cache
+        self.records = {}
+        self._producers = {}
+        self._started = time.perf_counter()
+
+    def _memo_key(self, stage):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(stage.name.encode())
+        for name in stage.inputs:
+            digest.update(f";{name}={self.fingerprints[name]}".encode())
+        return digest.hexdigest()
+
+    def _run_stage(self, stage, arguments, key):
+        """Runs on a pool thread (or inline): look up or compute the stage outputs."""
+        started = time.perf_counter()
+        outputs = self.cache.get(key) if key is not None else None
+        cached = outputs is not None
+        if not cached:
+            outputs = stage.function(**arguments) or {}
+            missing = [name for name in stage.outputs if name not in outputs]
+            if missing:
+                raise ValueError(f"Stage {stage.name!r} did not return {missing}")
+            if key is not None:
+                self.cache.put(key, outputs)
+        return outputs, started, time.perf_counter(), cached
+
+    def _finish_stage(self, stage, key, outcome):
+        """On the scheduling thread: publish the outputs and record the timing."""
+        outputs, started, finished, cached = outcome
+        for name in stage.outputs:
+            self.values[name] = outputs[name]
+            self.fingerprints[name] = f"{key}:{name}" if key is not None else fingerprint(outputs[name])
+            self._producers[name] = stage.name
+
+        self.records[stage.name] = {
+            "start": started - self._started,
+            "end": finished - self._started,
+            "seconds": finished - started,
+            "cached": cached,
+            "dependencies": sorted({self._producers[name] for name in stage.inputs if name in self._producers}),
+        }
+
+    def _prepare(self, stage):
+        arguments = {name: self.values[name] for name in stage.inputs}
+        key = self._memo_key(stage) if stage.memoize and self.cache is not None else None
+        return arguments, key
+
+    def execute(self, stages):
+        """Run the stages, each as soon as its inputs exist. Returns the values of the run."""
+        validate_stages(stages, self.values)
+        pending = list(stages)
+
+        if self.max_workers <= 1:
+            while pending:
+                stage = next(stage for stage in pending if all(name in self.values for name in stage.inputs))
+                pending.remove(stage)
+                arguments, key = self._prepare(stage)
+                self._finish_stage(stage, key, self._run_stage(stage, arguments, key))
+            return self.values
+
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cwb-stage") as executor:
+            while pending or running:
+                if error is None:
+                    for stage in [stage for stage in pending if all(name in self.values for name in stage.inputs)]:
+                        pending.remove(stage)
+                        arguments, key = self._prepare(stage)
+                        running[executor.submit(self._run_stage, stage, arguments, key)] = (stage, key)
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, key = running.pop(future)
+                    try:
+                        self._finish_stage(stage, key, future.result())
+                    except BaseException as stage_error:
+                        # Start nothing new, let the running stages finish, then raise the first error
+                        error = error or stage_error
+
+        if error is not None:
+            raise error
+        return self.values
+
+    @property
+    def timings(self):
+        """{stage: seconds} in the order the stages finished."""
+        return {name: record["seconds"] for name, record in sorted(self.records.items(), key=lambda item: item[1]["end"])}
+
+    def critical_path(self):
+        """Stages that determined the wall-clock time, first to last."""
+        if not self.records:
+            return []
+
+        path = [max(self.records, key=lambda name: self.records[name]["end"])]
+        while self.records[path[-1]]["dependencies"]:
+            path.append(max(self.records[path[-1]]["dependencies"], key=lambda name: self.records[name]["end"]))
+        return path[::-1]
+
+    def report(self):
+        """Wall time, critical path and parallelism of the run so far."""
+        path = self.critical_path()
+        wall_seconds = max((record["end"] for record in self.records.values()), default=0.0)
+        stage_seconds = sum(record["seconds"] for record in self.records.values())
+
+        return {
+            "wall_seconds": wall_seconds,
+            "critical_path": [{"stage": name, "seconds": self.records[name]["seconds"]} for name in path],
+            "critical_path_seconds": sum(self.records[name]["seconds"] for name in path),
+            "stage_seconds": stage_seconds,
+            "parallelism": stage_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+            "cached_stages": [name for name, record in self.records.items() if record["cached"]],
+        }
+
+    def format_report(self):
+        """Readable critical-path report."""
+        report = self.report()
+        lines = [
+            f"Pipeline: {report['wall_seconds']:.2f}s wall, {report['stage_seconds']:.2f}s in stages "
+            f"(parallelism {report['parallelism']:.2f}), critical path {report['critical_path_seconds']:.2f}s:"
+        ]
+        for step in report["critical_path"]:
+            share = step["seconds"] / report["wall_seconds"] if report["wall_seconds"] > 0 else 0.0
+            lines.append(f"  {step['stage']:<28} {step['seconds']:8.3f}s {share:6.1%}")
+        if report["cached_stages"]:
+            lines.append(f"  memoized: {', '.join(report['cached_stages'])}")
+        return "\n".join(lines)
@@ -0,0 +1,213 @@
+import pandas as pd
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+from functions.machinelearning import DEFAULT_HYPERPARAMETERS
+
+
+# Preflight validation of the retrieved history, before any model is built
+#
+# Bad histories used to fail late: mid-training (too short for context_length), in
+# get_dynamic_features (an all-zero rolling_7d_std divides by zero) or in step 9.
+# validate_history checks schema, length, the daily date sequence and value ranges of the
+# whole frame with array operations and reports every problem at once as a
+# PreflightValidationError, which run_ml_model returns as a structured 422.
+#
+# A repayment schedule is checked the same way before any work starts:
+# validate_repayment_schedule reports non-numeric amounts, unparseable dates and days
+# outside the forecast horizon (and, once the history is known, dates outside its
+# validation window) as a ScheduleValidationError, returned as a 400.
+
+FEATURE_COLUMNS = ['day_of_month', 'day_of_week', 'is_weekend', 'rolling_7d_std',
+                   'is_salary_day', 'is_rent_day', 'is_major_expense', 'trend_7d']
+REQUIRED_COLUMNS = ['date', 'balance'] + FEATURE_COLUMNS
+FLAG_COLUMNS = ['is_weekend', 'is_salary_day', 'is_rent_day', 'is_major_expense']
+VALUE_RANGES = {'day_of_month': (1, 31), 'day_of_week': (0, 6), 'rolling_7d_std': (0, np.inf)}
+
+
+class PreflightValidationError(ValueError):
+    """The history cannot be used for a forecast. errors is a list of {code, field, message} dicts."""
+
+    # Raised for bad input rather than a server fault: the worker pool passes it through unchanged
+    client_error = True
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+    def __str__(self):
+        return "; ".join(error['message'] for error in self.errors)
+
+
+class ScheduleValidationError(ValueError):
+    """The repayment schedule cannot be simulated. errors is a list of messages."""
+
+    # Raised for bad input rather than a server fault: the worker pool passes it through unchanged
+    client_error = True
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+    def __str__(self):
+        return "; ".join(self.errors)
+
+
+def get_minimum_history_length(hyperparameters=None):
+    """
+    Rows needed by run_prediction: the last prediction_length days are held out for validation,
+    and make_evaluation_predictions holds out another prediction_length before the
+    context_length days the model conditions on.
+    """
+    hyperparameters = {**DEFAULT_HYPERPARAMETERS, **(hyperparameters or {})}
+    return hyperparameters['context_length'] + 2 * hyperparameters['prediction_length']
+
+
+def validate_history(data, hyperparameters=None):
+    """
+    Check a retrieved history before training.
+
+    Parameters:
+    data (DataFrame): fin_history rows for the applicant
+    hyperparameters (dict): Overrides of DEFAULT_HYPERPARAMETERS (context and prediction length)
+
+    Raises:
+    PreflightValidationError: With every problem found
+    """
+    errors = []
+
+    def add_error(code, field, message, **details):
+        errors.append({'code': code, 'field': field, 'message': message, **details})
+
+    if data is None or len(data) == 0:
+        raise PreflightValidationError([{'code': 'no_history', 'field': None, 'message': 'No financial history found'}])
+
+    missing_columns = [column for column in REQUIRED_COLUMNS if column not in data.columns]
+    if missing_columns:
+        raise PreflightValidationError([{
+            'code': 'missing_columns', 'field': None, 'columns': missing_columns,
+            'message': f"History is missing required columns: {', '.join(missing_columns)}",
+        }])
+
+    # Length
+    minimum_length = get_minimum_history_length(hyperparameters)
+    if len(data) < minimum_length:
+        add_error('history_too_short', None, f"History has {len(data)} days, at least {minimum_length} are needed",
+                  rows=len(data), minimum_rows=minimum_length)
+
+    # Numeric columns: one (rows, columns) matrix, one finiteness check
+    numeric_columns = ['balance'] + FEATURE_COLUMNS
+    try:
+        values = data[numeric_columns].to_numpy(dtype=float)
+    except (TypeError, ValueError):
+        raise PreflightValidationError([
+            {'code': 'invalid_dtype', 'field': column, 'message': f"{column} contains non-numeric values"}
+            for column in numeric_columns
+            if (pd.to_numeric(data[column], errors='coerce').isna() & data[column].notna()).any()
+        ])
+
+    non_finite = (~np.isfinite(values)).sum(axis=0)
+    for column, count in zip(numeric_columns, non_finite):
+        if count:
+            add_error('non_finite_values', column, f"{column} has {count} missing or infinite values", count=int(count))
+
+    # Value ranges (non-finite values are already reported)
+    with np.errstate(invalid='ignore'):
+        flags = values[:, [numeric_columns.index(column) for column in FLAG_COLUMNS]]
+        invalid_flags = (np.isfinite(flags) & (flags != 0) & (flags != 1)).sum(axis=0)
+        for column, count in zip(FLAG_COLUMNS, invalid_flags):
+            if count:
+                add_error('out_of_range', column, f"{column} has {count} values other than 0 and 1", count=int(count))
+
+        for column, (low, high) in VALUE_RANGES.items():
+            column_values = values[:, numeric_columns.index(column)]
+            count = int((np.isfinite(column_values) & ((column_values < low) | (column_values > high))).sum())
+            if count:
+                add_error('out_of_range', column, f"{column} has {count} values outside [{low}, {high}]", count=count)
+
+    volatility = values[:, numeric_columns.index('rolling_7d_std')]
+    if not np.any(np.isfinite(volatility) & (volatility > 0)):
+        add_error('zero_volatility', 'rolling_7d_std', "rolling_7d_std is zero throughout, volatility cannot be normalised")
+
+    # Daily date sequence: parseable, increasing, no gaps or duplicates
+    dates = pd.to_datetime(data['date'], errors='coerce').to_numpy(dtype='datetime64[ns]')
+    unparseable = int(np.isnat(dates).sum())
+    if unparseable:
+        add_error('invalid_dates', 'date', f"date has {unparseable} missing or unparseable values", count=unparseable)
+    else:
+        steps = np.diff(dates.astype('datetime64[D]').astype(np.int64))
+        for code, mask, description in [
+            ('dates_not_increasing', steps < 0, 'steps backwards'),
+            ('duplicate_dates', steps == 0, 'duplicate dates'),
+            ('date_gaps', steps > 1, 'gaps in the daily sequence'),
+        ]:
+            count = int(mask.sum())
+            if count:
+                first = str(dates[1:][mask][0].astype('datetime64[D]'))
+                add_error(code, 'date', f"date has {count} {description} (first at {first})", count=count, first=first)
+
+    if errors:
+        raise PreflightValidationError(errors)
+
+
+def _schedule_number(value):
+    """A schedule amount or day as a float, NaN when it is not a number (bools and containers included)."""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return np.nan
+    try:
+        return float(pd.to_numeric(pd.Series([value]), errors='coerce').iloc[0])
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _schedule_date(value):
+    """A schedule date as a Timestamp, NaT unless it is a string pandas can parse."""
+    if not isinstance(value, str):
+        return pd.NaT
+    try:
+        return pd.to_datetime(value)
+    except (TypeError, ValueError, OverflowError):
+        return pd.NaT
+
+
+def validate_repayment_schedule(schedule, forecast_dates=None, horizon=None):
+    """
+    Check a repayment schedule before the forecast is run.
+
+    Parameters:
+    schedule (list): Instalments as {'date': 'YYYY-MM-DD', 'amount': ...} or {'day': 1..horizon, 'amount': ...}
+    forecast_dates (list): Dates of the forecast days, when known; dates must be one of them
+    horizon (int): Forecast days (defaults to prediction_length)
+
+    Raises:
+    ScheduleValidationError: With every problem found
+    """
+    horizon = horizon or DEFAULT_HYPERPARAMETERS['prediction_length']
+    if not isinstance(schedule, list) or not all(
+        isinstance(instalment, dict) and 'amount' in instalment and ('date' in instalment or 'day' in instalment)
+        for instalment in schedule
+    ):
+        raise ScheduleValidationError(["repayment_schedule must be a list of {date or day, amount}"])
+
+    if forecast_dates is not None:
+        forecast_dates = set(pd.to_datetime(pd.Series(forecast_dates)).dt.normalize())
+
+    errors = []
+    for position, instalment in enumerate(schedule, start=1):
+        if not np.isfinite(_schedule_number(instalment['amount'])):
+            errors.append(f"Instalment {position}: amount {instalment['amount']!r} is not a number")
+
+        if 'date' in instalment:
+            due_date = _schedule_date(instalment['date'])
+            if pd.isna(due_date):
+                errors.append(f"Instalment {position}: date {instalment['date']!r} is not a valid date")
+            elif forecast_dates is not None and due_date.normalize() not in forecast_dates:
+                errors.append(f"Instalment {position}: date {instalment['date']} is outside the forecast period "
+                              f"({min(forecast_dates):%Y-%m-%d} to {max(forecast_dates):%Y-%m-%d})")
+        else:
+            day = _schedule_number(instalment['day'])
+            if not np.isfinite(day) or day != int(day) or not 1 <= day <= horizon:
+                errors.append(f"Instalment {position}: day {instalment['day']!r} is outside the forecast period (1-{horizon})")
+
+    if errors:
+        raise ScheduleValidationError(errors)
@@ -0,0 +1,151 @@
+import os
+import re
+import json
+import time
+import uuid
+import random
+import shutil
+import pstats
+import cProfile
+import tempfile
+import threading
+import contextlib
+
+
+# Opt-in per-request profiling for run_prediction
+#
+# A request is profiled when it carries the X-CWB-Profile header (any value but "0") or is
+# picked by the sample rate. The whole of run_prediction runs under cProfile, and the
+# training and sampling stages additionally under the torch profiler. Each capture is a
+# directory named after the request id (X-Request-Id if the caller sent one) holding:
+#   meta.json           request id, creation time and stage timings
+#   profile.prof        cProfile stats (open with pstats or snakeviz)
+#   profile.txt         top functions by cumulative time
+#   torch_<stage>.json  torch profiler chrome trace (chrome://tracing or Perfetto)
+# Traces are written after the request's cProfile stops, so exporting them does not show
+# up in the Python profile.
+# Only the newest CWB_PROFILE_RETENTION captures are kept.
+#
+# Configuration (environment variables):
+# CWB_PROFILE_SAMPLE_RATE   fraction of requests profiled without the header (default 0)
+# CWB_PROFILE_DIR           capture directory (default cwb_profiles in the temp directory)
+# CWB_PROFILE_RETENTION     captures kept (default 50)
+
+SAMPLE_RATE = float(os.environ.get("CWB_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("CWB_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "cwb_profiles"))
+RETENTION = int(os.environ.get("CWB_PROFILE_RETENTION", "50"))
+
+PROFILE_HEADER = "X-CWB-Profile"
+REQUEST_ID_HEADER = "X-Request-Id"
+PROFILE_ID_HEADER = "X-CWB-Profile-Id"
+
+TOP_FUNCTIONS = 40
+
+_active = threading.local()
+
+
+def get_profile_id(request):
+    """
+    Capture id for a request that should be profiled, otherwise None.
+    Uses the caller's X-Request-Id when it is a safe directory name.
+    """
+    forced = request.headers.get(PROFILE_HEADER, "0") not in ("", "0")
+    if not forced and not (SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE):
+        return None
+
+    request_id = request.headers.get(REQUEST_ID_HEADER, "")
+    if re.fullmatch(r"[A-Za-z0-9_.-]{1,100}", request_id) and request_id not in (".", ".."):
+        return request_id
+    return uuid.uuid4().hex
+
+
+class ProfileCapture:
+    """cProfile plus per-stage torch profiler traces for one request, written to directory."""
+
+    def __init__(self, profile_id, directory):
+        self.profile_id = profile_id
+        self.directory = directory
+        self.profiler = cProfile.Profile()
+        self.torch_profilers = {}
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def torch_stage(self, name):
+        import torch
+
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as torch_profiler:
+            yield
+        self.torch_profilers[name] = torch_profiler
+
+    def save(self, timings=None):
+        for name, torch_profiler in self.torch_profilers.items():
+            torch_profiler.export_chrome_trace(os.path.join(self.directory, f"torch_{name}.json"))
+
+        self.profiler.dump_stats(os.path.join(self.directory, "profile.prof"))
+        with open(os.path.join(self.directory, "profile.txt"), "w") as summary_file:
+            pstats.Stats(self.profiler, stream=summary_file).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+
+        with open(os.path.join(self.directory, "meta.json"), "w") as meta_file:
+            json.dump({"request_id": self.profile_id, "created": time.time(), "timings": timings or {}}, meta_file)
+
+
+@contextlib.contextmanager
+def profile_request(profile_id, profile_dir=PROFILE_DIR, retention=RETENTION):
+    """
+    Profile the enclosed block when profile_id is set (yields the ProfileCapture, else None).
+    Stage timings can be attached by setting capture.timings before the block ends.
+    """
+    if profile_id is None:
+        yield None
+        return
+
+    directory = os.path.join(profile_dir, profile_id)
+    os.makedirs(directory, exist_ok=True)
+    capture = ProfileCapture(profile_id, directory)
+
+    _active.capture = capture
+    capture.profiler.enable()
+    try:
+        yield capture
+    finally:
+        capture.profiler.disable()
+        _active.capture = None
+        capture.save(capture.timings)
+        prune_captures(profile_dir, retention)
+        print(f"Profile for request {profile_id} written to {directory}")
+
+
+def profile_stage(name):
+    """Torch profiler trace of the enclosed stage when the current request is being profiled."""
+    capture = getattr(_active, "capture", None)
+    if capture is None:
+        return contextlib.nullcontext()
+    return capture.torch_stage(name)
+
+
+def list_captures(profile_dir=PROFILE_DIR):
+    """Index of the kept captures by request id, newest first."""
+    captures = []
+    for profile_id in os.listdir(profile_dir) if os.path.isdir(profile_dir) else []:
+        try:
+            with open(os.path.join(profile_dir, profile_id, "meta.json")) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, json.JSONDecodeError):
+            continue  # capture still being written
+        captures.append({**meta, "path": os.path.join(profile_dir, profile_id)})
+
+    return sorted(captures, key=lambda capture: capture["created"], reverse=True)
+
+
+def get_capture(request_id, profile_dir=PROFILE_DIR):
+    """Files of the capture for request_id, or None if it was not kept."""
+    directory = os.path.join(profile_dir, request_id)
+    if not os.path.isfile(os.path.join(directory, "meta.json")):
+        return None
+    return {name: os.path.join(directory, name) for name in sorted(os.listdir(directory))}
+
+
+def prune_captures(profile_dir=PROFILE_DIR, retention=RETENTION):
+    """Delete all but the newest retention captures."""
+    for capture in list_captures(profile_dir)[retention:]:
+        shutil.rmtree(capture["path"], ignore_errors=True)
@@ -0,0 +1,85 @@
+import struct
+
+import orjson
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+
+# Response payloads for run_ml_model
+#
+# JSON (default): the prediction result serialized with orjson, NumPy arrays included natively.
+#
+# Binary (Accept: application/x-cwb-forecast) for high-volume internal callers:
+#   header    16 bytes, little endian: magic b"CWBF", version (uint16), quantiles Q (uint16),
+#             days H (uint16), reserved (uint16), metadata length M (uint32)
+#   levels    Q x float32 quantile levels
+#   values    Q x H float32 forecast matrix, row-major (one row per quantile)
+#   metadata  M bytes of orjson with everything else in the result (assessment, dates, ids)
+
+JSON_CONTENT_TYPE = "application/json"
+BINARY_CONTENT_TYPE = "application/x-cwb-forecast"
+
+BINARY_MAGIC = b"CWBF"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHHHI")
+
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _default(value):
+    """Fallback for types orjson does not handle natively (pandas timestamps, non-contiguous arrays)."""
+    if isinstance(value, np.ndarray):
+        return np.ascontiguousarray(value).tolist()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def encode_json(payload):
+    """Serialize a response payload to JSON bytes with orjson."""
+    return orjson.dumps(payload, default=_default, option=ORJSON_OPTIONS)
+
+
+def encode_binary(result):
+    """
+    Encode a run_prediction result in the compact binary format.
+    The forecast matrix travels as raw float32, everything else as orjson metadata.
+    """
+    forecast = result["forecast"]
+    levels = np.ascontiguousarray(forecast["quantiles"], dtype="<f4")
+    values = np.ascontiguousarray(forecast["values"], dtype="<f4")
+    n_quantiles, n_days = values.shape
+
+    metadata = {key: value for key, value in result.items() if key != "forecast"}
+    metadata["forecast"] = {key: value for key, value in forecast.items() if key not in ("quantiles", "values")}
+    metadata_bytes = encode_json(metadata)
+
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, n_quantiles, n_days, 0, len(metadata_bytes))
+
+    return b"".join([header, levels.tobytes(), values.tobytes(), metadata_bytes])
+
+
+def decode_binary(payload):
+    """Decode a payload written by encode_binary back into a result dictionary."""
+    magic, version, n_quantiles, n_days, _, metadata_length = BINARY_HEADER.unpack_from(payload)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"Not a CWB forecast payload (magic {magic!r}, version {version})")
+
+    offset = BINARY_HEADER.size
+    levels = np.frombuffer(payload, dtype="<f4", count=n_quantiles, offset=offset)
+    offset += levels.nbytes
+    values = np.frombuffer(payload, dtype="<f4", count=n_quantiles * n_days, offset=offset).reshape(n_quantiles, n_days)
+    offset += values.nbytes
+
+    result = orjson.loads(payload[offset:offset + metadata_length])
+    result["forecast"]["quantiles"] = levels
+    result["forecast"]["values"] = values
+
+    return result
+
+
+def negotiate_content_type(request):
+    """Pick the response format from the request's Accept header (JSON unless binary is preferred)."""
+    return request.accept_mimetypes.best_match([JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE]) or JSON_CONTENT_TYPE
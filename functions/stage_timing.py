@@ -0,0 +1,22 @@
+# Per-stage wall-clock timings for run_prediction
+#
+# run_prediction returns the duration of each pipeline stage (functions.pipeline) with the
+# result; they are sent back to HTTP callers in a Server-Timing header, which the
+# load-test harness aggregates into per-stage latency percentiles.
+
+
+def format_server_timing(timings):
+    """Server-Timing header value for {stage: seconds}, durations in milliseconds."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def parse_server_timing(header):
+    """Inverse of format_server_timing: {stage: seconds} from a Server-Timing header value."""
+    timings = {}
+    for metric in filter(None, (part.strip() for part in (header or "").split(","))):
+        name, _, params = metric.partition(";")
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                timings[name.strip()] = float(value) / 1000
+    return timings
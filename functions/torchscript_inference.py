@@ -0,0 +1,174 @@
+import time
+
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+import torch
+
+from gluonts.dataset.loader import InferenceDataLoader
+from gluonts.torch.batchify import batchify
+from gluonts.torch.model.predictor import PyTorchPredictor
+from gluonts.transform import SelectFields
+
+from functions.machinelearning import generate_forecasts
+
+
+# TorchScript inference for the DeepAR sampling path
+#
+# The trained network's forward pass (context encoding plus the 30 step
+# autoregressive sampling loop) is traced once into a TorchScript module, which runs
+# without the eager-mode Python overhead on every step. The compiled module is wrapped
+# in a PyTorchPredictor with the original input transformation, so generate_forecasts
+# works unchanged. compile_predictor checks the compiled samples against the eager
+# predictor (same seed) before returning it.
+
+
+def get_example_inputs(predictor, data_for_forecast):
+    """
+    First batch of network inputs for data_for_forecast, in predictor.input_names order.
+    Like make_evaluation_predictions, the last prediction_length days of each target are held back.
+    """
+    truncated_data = [
+        {**entry, "target": entry["target"][..., :-predictor.prediction_length]}
+        for entry in data_for_forecast
+    ]
+    inference_data_loader = InferenceDataLoader(
+        truncated_data,
+        transform=predictor.input_transform + SelectFields(predictor.input_names, allow_missing=True),
+        batch_size=predictor.batch_size,
+        stack_fn=lambda data: batchify(data, predictor.device),
+    )
+    batch = next(iter(inference_data_loader))
+
+    return tuple(batch[name] for name in predictor.input_names)
+
+
+def trace_prediction_net(predictor, data_for_forecast):
+    """Trace the predictor's sampling network to TorchScript using one batch of real inputs."""
+    # The lightning module only forwards to the DeepAR model, trace the model itself
+    network = getattr(predictor.prediction_net, "model", predictor.prediction_net).eval()
+    example_inputs = get_example_inputs(predictor, data_for_forecast)
+
+    with torch.no_grad():
+        traced = torch.jit.trace(network, example_inputs, check_trace=False)
+
+    return torch.jit.freeze(traced)
+
+
+def wrap_compiled_net(predictor, compiled_net):
+    """PyTorchPredictor that runs compiled_net with the transformations of predictor."""
+    return PyTorchPredictor(
+        input_names=predictor.input_names,
+        prediction_net=compiled_net,
+        batch_size=predictor.batch_size,
+        prediction_length=predictor.prediction_length,
+        input_transform=predictor.input_transform,
+        forecast_generator=predictor.forecast_generator,
+        output_transform=predictor.output_transform,
+        lead_time=predictor.lead_time,
+        device=predictor.device,
+    )
+
+
+def get_forecast_samples(predictor, data_for_forecast, seed):
+    """Seeded forecast samples for every series, stacked as (series, samples, days)."""
+    torch.manual_seed(seed)
+    forecasts, _ = generate_forecasts(predictor, data_for_forecast)
+
+    return np.stack([forecast.samples for forecast in forecasts])
+
+
+def check_compiled_predictor(predictor, compiled_predictor, data_for_forecast, rtol=1e-4, atol=1e-4, seed=0):
+    """
+    Compare seeded samples from the eager and compiled predictors.
+
+    Returns:
+    dict: 'equivalent' (bool) and 'max_abs_diff' between the two sample arrays
+    """
+    eager_samples = get_forecast_samples(predictor, data_for_forecast, seed)
+    compiled_samples = get_forecast_samples(compiled_predictor, data_for_forecast, seed)
+
+    return {
+        'equivalent': bool(np.allclose(eager_samples, compiled_samples, rtol=rtol, atol=atol)),
+        'max_abs_diff': float(np.max(np.abs(eager_samples - compiled_samples))),
+    }
+
+
+def compile_predictor(predictor, data_for_forecast, verify=True, rtol=1e-4, atol=1e-4):
+    """
+    Compile the predictor's sampling path to TorchScript.
+
+    Parameters:
+    predictor: Trained GluonTS PyTorchPredictor (as returned by create_model_and_train)
+    data_for_forecast: Dataset used for tracing and, with verify, the equivalence check
+    verify (bool): Raise ValueError unless the compiled samples match the eager ones
+
+    Returns:
+    PyTorchPredictor: Drop-in predictor that runs the compiled module
+    """
+    compiled_predictor = wrap_compiled_net(predictor, trace_prediction_net(predictor, data_for_forecast))
+
+    if verify:
+        check = check_compiled_predictor(predictor, compiled_predictor, data_for_forecast, rtol=rtol, atol=atol)
+        if not check['equivalent']:
+            raise ValueError(f"Compiled predictor differs from eager predictor (max abs diff {check['max_abs_diff']:.3g})")
+
+    return compiled_predictor
+
+
+def export_torchscript(predictor, data_for_forecast, path):
+    """Compile the predictor and save the TorchScript module to path."""
+    compiled_predictor = compile_predictor(predictor, data_for_forecast)
+    torch.jit.save(compiled_predictor.prediction_net, str(path))
+
+    return compiled_predictor
+
+
+def load_compiled_predictor(path, predictor):
+    """Load a module saved by export_torchscript and wrap it with predictor's transformations."""
+    return wrap_compiled_net(predictor, torch.jit.load(str(path), map_location=predictor.device))
+
+
+def benchmark_compiled_predictor(predictor, data_for_forecast, repeats=5):
+    """
+    Time generate_forecasts with the eager and the compiled predictor on this machine.
+
+    Returns:
+    dict: compile time, median eager and compiled seconds per forecast, speedup and
+          the equivalence check result
+    """
+    start = time.perf_counter()
+    compiled_predictor = compile_predictor(predictor, data_for_forecast, verify=False)
+    compile_seconds = time.perf_counter() - start
+
+    check = check_compiled_predictor(predictor, compiled_predictor, data_for_forecast)
+
+    def median_seconds(model):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            generate_forecasts(model, data_for_forecast)
+            timings.append(time.perf_counter() - start)
+        return float(np.median(timings))
+
+    eager_seconds = median_seconds(predictor)
+    compiled_seconds = median_seconds(compiled_predictor)
+
+    return {
+        'compile_seconds': compile_seconds,
+        'eager_seconds': eager_seconds,
+        'compiled_seconds': compiled_seconds,
+        'speedup': eager_seconds / compiled_seconds,
+        'threads': torch.get_num_threads(),
+        **check,
+    }
+
+
+if __name__ == "__main__":
+    # CPU benchmark on a synthetic history: python -m functions.torchscript_inference
+    from functions.machinelearning import make_dummy_history, prep_data_for_deep_ar_model, create_model_and_train
+
+    training_data, _ = prep_data_for_deep_ar_model(make_dummy_history(240))
+    predictor = create_model_and_train(training_data, {"max_epochs": 2})
+
+    for name, value in benchmark_compiled_predictor(predictor, training_data).items():
+        print(f"{name}: {value}")
@@ -0,0 +1,212 @@
+import os
+import time
+import queue
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+
+# Core-aware scheduler for concurrent training jobs
+#
+# The usable cores are split into fixed core sets of threads_per_job cores, one per
+# slot. Each slot runs at most one job at a time in a pool process that is pinned to
+# the slot's cores (where the OS supports affinity) and limited to that many torch
+# intra-op/inter-op and BLAS threads. Jobs beyond the number of slots wait in a FIFO
+# queue instead of oversubscribing the machine. The usable cores are those this process
+# may run on, so in a worker-pool process the scheduler only splits the worker's share.
+#
+# Configuration (environment variables):
+# CWB_TRAINING_SCHEDULER   1 to train run_prediction models through the scheduler (default 0)
+# CWB_TRAINING_THREADS     cores per training job (default 2, capped at the available cores)
+
+ENABLED = os.environ.get("CWB_TRAINING_SCHEDULER", "0") == "1"
+THREADS_PER_JOB = int(os.environ.get("CWB_TRAINING_THREADS", "2"))
+
+STATS_WINDOW = 1000  # recent jobs kept for the queue wait percentile
+
+_training_scheduler = None
+_training_scheduler_lock = threading.Lock()
+
+
+def get_available_cores():
+    """Cores this process may run on (respects cgroup/taskset affinity where available)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _run_pinned(core_set, function, args, kwargs):
+    """Runs in a pool process: pin to core_set, cap threads, then run the job."""
+    from functions.machinelearning import limit_torch_threads
+
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, core_set)
+        except OSError:
+            pass
+    limit_torch_threads(len(core_set))
+
+    return function(*args, **kwargs)
+
+
+def _train_and_serialize(training_data, hyperparameters, predictor_dir, in_memory=False):
+    """
+    Train a model in the pool process and serialize the predictor for the parent.
+    With in_memory the disk-free training record is returned as well.
+    """
+    from functions.machinelearning import create_model_and_train, train_model_in_memory
+
+    if in_memory:
+        predictor, training_record = train_model_in_memory(training_data, hyperparameters)
+    else:
+        predictor, training_record = create_model_and_train(training_data, hyperparameters), None
+    predictor.serialize(Path(predictor_dir))
+
+    return training_record
+
+
+class TrainingScheduler:
+    """
+    Run training jobs with a fixed core budget each, queueing jobs beyond capacity.
+
+    Parameters:
+    threads_per_job (int): Cores (and torch threads) given to each job
+    cores (list): Core ids to schedule on (defaults to the cores available to this process)
+    """
+
+    def __init__(self, threads_per_job=THREADS_PER_JOB, cores=None):
+        cores = cores if cores is not None else get_available_cores()
+        self.threads_per_job = max(1, min(threads_per_job, len(cores)))
+        self.slots = max(1, len(cores) // self.threads_per_job)
+        self.core_sets = [
+            cores[slot * self.threads_per_job:(slot + 1) * self.threads_per_job]
+            for slot in range(self.slots)
+        ]
+
+        self._executor = ProcessPoolExecutor(max_workers=self.slots, mp_context=multiprocessing.get_context("spawn"))
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        # Running totals for the means and maximum, a bounded window of recent waits for the p95
+        self._queue_waits = deque(maxlen=STATS_WINDOW)
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._run_time_total = 0.0
+        self._started_jobs = 0
+
+        for core_set in self.core_sets:
+            threading.Thread(target=self._dispatch, args=(core_set,), daemon=True).start()
+
+        print(f"Training scheduler: {self.slots} slots x {self.threads_per_job} cores {self.core_sets}")
+
+    def _dispatch(self, core_set):
+        """One thread per slot: take the next queued job and run it on this slot's cores."""
+        while True:
+            future, submitted, function, args, kwargs = self._pending.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started = time.monotonic()
+            with self._lock:
+                self._running += 1
+                self._queue_waits.append(started - submitted)
+                self._queue_wait_total += started - submitted
+                self._queue_wait_max = max(self._queue_wait_max, started - submitted)
+                self._started_jobs += 1
+
+            try:
+                result = self._executor.submit(_run_pinned, core_set, function, args, kwargs).result()
+            except BaseException as error:
+                future.set_exception(error)
+                failed = True
+            else:
+                future.set_result(result)
+                failed = False
+
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._failed += int(failed)
+                self._run_time_total += time.monotonic() - started
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue function(*args, **kwargs) to run in a pinned pool process.
+        function must be importable at module level. Returns a Future.
+        """
+        future = Future()
+        self._pending.put((future, time.monotonic(), function, args, kwargs))
+        return future
+
+    def train(self, training_data, hyperparameters=None):
+        """Train a DeepAR model through the scheduler and return the predictor (blocks)."""
+        from gluonts.model.predictor import Predictor
+
+        with tempfile.TemporaryDirectory() as predictor_dir:
+            self.submit(_train_and_serialize, training_data, hyperparameters, predictor_dir).result()
+            return Predictor.deserialize(Path(predictor_dir))
+
+    def train_in_memory(self, training_data, hyperparameters=None):
+        """Disk-free training through the scheduler, returns (predictor, training record) (blocks)."""
+        from gluonts.model.predictor import Predictor
+
+        with tempfile.TemporaryDirectory() as predictor_dir:
+            training_record = self.submit(_train_and_serialize, training_data, hyperparameters, predictor_dir, in_memory=True).result()
+            return Predictor.deserialize(Path(predictor_dir)), training_record
+
+    def stats(self):
+        """
+        Throughput (jobs/minute) and queue wait statistics since the scheduler started
+        (the p95 covers the last STATS_WINDOW jobs).
+        """
+        with self._lock:
+            elapsed_minutes = (time.monotonic() - self._started) / 60
+            waits = np.array(self._queue_waits) if self._queue_waits else np.zeros(1)
+
+            return {
+                "slots": self.slots,
+                "threads_per_job": self.threads_per_job,
+                "running": self._running,
+                "queued": self._pending.qsize(),
+                "completed": self._completed,
+                "failed": self._failed,
+                "jobs_per_minute": self._completed / elapsed_minutes if elapsed_minutes > 0 else 0.0,
+                "queue_wait_mean_seconds": self._queue_wait_total / max(1, self._started_jobs),
+                "queue_wait_p95_seconds": float(np.percentile(waits, 95)),
+                "queue_wait_max_seconds": self._queue_wait_max,
+                "run_time_mean_seconds": self._run_time_total / max(1, self._completed),
+            }
+
+    def report(self):
+        """Print the scheduler statistics."""
+        for name, value in self.stats().items():
+            print(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def get_training_scheduler():
+    """
+    Return the process-wide training scheduler, creating it on first use.
+    Returns None when CWB_TRAINING_SCHEDULER is not enabled.
+    """
+    global _training_scheduler
+
+    if not ENABLED:
+        return None
+
+    with _training_scheduler_lock:
+        if _training_scheduler is None:
+            _training_scheduler = TrainingScheduler()
+
+    return _training_scheduler
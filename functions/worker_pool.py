@@ -0,0 +1,336 @@
+import os
+import time
+import queue
+import importlib
+import threading
+import multiprocessing
+
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+
+# Pre-warmed worker process pool
+#
+# Training and inference run in a fixed set of worker processes instead of the HTTP
+# worker. Each process imports the ML stack and runs a warm-up forecast once at
+# startup, then serves jobs sent over its own Pipe. Workers are recycled after
+# max_jobs_per_worker jobs to bound memory growth, and a worker that dies mid-job
+# only fails that job - it is replaced and the pool carries on. Each slot owns a disjoint
+# share of the cores and its processes are pinned to it (where the OS supports affinity),
+# so a training scheduler or ensemble started inside a worker splits only that share
+# instead of every worker splitting the whole machine. A replacement that
+# fails to start is retried with backoff; a slot whose replacement never starts is
+# given up, and once no slots are left submit raises WorkerPoolExhaustedError instead
+# of waiting forever.
+#
+# Configuration (environment variables):
+# CWB_WORKER_POOL_SIZE      number of worker processes, 0 runs jobs in the HTTP worker (default 0)
+# CWB_WORKER_MAX_JOBS       jobs served before a worker is recycled (default 50)
+# CWB_WORKER_THREADS        torch threads per worker (default cpu_count // pool size)
+# CWB_WORKER_JOB_TIMEOUT    seconds before a running job is killed (default: no timeout)
+# CWB_WORKER_RESPAWN_ATTEMPTS  attempts to start a replacement before its slot is given up (default 8)
+# CWB_WORKER_START_TIMEOUT     seconds a new worker may take to import and warm up (default 600)
+# CWB_WORKER_STOP_TIMEOUT      seconds a recycled worker gets to flush and exit before it is killed (default 60)
+
+POOL_SIZE = int(os.environ.get("CWB_WORKER_POOL_SIZE", "0"))
+MAX_JOBS_PER_WORKER = int(os.environ.get("CWB_WORKER_MAX_JOBS", "50"))
+THREADS_PER_WORKER = os.environ.get("CWB_WORKER_THREADS")
+JOB_TIMEOUT = os.environ.get("CWB_WORKER_JOB_TIMEOUT")
+RESPAWN_ATTEMPTS = int(os.environ.get("CWB_WORKER_RESPAWN_ATTEMPTS", "8"))
+START_TIMEOUT_SECONDS = float(os.environ.get("CWB_WORKER_START_TIMEOUT", "600"))
+STOP_TIMEOUT_SECONDS = float(os.environ.get("CWB_WORKER_STOP_TIMEOUT", "60"))
+
+RESPAWN_BACKOFF_SECONDS = 1.0
+MAX_RESPAWN_BACKOFF_SECONDS = 60.0
+IDLE_POLL_SECONDS = 1.0
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+class WorkerCrashedError(RuntimeError):
+    """Raised when the worker process running a job exits before returning a result."""
+
+
+class WorkerJobError(RuntimeError):
+    """Raised when a job raised an exception inside the worker process."""
+
+
+class WorkerPoolExhaustedError(RuntimeError):
+    """Raised by submit when every worker slot has been lost (no replacement would start)."""
+
+
+def _resolve(target):
+    """Import 'module:function' and return the function."""
+    module_name, function_name = target.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def get_worker_core_sets(size):
+    """Split the cores available to this process into size disjoint shares (all cores each if fewer cores than workers)."""
+    from functions.training_scheduler import get_available_cores
+
+    cores = get_available_cores()
+    if len(cores) < size:
+        return [cores] * size
+    return [[int(core) for core in share] for share in np.array_split(cores, size)]
+
+
+def _worker_main(connection, num_threads, core_set, preload, warm_up):
+    """Entry point of a worker process."""
+    from functions.machinelearning import limit_torch_threads, warm_up_forecast
+
+    # Pin to this slot's cores: schedulers created in the worker then see only its share
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, core_set)
+        except OSError:
+            pass
+    limit_torch_threads(num_threads)
+    for module_name in preload:
+        importlib.import_module(module_name)
+    if warm_up:
+        warm_up_forecast()
+
+    connection.send(("ready", os.getpid()))
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        target, kwargs = message
+        try:
+            connection.send(("ok", _resolve(target)(**kwargs)))
+        except Exception as error:
+            # Client errors (bad input, e.g. PreflightValidationError) are re-raised as themselves by submit
+            if getattr(error, "client_error", False):
+                connection.send(("client_error", error))
+            else:
+                connection.send(("error", f"{type(error).__name__}: {error}"))
+
+    # Recycled or orphaned: write out the results of the last jobs before exiting
+    from functions.write_behind import flush_write_behind
+    flush_write_behind()
+
+
+class _Worker:
+    def __init__(self, process, connection, core_set):
+        self.process = process
+        self.connection = connection
+        self.core_set = core_set
+        self.jobs_done = 0
+
+
+class WorkerPool:
+    """
+    Fixed-size pool of pre-warmed worker processes.
+
+    Parameters:
+    size (int): Number of worker processes
+    max_jobs_per_worker (int): Jobs served before a worker is replaced with a fresh one
+    threads_per_worker (int): Torch threads in each worker (defaults to cpu_count // size)
+    job_timeout (float): Seconds a job may run before its worker is killed (None waits forever)
+    respawn_attempts (int): Attempts to start a replacement worker before its slot is given up
+    preload (list): Modules imported by each worker at startup
+    warm_up (bool): Run a dummy forecast in each worker at startup
+    """
+
+    def __init__(self, size, max_jobs_per_worker=MAX_JOBS_PER_WORKER, threads_per_worker=None,
+                 job_timeout=None, respawn_attempts=RESPAWN_ATTEMPTS, preload=("predict",), warm_up=True):
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // size)
+        self.job_timeout = job_timeout
+        self.respawn_attempts = respawn_attempts
+        self.preload = list(preload)
+        self.warm_up = warm_up
+
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"jobs": 0, "errors": 0, "crashes": 0, "timeouts": 0, "recycled": 0, "lost_slots": 0}
+        self._slots = 0  # workers running or being replaced
+        self._closed = False
+
+    def start(self):
+        """Start every worker and wait until all of them are warm."""
+        for worker in [self._spawn(core_set) for core_set in get_worker_core_sets(self.size)]:
+            self._wait_until_ready(worker)
+            self._idle.put(worker)
+        self._slots = self.size
+        print(f"Worker pool started with {self.size} workers x {self.threads_per_worker} threads")
+        return self
+
+    def _spawn(self, core_set):
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(child_connection, self.threads_per_worker, core_set, self.preload, self.warm_up),
+            daemon=True,
+        )
+        process.start()
+        child_connection.close()
+        return _Worker(process, parent_connection, core_set)
+
+    def _wait_until_ready(self, worker, timeout=START_TIMEOUT_SECONDS):
+        status = None
+        try:
+            if worker.connection.poll(timeout):
+                status, _ = worker.connection.recv()
+        except (EOFError, OSError):
+            pass
+        if status != "ready":
+            if worker.process.is_alive():
+                # Hung while importing or warming up: it will never serve the slot
+                worker.process.terminate()
+                worker.process.join(timeout=5)
+                raise WorkerCrashedError(f"Worker did not become ready within {timeout:.0f}s")
+            raise WorkerCrashedError(f"Worker failed to start (exit code {worker.process.exitcode})")
+
+    def _stop(self, worker, grace=0.0):
+        """Stop a worker, giving it up to grace seconds to exit on its own (flush writes, atexit) first."""
+        if grace > 0:
+            worker.process.join(timeout=grace)
+        worker.connection.close()
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.process.join()
+
+    def _replace(self, worker, grace=0.0):
+        """
+        Stop a worker and add a fresh, warmed-up one in the background.
+        With grace (a recycled worker that was sent the stop message) it may exit on its own first.
+        """
+        def start_replacement():
+            self._stop(worker, grace)
+
+            for attempt in range(self.respawn_attempts):
+                if self._closed:
+                    return
+                delay = min(MAX_RESPAWN_BACKOFF_SECONDS, RESPAWN_BACKOFF_SECONDS * 2 ** attempt)
+                try:
+                    replacement = self._spawn(worker.core_set)
+                except Exception as error:
+                    # e.g. out of memory or file descriptors: the slot stays, try again later
+                    print(f"Worker replacement could not be spawned: {error}, retrying in {delay:.0f}s")
+                    time.sleep(delay)
+                    continue
+                try:
+                    self._wait_until_ready(replacement)
+                except WorkerCrashedError as error:
+                    replacement.connection.close()
+                    replacement.process.join(timeout=1)
+                    print(f"Worker replacement failed: {error}, retrying in {delay:.0f}s")
+                    time.sleep(delay)
+                    continue
+                self._idle.put(replacement)
+                return
+
+            with self._lock:
+                self._slots -= 1
+                self._stats["lost_slots"] += 1
+                slots = self._slots
+            print(f"Worker slot lost after {self.respawn_attempts} failed replacements, {slots} of {self.size} left")
+
+        threading.Thread(target=start_replacement, daemon=True).start()
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def submit(self, target, **kwargs):
+        """
+        Run target ('module:function') with kwargs on the next idle worker and return its result.
+        Blocks until a worker is free; raises WorkerPoolExhaustedError once no worker slots are left.
+        Thread-safe.
+        """
+        worker = self._next_idle_worker()
+        self._count("jobs")
+
+        try:
+            worker.connection.send((target, kwargs))
+            finished = worker.connection.poll(self.job_timeout)
+            if finished:
+                status, result = worker.connection.recv()
+        except (EOFError, OSError):
+            self._count("crashes")
+            worker.process.join(timeout=1)
+            exitcode = worker.process.exitcode
+            self._replace(worker)
+            raise WorkerCrashedError(f"Worker running {target} exited unexpectedly (exit code {exitcode})")
+
+        if not finished:
+            self._count("timeouts")
+            self._replace(worker)
+            raise TimeoutError(f"Job {target} did not finish within {self.job_timeout}s")
+
+        worker.jobs_done += 1
+        if worker.jobs_done >= self.max_jobs_per_worker:
+            self._count("recycled")
+            worker.connection.send(None)
+            self._replace(worker, grace=STOP_TIMEOUT_SECONDS)
+        else:
+            self._idle.put(worker)
+
+        if status == "error":
+            self._count("errors")
+            raise WorkerJobError(result)
+        if status == "client_error":
+            raise result
+
+        return result
+
+    def _next_idle_worker(self):
+        """Wait for an idle worker, checking that some slot can still provide one."""
+        while True:
+            try:
+                return self._idle.get(timeout=IDLE_POLL_SECONDS)
+            except queue.Empty:
+                with self._lock:
+                    slots = self._slots
+                if slots <= 0 or self._closed:
+                    raise WorkerPoolExhaustedError("No worker processes left in the pool (all replacements failed to start)")
+
+    def stats(self):
+        """Counters for jobs, errors, crashes, timeouts and recycled workers, plus idle workers."""
+        with self._lock:
+            return {**self._stats, "size": self.size, "slots": self._slots, "idle": self._idle.qsize()}
+
+    def shutdown(self):
+        """Stop all idle workers."""
+        self._closed = True
+        while not self._idle.empty():
+            worker = self._idle.get()
+            try:
+                worker.connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+
+def get_worker_pool():
+    """
+    Return the process-wide worker pool, starting it on first use.
+    Returns None when CWB_WORKER_POOL_SIZE is 0 (jobs then run in the HTTP worker).
+    """
+    global _worker_pool
+
+    if POOL_SIZE <= 0:
+        return None
+
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = WorkerPool(
+                POOL_SIZE,
+                max_jobs_per_worker=MAX_JOBS_PER_WORKER,
+                threads_per_worker=int(THREADS_PER_WORKER) if THREADS_PER_WORKER else None,
+                job_timeout=float(JOB_TIMEOUT) if JOB_TIMEOUT else None,
+            ).start()
+
+    return _worker_pool
@@ -0,0 +1,345 @@
+import io
+import os
+import time
+import queue
+import atexit
+import pickle
+import tempfile
+import threading
+
+import psycopg2
+
+from functions.database import (
+    get_column_name_and_datatype_dictionary,
+    prepare_sql_queries_and_values,
+    insert_data_into_sql_data_base,
+    insert_batches_into_sql_data_base,
+)
+
+
+# Write-behind persistence for run_prediction results (step 13)
+#
+# With write-behind enabled the request hands its (table name, DataFrame) pairs to a
+# bounded in-process queue and returns. A background writer drains the queue, coalesces
+# the rows of all queued requests into one INSERT batch per table, and writes them over a
+# single connection. Only transient failures (connection lost, database unavailable) are
+# retried with exponential backoff; if the database stays unavailable (or the queue is full)
+# the results are appended to a local spill file, which is replayed once writes succeed
+# again. Any other error means the rows themselves are bad: the coalesced batch is split
+# and its requests written one at a time, and a request that still fails is moved to a
+# dead-letter file, so it neither blocks the writer nor takes other requests down with it.
+# A spill file that cannot be read back (truncated or corrupt) is renamed to *.corrupt
+# after the readable requests are taken from it; if the spill file cannot be written
+# (e.g. disk full) the requests are held in memory until the next replay. The writer
+# thread logs any other failure and carries on.
+#
+# Configuration (environment variables):
+# CWB_WRITE_BEHIND              1 to enable, otherwise results are written synchronously (default 0)
+# CWB_WRITE_BEHIND_QUEUE_SIZE   requests held in memory before spilling to disk (default 1000)
+# CWB_WRITE_BEHIND_BATCH        requests coalesced into one database write (default 50)
+# CWB_WRITE_BEHIND_LINGER       seconds the writer waits for more requests to batch (default 0.5)
+# CWB_WRITE_BEHIND_RETRIES      write attempts before a batch is spilled (default 5)
+# CWB_WRITE_BEHIND_SPILL_PATH   spill file (default cwb_write_behind.spill in the temp directory)
+# CWB_WRITE_BEHIND_DEAD_LETTER_PATH   requests that cannot be written (default cwb_write_behind.dead in the temp directory)
+
+ENABLED = os.environ.get("CWB_WRITE_BEHIND", "0") == "1"
+QUEUE_SIZE = int(os.environ.get("CWB_WRITE_BEHIND_QUEUE_SIZE", "1000"))
+BATCH_SIZE = int(os.environ.get("CWB_WRITE_BEHIND_BATCH", "50"))
+LINGER_SECONDS = float(os.environ.get("CWB_WRITE_BEHIND_LINGER", "0.5"))
+MAX_RETRIES = int(os.environ.get("CWB_WRITE_BEHIND_RETRIES", "5"))
+SPILL_PATH = os.environ.get(
+    "CWB_WRITE_BEHIND_SPILL_PATH", os.path.join(tempfile.gettempdir(), "cwb_write_behind.spill")
+)
+DEAD_LETTER_PATH = os.environ.get(
+    "CWB_WRITE_BEHIND_DEAD_LETTER_PATH", os.path.join(tempfile.gettempdir(), "cwb_write_behind.dead")
+)
+
+# Errors worth retrying: the database or the connection to it is unavailable, the rows are fine
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, ConnectionError, TimeoutError)
+
+BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 30.0
+
+_write_behind_queue = None
+_write_behind_queue_lock = threading.Lock()
+
+
+def coalesce_results(results):
+    """
+    Turn queued results into one (table_query, insert_query, values_list) per table.
+
+    Parameters:
+    results (list): One [(table_name, DataFrame), ...] list per request
+
+    Returns:
+    list: Prepared statements with the rows of all requests for the same table combined
+    """
+    statements = {}
+    for request_results in results:
+        for table_name, df in request_results:
+            column_definitions = get_column_name_and_datatype_dictionary(df)
+            table_query, insert_query, values_list = prepare_sql_queries_and_values(column_definitions, table_name, df)
+
+            key = (table_query, insert_query)
+            statements.setdefault(key, []).extend(values_list)
+
+    return [(table_query, insert_query, values_list) for (table_query, insert_query), values_list in statements.items()]
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue of results plus the background thread that writes them.
+
+    Parameters:
+    maxsize (int): Requests held in memory before new ones go straight to the spill file
+    batch_size (int): Maximum requests coalesced into one database write
+    linger (float): Seconds to wait for more requests after the first one arrives
+    max_retries (int): Write attempts before the batch is spilled
+    spill_path (str): File used when the database is unavailable
+    dead_letter_path (str): File for requests that fail with a non-transient error
+    write (callable): Writes a list of prepared statements, raising on failure
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE, linger=LINGER_SECONDS,
+                 max_retries=MAX_RETRIES, spill_path=SPILL_PATH, dead_letter_path=DEAD_LETTER_PATH,
+                 write=insert_batches_into_sql_data_base):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self.dead_letter_path = dead_letter_path
+        self.write = write
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"enqueued": 0, "written_requests": 0, "written_rows": 0, "batches": 0,
+                       "retries": 0, "spilled": 0, "replayed": 0, "dead_lettered": 0, "spill_errors": 0}
+        self._held = []  # requests that could not be spilled to disk, replayed with the spill file
+
+        self._thread = threading.Thread(target=self._run, name="cwb-write-behind", daemon=True)
+        self._thread.start()
+
+    def _count(self, stat, amount=1):
+        with self._stats_lock:
+            self._stats[stat] += amount
+
+    def enqueue(self, request_results):
+        """Queue one request's [(table_name, DataFrame), ...] for writing. Never blocks."""
+        self._count("enqueued")
+        try:
+            self._queue.put_nowait(request_results)
+        except queue.Full:
+            self._spill([request_results])
+
+    def _next_batch(self):
+        """Block for the first request, then collect more for up to linger seconds."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.linger
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _write_with_retry(self, batch):
+        """
+        Write a batch of requests, retrying transient errors with backoff.
+        Returns True once written, False if the database stayed unavailable; other errors are raised.
+        """
+        statements = coalesce_results(batch)
+
+        for attempt in range(self.max_retries):
+            try:
+                rows = self.write(statements)
+            except TRANSIENT_ERRORS as error:
+                self._count("retries")
+                delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt)
+                print(f"Write-behind attempt {attempt + 1} failed ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            self._count("batches")
+            self._count("written_requests", len(batch))
+            self._count("written_rows", rows or 0)
+            return True
+
+        return False
+
+    def _write_batch(self, batch):
+        """
+        Write a batch, splitting it into single requests if the coalesced write fails for good.
+        Requests that fail on their own go to the dead-letter file.
+
+        Returns:
+        list: Requests not written because the database is unavailable (to be spilled)
+        """
+        try:
+            return [] if self._write_with_retry(batch) else batch
+        except Exception as error:
+            if len(batch) == 1:
+                self._dead_letter(batch[0], error)
+                return []
+            print(f"Write-behind batch of {len(batch)} requests failed ({error}), writing them one at a time")
+
+        for index, request_results in enumerate(batch):
+            if self._write_batch([request_results]):
+                # Unavailable again: keep this request and the rest for the spill file
+                return batch[index:]
+        return []
+
+    def _dead_letter(self, request_results, error):
+        """Append a request that cannot be written, with its error, to the dead-letter file."""
+        try:
+            with self._spill_lock:
+                with open(self.dead_letter_path, "ab") as dead_letter_file:
+                    pickle.dump({"error": f"{type(error).__name__}: {error}", "results": request_results}, dead_letter_file)
+                    dead_letter_file.flush()
+                    os.fsync(dead_letter_file.fileno())
+        except (OSError, pickle.PicklingError) as file_error:
+            self._count("spill_errors")
+            print(f"Write-behind could not write {self.dead_letter_path} ({file_error}), dropping a request that failed with {error}")
+            return
+        self._count("dead_lettered")
+        print(f"Write-behind moved a request to {self.dead_letter_path} ({type(error).__name__}: {error})")
+
+    def _spill(self, batch):
+        """Append requests to the spill file and fsync it (held in memory if the file cannot be written)."""
+        with self._spill_lock:
+            try:
+                with open(self.spill_path, "ab") as spill_file:
+                    for request_results in batch:
+                        pickle.dump(request_results, spill_file)
+                    spill_file.flush()
+                    os.fsync(spill_file.fileno())
+            except (OSError, pickle.PicklingError) as error:
+                # A partly written record is caught as corrupt on replay; the whole batch is kept here
+                self._held.extend(batch)
+                self._count("spill_errors")
+                print(f"Write-behind could not spill to {self.spill_path} ({error}), holding {len(batch)} requests in memory")
+                return
+        self._count("spilled", len(batch))
+        print(f"Write-behind spilled {len(batch)} requests to {self.spill_path}")
+
+    def _take_spilled(self):
+        """Remove and return everything in the spill file, plus requests held in memory."""
+        with self._spill_lock:
+            spilled, self._held = self._held, []
+            if not os.path.exists(self.spill_path):
+                return spilled
+
+            try:
+                with open(self.spill_path, "rb") as spill_file:
+                    contents = io.BytesIO(spill_file.read())
+            except OSError as error:
+                self._count("spill_errors")
+                print(f"Write-behind could not read {self.spill_path} ({error}), will retry on the next replay")
+                return spilled
+
+            corrupt = None
+            while contents.tell() < len(contents.getbuffer()):
+                try:
+                    spilled.append(pickle.load(contents))
+                except Exception as error:
+                    corrupt = error
+                    break
+
+            try:
+                if corrupt is None:
+                    os.remove(self.spill_path)
+                else:
+                    # Keep the unreadable file for inspection, the requests before the bad record are replayed
+                    corrupt_path = f"{self.spill_path}.{time.strftime('%Y%m%d%H%M%S')}.corrupt"
+                    os.replace(self.spill_path, corrupt_path)
+                    self._count("spill_errors")
+                    print(f"Write-behind spill file is corrupt ({type(corrupt).__name__}: {corrupt}), "
+                          f"replaying {len(spilled)} readable requests, moved the file to {corrupt_path}")
+            except OSError as error:
+                print(f"Write-behind could not remove {self.spill_path} ({error})")
+
+        return spilled
+
+    def _replay_spilled(self):
+        """Write spilled requests in batches, spilling them again if the database is still down."""
+        spilled = self._take_spilled()
+        for start in range(0, len(spilled), self.batch_size):
+            batch = spilled[start:start + self.batch_size]
+            unwritten = self._write_batch(batch)
+            self._count("replayed", len(batch) - len(unwritten))
+            if unwritten:
+                self._spill(unwritten + spilled[start + self.batch_size:])
+                return
+
+    def _run(self):
+        self._replay_spilled()
+
+        while True:
+            batch = self._next_batch()
+            try:
+                unwritten = self._write_batch(batch)
+                if unwritten:
+                    self._spill(unwritten)
+                else:
+                    self._replay_spilled()
+            except Exception as error:
+                # Never let the writer thread die: later requests would queue up unwritten
+                print(f"Write-behind writer error ({type(error).__name__}: {error}), continuing")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Block until every queued request has been written, spilled or dead-lettered."""
+        self._queue.join()
+
+    def stats(self):
+        """Counters for queued, written, retried, spilled and dead-lettered requests, plus the queue depth and held requests."""
+        with self._stats_lock:
+            return {**self._stats, "queue_depth": self._queue.qsize(), "held": len(self._held)}
+
+
+def get_write_behind_queue():
+    """
+    Return the process-wide write-behind queue, starting its writer on first use.
+    Returns None when CWB_WRITE_BEHIND is not enabled.
+    """
+    global _write_behind_queue
+
+    if not ENABLED:
+        return None
+
+    with _write_behind_queue_lock:
+        if _write_behind_queue is None:
+            _write_behind_queue = WriteBehindQueue()
+            atexit.register(_write_behind_queue.flush)
+
+    return _write_behind_queue
+
+
+def flush_write_behind():
+    """Block until this process's queued results are written or spilled (no-op if write-behind never started)."""
+    if _write_behind_queue is not None:
+        _write_behind_queue.flush()
+
+
+def write_results(request_results):
+    """
+    Persist one request's [(table_name, DataFrame), ...].
+
+    Queued for the background writer when write-behind is enabled, otherwise
+    written synchronously table by table as before.
+    """
+    write_behind_queue = get_write_behind_queue()
+    if write_behind_queue is not None:
+        write_behind_queue.enqueue(request_results)
+        return
+
+    for table_name, df in request_results:
+        column_definitions = get_column_name_and_datatype_dictionary(df)
+        insert_data_into_sql_data_base(*prepare_sql_queries_and_values(column_definitions, table_name, df))
@@ -0,0 +1,227 @@
+"""
+Offline load test for run_ml_model.
+
+Starts the function locally under functions-framework against the in-memory database
+(CWB_DB_BACKEND=fake), drives it at one or more concurrency levels with a weighted mix of
+request kinds, and reports throughput plus p50/p95/p99 latency end to end and per pipeline
+stage (from the Server-Timing header).
+
+Examples:
+    python load-test-cwb-ml-api.py --concurrency 1,2,4 --requests 20
+    python load-test-cwb-ml-api.py --mix json:3,binary:1,invalid:1 --env CWB_WORKER_POOL_SIZE=2
+    python load-test-cwb-ml-api.py --url http://localhost:8080 --concurrency 8   # already running server
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+np.bool = np.bool_ # https://stackoverflow.com/questions/74893742/how-to-solve-attributeerror-module-numpy-has-no-attribute-bool
+
+from functions.stage_timing import parse_server_timing
+from functions.response_encoding import BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE
+
+
+# Request kinds the mix is drawn from: (payload builder, Accept header)
+REQUEST_KINDS = {
+    "json": (lambda rng: {"applicant_id": str(rng.randint(100000000, 999999999)), "required_amount": rng.choice([2000, 8000, 14000, 30000])}, JSON_CONTENT_TYPE),
+    "binary": (lambda rng: {"applicant_id": str(rng.randint(100000000, 999999999)), "required_amount": rng.choice([2000, 8000, 14000, 30000])}, BINARY_CONTENT_TYPE),
+    "invalid": (lambda rng: {"applicant_id": str(rng.randint(100000000, 999999999))}, JSON_CONTENT_TYPE),  # 400 fast path
+}
+
+PERCENTILES = [50, 95, 99]
+
+
+def parse_mix(mix):
+    """'json:3,binary:1' -> {'json': 3.0, 'binary': 1.0}"""
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition(":")
+        if kind not in REQUEST_KINDS:
+            raise ValueError(f"Unknown request kind '{kind}', expected one of {list(REQUEST_KINDS)}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, extra_env, startup_timeout):
+    """Start run_ml_model under functions-framework and wait until it answers."""
+    env = {**os.environ, "CWB_DB_BACKEND": "fake", **extra_env}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "functions_framework", "--target", "run_ml_model", "--source", "main.py",
+         "--host", "127.0.0.1", "--port", str(port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+
+    url = f"http://127.0.0.1:{port}/"
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"functions-framework exited with code {server.returncode}")
+        try:
+            urllib.request.urlopen(url, timeout=1)
+        except urllib.error.HTTPError:
+            return server, url  # any HTTP answer (400 for a non-JSON GET) means it is up
+        except OSError:
+            time.sleep(0.5)
+        else:
+            return server, url
+
+    server.terminate()
+    raise TimeoutError(f"Server did not start within {startup_timeout}s")
+
+
+def send_request(url, kind, payload, timeout):
+    """POST one request and return its outcome with client latency and server stage timings."""
+    _, accept = REQUEST_KINDS[kind]
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json", "Accept": accept},
+    )
+
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status, server_timing = response.status, response.headers.get("Server-Timing")
+    except urllib.error.HTTPError as error:
+        error.read()
+        status, server_timing = error.code, error.headers.get("Server-Timing")
+    except OSError:
+        status, server_timing = None, None  # connection error or timeout
+
+    return {
+        "kind": kind,
+        "status": status,
+        "latency": time.perf_counter() - started,
+        "stages": parse_server_timing(server_timing),
+    }
+
+
+def run_level(url, concurrency, num_requests, weights, timeout, seed):
+    """Send num_requests drawn from the mix with concurrency requests in flight."""
+    rng = random.Random(seed)
+    kinds = rng.choices(list(weights), weights=list(weights.values()), k=num_requests)
+    requests = [(kind, REQUEST_KINDS[kind][0](rng)) for kind in kinds]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda request: send_request(url, *request, timeout), requests))
+    elapsed = time.perf_counter() - started
+
+    return summarize(results, concurrency, elapsed)
+
+
+def get_percentiles(values):
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+    return dict(zip([f"p{p}" for p in PERCENTILES], np.percentile(values, PERCENTILES).tolist()))
+
+
+def summarize(results, concurrency, elapsed):
+    """Throughput, status counts and latency percentiles (overall, per kind and per stage)."""
+    statuses = {}
+    for result in results:
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+
+    successful = [result for result in results if result["status"] == 200]
+    stage_names = list(dict.fromkeys(name for result in successful for name in result["stages"]))
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(results) / elapsed,
+        "successful_rps": len(successful) / elapsed,
+        "statuses": statuses,
+        "latency": get_percentiles([result["latency"] for result in results]),
+        "latency_by_kind": {
+            kind: get_percentiles([result["latency"] for result in results if result["kind"] == kind])
+            for kind in dict.fromkeys(result["kind"] for result in results)
+        },
+        "stages": {
+            name: get_percentiles([result["stages"][name] for result in successful if name in result["stages"]])
+            for name in stage_names
+        },
+    }
+
+
+def format_percentiles(percentiles):
+    return "  ".join(
+        f"{name} {value * 1000:9.1f}ms" if value is not None else f"{name}       n/a"
+        for name, value in percentiles.items()
+    )
+
+
+def print_report(summary):
+    print(f"\n=== concurrency {summary['concurrency']}: {summary['requests']} requests in {summary['elapsed_seconds']:.1f}s ===")
+    print(f"throughput: {summary['throughput_rps']:.2f} req/s ({summary['successful_rps']:.2f} successful req/s)")
+    print(f"statuses: {summary['statuses']}")
+    print(f"{'end to end':<24}{format_percentiles(summary['latency'])}")
+    for kind, percentiles in summary["latency_by_kind"].items():
+        print(f"{'  ' + kind:<24}{format_percentiles(percentiles)}")
+    print("per stage (successful requests):")
+    for name, percentiles in summary["stages"].items():
+        print(f"{'  ' + name:<24}{format_percentiles(percentiles)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,2,4", help="comma separated concurrency levels (default 1,2,4)")
+    parser.add_argument("--requests", type=int, default=20, help="requests per concurrency level (default 20)")
+    parser.add_argument("--mix", default="json:1", help=f"weighted request kinds from {list(REQUEST_KINDS)} (default json:1)")
+    parser.add_argument("--warm-up", type=int, default=1, help="unmeasured requests before the first level (default 1)")
+    parser.add_argument("--timeout", type=float, default=300, help="per request timeout in seconds (default 300)")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the server, repeatable")
+    parser.add_argument("--url", help="test an already running server instead of starting one")
+    parser.add_argument("--startup-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the summaries as JSON to this file")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    levels = [int(level) for level in args.concurrency.split(",")]
+    extra_env = dict(item.split("=", 1) for item in args.env)
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_server(get_free_port(), extra_env, args.startup_timeout)
+
+    try:
+        if args.warm_up:
+            run_level(url, 1, args.warm_up, {"json": 1}, args.timeout, args.seed)
+
+        summaries = []
+        for level in levels:
+            summary = run_level(url, level, args.requests, weights, args.timeout, args.seed + level)
+            print_report(summary)
+            summaries.append(summary)
+
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump(summaries, output_file, indent=2)
+            print(f"\nSummaries written to {args.output}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,76 @@ import flask
 import functions_framework
 import os
 import sys
+import time
 
 # Add the parent directory to sys.path to resolve imports
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-# Import the prediction functionality
-from predict import run_prediction  # Assuming predict.py has this function
+from functions.worker_pool import WorkerPoolExhaustedError, get_worker_pool
+from functions.response_encoding import (
+    BINARY_CONTENT_TYPE,
+    JSON_CONTENT_TYPE,
+    encode_binary,
+    encode_json,
+    negotiate_content_type,
+)
+from functions.stage_timing import format_server_timing
+from functions.profiling import PROFILE_ID_HEADER, get_profile_id
+from functions.admission_control import AdmissionRejected, admit_request, get_metrics_text
+from functions.preflight import PreflightValidationError, ScheduleValidationError, validate_repayment_schedule
+from functions.forecast_sketches import query_quantiles, query_exceedance_probabilities
+
+# Success message by where run_prediction put the results
+DATABASE_MESSAGES = {
+    "written": "Assessment completed and added to database",
+    "queued": "Assessment completed and queued for database",
+    "not_stored": "Assessment completed (cold start, not stored in database)",
+}
+
+# Start the pre-warmed worker pool (None when CWB_WORKER_POOL_SIZE is 0)
+worker_pool = get_worker_pool()
+
+# Without a pool the prediction runs in this process, so import the ML stack here
+if worker_pool is None:
+    # Import the prediction functionality
+    from predict import run_prediction  # Assuming predict.py has this function
 
 
 @functions_framework.http
 def run_ml_model(request: flask.Request) -> flask.typing.ResponseReturnValue:
+    # Admission metrics (queue depth, rejections) for monitoring
+    if request.method == "GET" and request.path == "/metrics":
+        return flask.Response(get_metrics_text(), mimetype="text/plain; version=0.0.4")
+
+    # Arbitrary quantiles / exceedance probabilities from the stored forecast sketches (no rerun)
+    # GET /sketches?applicant_id=...&quantiles=0.15,0.85&thresholds=0,5000
+    if request.method == "GET" and request.path == "/sketches":
+        applicant_id = request.args.get('applicant_id')
+        try:
+            quantiles = [float(value) for value in request.args.get('quantiles', '').split(',') if value]
+            thresholds = [float(value) for value in request.args.get('thresholds', '').split(',') if value]
+        except ValueError:
+            return flask.Response("Invalid input: quantiles and thresholds must be comma-separated numbers.", status=400)
+        if applicant_id is None or not (quantiles or thresholds):
+            return flask.Response("Missing query parameters: applicant_id and quantiles and/or thresholds", status=400)
+        if any(not 0 <= quantile <= 1 for quantile in quantiles):
+            return flask.Response("Invalid input: quantiles must be between 0 and 1.", status=400)
+
+        answers = {}
+        if quantiles:
+            answers["quantiles"] = query_quantiles(applicant_id, quantiles)
+        if thresholds:
+            answers["exceedance_probabilities"] = query_exceedance_probabilities(applicant_id, thresholds)
+        if any(frame is None for frame in answers.values()):
+            return flask.Response(f"No forecast sketches stored for applicant {applicant_id}", status=404)
+
+        first = next(iter(answers.values()))
+        return flask.Response(encode_json({
+            "applicant_id": applicant_id,
+            "dates": first.index.tolist(),
+            **{name: {"columns": frame.columns.tolist(), "values": frame.to_numpy()} for name, frame in answers.items()},
+        }), mimetype=JSON_CONTENT_TYPE)
+
     if request.is_json:
         data = request.get_json()
         applicant_id = data.get('applicant_id')
@@ -27,16 +87,70 @@ def run_ml_model(request: flask.Request) -> flask.typing.ResponseReturnValue:
         except ValueError:
             return flask.Response("Invalid input: required_amount must be a number.", status=400)
 
+        # Optional list of amounts for an affordability curve (all answered from the same forecast)
+        required_amounts = data.get('required_amounts')
+        if required_amounts is not None:
+            try:
+                required_amounts = [float(amount) for amount in required_amounts]
+            except (TypeError, ValueError):
+                return flask.Response("Invalid input: required_amounts must be a list of numbers.", status=400)
+
+        # Optional repayment schedule: [{"date": "YYYY-MM-DD" or "day": n, "amount": ...}, ...]
+        repayment_schedule = data.get('repayment_schedule')
+        if repayment_schedule is not None:
+            try:
+                validate_repayment_schedule(repayment_schedule)
+            except ScheduleValidationError as rejection:
+                return flask.Response(f"Invalid input: {rejection}", status=400)
+
+        # Opt-in profiling: X-CWB-Profile header or CWB_PROFILE_SAMPLE_RATE
+        profile_id = get_profile_id(request)
+
         try:
+            started = time.perf_counter()
+
             # Run the ML model prediction using predict.py
             # This function will handle the database insertion
-            run_prediction(applicant_id=applicant_id, required_amount=required_amount)
+            # Admission control caps concurrent runs (waits in a bounded queue, or raises AdmissionRejected)
+            with admit_request():
+                if worker_pool is not None:
+                    result = worker_pool.submit("predict:run_prediction", applicant_id=applicant_id, required_amount=required_amount, required_amounts=required_amounts, repayment_schedule=repayment_schedule, profile_id=profile_id)
+                else:
+                    result = run_prediction(applicant_id=applicant_id, required_amount=required_amount, required_amounts=required_amounts, repayment_schedule=repayment_schedule, profile_id=profile_id)
             
-            # Return success message
-            return flask.jsonify({
+            # Per-stage durations plus the end-to-end handler time (including any worker pool hand-off)
+            headers = {"Server-Timing": format_server_timing({
+                **result.get("timings", {}),
+                "total": time.perf_counter() - started,
+            })}
+            if profile_id is not None:
+                headers[PROFILE_ID_HEADER] = profile_id
+
+            # Return the assessment and forecast inline, as compact binary if the caller asked for it
+            if negotiate_content_type(request) == BINARY_CONTENT_TYPE:
+                return flask.Response(encode_binary(result), mimetype=BINARY_CONTENT_TYPE, headers=headers)
+
+            return flask.Response(encode_json({
                 "status": "success",
-                "message": "Assessment completed and added to database"
-            })
+                "message": DATABASE_MESSAGES.get(result.get("database"), DATABASE_MESSAGES["written"]),
+                **result,
+            }), mimetype=JSON_CONTENT_TYPE, headers=headers)
+        except PreflightValidationError as rejection:
+            # The applicant's history cannot be forecast: structured errors, no training was started
+            return flask.Response(encode_json({
+                "status": "error",
+                "message": "Financial history failed validation",
+                "errors": rejection.errors,
+            }), status=422, mimetype=JSON_CONTENT_TYPE)
+        except ScheduleValidationError as rejection:
+            # Instalment dates outside the applicant's forecast period, or a schedule on a cold-start forecast
+            return flask.Response(f"Invalid input: {rejection}", status=400)
+        except AdmissionRejected as rejection:
+            # Overloaded: tell the caller when to retry instead of queueing without bound
+            return flask.Response(rejection.reason, status=rejection.status, headers={"Retry-After": str(rejection.retry_after)})
+        except WorkerPoolExhaustedError as error:
+            # Every worker process is gone and none would restart: unavailable, not a model error
+            return flask.Response(str(error), status=503)
         except Exception as e:
             # Handle any errors from the prediction model
             return flask.Response(f"Error running the ML model: {str(e)}", status=500)
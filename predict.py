@@ -8,21 +8,42 @@ import functions.database
 importlib.reload(functions.database)
 
 from functions.database import (
-    get_column_name_and_datatype_dictionary, 
-    prepare_sql_queries_and_values,
-    insert_data_into_sql_data_base,
-    retrieve_data_from_sql,
     add_metadata_columns
 )
 
+# Not reloaded: these modules hold the process-wide write-behind queue, training scheduler, ensemble pool and history cache
+from functions.write_behind import get_write_behind_queue, write_results
+from functions.training_scheduler import get_training_scheduler
+from functions.ensemble import ENSEMBLE_SIZE, run_ensemble
+from functions.history_cache import retrieve_history
+# Not reloaded: main.py catches PreflightValidationError, a reload would make it a different class
+from functions.preflight import PreflightValidationError, ScheduleValidationError, validate_history, validate_repayment_schedule
+# Not reloaded: holds the process-wide similarity index
+from functions.applicant_similarity import get_similarity_index, is_cold_start_candidate
+# Not reloaded: holds the process-wide stage cache and FX rate table
+from functions.currency import (
+    BASE_CURRENCY,
+    GBP_CONVERSION,
+    convert_forecast_frame_to_gbp,
+    get_history_currency,
+    get_unsupported_currency,
+)
+from functions.pipeline import PIPELINE_WORKERS, PipelineRun, Stage, fingerprint, get_stage_cache
+from functions.profiling import profile_request, profile_stage
+
 import functions.machinelearning
 importlib.reload(functions.machinelearning)
 
 from functions.machinelearning import (
+    QUANTILES,
+    QUANTILE_NAMES,
     prep_data_for_deep_ar_model,
+    DISK_FREE_TRAINING,
     create_model_and_train,
+    train_model_in_memory,
     generate_forecasts,
     inverse_transform_forecasts,
+    get_sample_paths,
     get_forecast_data_frames,
 
 )
@@ -32,16 +53,30 @@ importlib.reload(functions.ml_evaluation)
 
 from functions.ml_evaluation import (
     get_evaluation_metrics, 
-    get_combined_rmse,
+    get_combined_rmse_from_forecast,
     get_experiment_number,
     get_hyperparameters,
+    get_hyperparameters_from_dict,
+)
+
+import functions.forecast_sketches
+importlib.reload(functions.forecast_sketches)
+
+from functions.forecast_sketches import (
+    SKETCH_TABLE_NAME,
+    get_sketch_data_frame,
 )
 
 import functions.applicant_assessment_results
 importlib.reload(functions.applicant_assessment_results)
 
 from functions.applicant_assessment_results import (
+    AFFORDABILITY_MODE,
     assess_affordability,
+    assess_affordability_from_samples,
+    get_affordability_curve,
+    get_schedule_due_days,
+    simulate_repayment_schedule,
     get_overall_assessment,
 )
 
@@ -49,194 +84,410 @@ import warnings
 warnings.filterwarnings('ignore')
 
 
-def run_prediction(applicant_id = '123456799', required_amount = 14000): 
-    
-    print(f"Starting run_prediction with applicant_id={applicant_id}, required_amount={required_amount}\n")
-    print("[STARTED] Step 1: Data collection\n")
-
-    # Step 1: Data collection - ideally this should retrieve data for specified applicant id
-    data = retrieve_data_from_sql("fin_history")
-    
-    # Example threshold amount
-    print("[COMPLETED] Step 1: Data collection\n")
-    print("[STARTED] Step 2: Prepare data for DeepAR\n")
-
-    # Step 2: Prepare data for DeepAR - 
-    # - Split data 
-    # - Prep dynamic features
-    # - normalise where neccessary, 
-    # - scale balance with appropriate scaler 
-    # - convert to expected GluonTS format
-
+# Database tables
+#
+#  delete/DROP later: 'cwb_results' # old table for holding results
+#
+##### Active tables
+# Financial history
+fin_history_table_name = 'fin_history'
+fin_history_enhanced_table_name = 'fin_history_enhanced' # Feature engineered data, applicant id, date, time etc
+
+# Applicant Assessment and Model Evaluation
+cwb_combined_rmse_table_name = 'cwb_combined_rmse' # Combined results for validation and future set
+cwb_validation_assessment_table_name = 'cwb_validation_assessment' # Assessment and Hyperparameters for validation set
+# cwb_future_assessment_table_name = 'cwb_future_assessment' # Assessment and Hyperparameters for future set
+
+# Forecasts
+cwb_validation_forecasts_table_name = 'cwb_validation_forecasts' # 30 days forecast, date, actual balance
+cwb_validation_forecast_sketches_table_name = SKETCH_TABLE_NAME # per-day quantile sketch of all sample paths (BYTEA)
+gbp_cwb_validation_forecasts_table_name = 'gbp_cwb_validation_forecasts' # 30 days forecast, date, actual balance, in GBP (non-GBP applicants only)
+# cwb_future_forecasts_table_name = 'cwb_future_forecasts'  # 30 days forecast, date
+# gbp_cwb_future_forecasts_table_name = 'gbp_cwb_future_forecasts'  # 30 days forecast, date
+
+
+def run_prediction(applicant_id = '123456799', required_amount = 14000, required_amounts = None, repayment_schedule = None, profile_id = None):
+    """
+    Run the assessment pipeline. With a profile_id the run is captured by functions.profiling
+    (cProfile end to end, torch profiler for training and sampling) under that id; profiled
+    runs execute their stages in order on this thread so that cProfile sees all of them.
+    """
+    with profile_request(profile_id) as capture:
+        max_workers = 1 if capture is not None else PIPELINE_WORKERS
+        result = _run_prediction(applicant_id, required_amount, required_amounts, repayment_schedule, max_workers)
+        if capture is not None:
+            capture.timings = result["timings"]
+            result["profile_id"] = profile_id
+
+    return result
+
+
+# Pipeline stages - each takes its inputs as keyword arguments and returns its outputs by name
+
+# Step 1: Data collection - read-through the local history cache when enabled (one delta query per request)
+def data_collection(applicant_id):
+    return {"data": retrieve_history(applicant_id)}
+
+
+# Step 1.1: Preflight validation - reject unusable histories before any CPU is spent on training
+def preflight(data):
+    try:
+        validate_history(data)
+    except PreflightValidationError as rejection:
+        return {"preflight_errors": rejection.errors}
+    return {"preflight_errors": None}
+
+
+# Step 1.2: Currency of the applicant's balances (GBP unless the history or CWB_SOURCE_CURRENCY says otherwise)
+# A currency the FX table cannot convert is rejected here, before any training or writes
+def detect_currency(data):
+    currency = get_history_currency(data)
+    reason = get_unsupported_currency(currency)
+    if reason is not None:
+        raise PreflightValidationError([{'code': 'unsupported_currency', 'field': 'currency', 'currency': currency, 'message': reason}])
+    return {"currency": currency}
+
+
+# Step 2: Prepare data for DeepAR -
+# - Split data
+# - Prep dynamic features
+# - normalise where neccessary,
+# - scale balance with appropriate scaler
+# - convert to expected GluonTS format
+def prepare_data(data):
     # Split data: use first 7 months for training, last month for validation
     split_idx = len(data) - 30  # Last 30 days as validation
     train_data = data.iloc[:split_idx]
 
     training_data, scaler = prep_data_for_deep_ar_model(train_data)
-    print("[COMPLETED] Step 2: Prepare data for DeepAR\n")
-    print("[STARTED] Step 3: Create and train model\n")
-
-    # Step 3: Create and train model
-    forecasting_model_for_validation = create_model_and_train(training_data)
-    print("[COMPLETED] Step 3: Create and train model\n")
-    print("[STARTED] Step 4: Generate forecasts")
+    return {"train_data": train_data, "training_data": training_data, "scaler": scaler}
+
+
+# Step 3: Create and train model (on its own core budget when the training scheduler is enabled)
+# Disk-free training keeps checkpoint, metrics and hyperparameters in memory (training_record)
+# Ensemble mode trains CWB_ENSEMBLE_SIZE seeded members in parallel and samples them in the pool (step 4 included)
+def training(training_data):
+    training_scheduler = get_training_scheduler()
+    model, training_record, ensemble_forecasts = None, None, None
+    with profile_stage("training"):
+        if ENSEMBLE_SIZE > 1:
+            pooled_forecast, training_record = run_ensemble(training_data)
+            ensemble_forecasts = [pooled_forecast]
+        elif training_scheduler is not None and DISK_FREE_TRAINING:
+            model, training_record = training_scheduler.train_in_memory(training_data)
+        elif training_scheduler is not None:
+            model = training_scheduler.train(training_data)
+        elif DISK_FREE_TRAINING:
+            model, training_record = train_model_in_memory(training_data)
+        else:
+            model = create_model_and_train(training_data)
+
+    # Experiment number: the training record's version, or the newest lightning_logs version right after training
+    experiment_no = training_record['version'] if training_record is not None else get_experiment_number("lightning_logs")
+    return {"model": model, "training_record": training_record, "ensemble_forecasts": ensemble_forecasts, "experiment_no": experiment_no}
+
+
+# Step 4: Generate forecasts
+def forecasting(model, training_data, ensemble_forecasts):
+    if ensemble_forecasts is not None:
+        return {"validation_forecasts": ensemble_forecasts}
+
+    with profile_stage("sampling"):
+        validation_forecasts, validation_tss = generate_forecasts(model, training_data)
+    return {"validation_forecasts": validation_forecasts}
+
+
+# Step 5: Inverse transform forecasts
+def inverse_transform(validation_forecasts, scaler):
+    transformed_validation_forecast_values = inverse_transform_forecasts(validation_forecasts[0], scaler)
 
-    # Step 4: Generate forecasts
-    validation_forecasts, validation_tss = generate_forecasts(forecasting_model_for_validation, training_data)
-    print("[COMPLETED] Step 4: Generate forecasts\n")
-    print("[STARTED] Step 5: Inverse transform forecasts\n")
+    # Keep every sample path too: the final-day distribution answers any required amount
+    validation_sample_paths = get_sample_paths(validation_forecasts[0], scaler)
+    return {
+        "transformed_validation_forecast_values": transformed_validation_forecast_values,
+        "validation_sample_paths": validation_sample_paths,
+        "final_day_samples": validation_sample_paths[:, -1],
+    }
 
-    # Step 5: Inverse transform forecasts
-    transformed_validation_forecast_values = inverse_transform_forecasts(validation_forecasts[0], scaler)
-    print("[COMPLETED] Step 5: Inverse transform forecasts\n")
-    print("[STARTED] Step 6: Get forecast data frames \n")
 
-    # Step 6: Get forecast data frames
-    (forecast_7days_validation_set, 
-    forecast_14days_validation_set, 
+# Step 6: Get forecast data frames
+def forecast_data_frames(transformed_validation_forecast_values, data):
+    (forecast_7days_validation_set,
+    forecast_14days_validation_set,
     forecast_30days_validation_set
     ) = get_forecast_data_frames(transformed_validation_forecast_values, data)
-    print("[COMPLETED] Step 6: Get forecast data frames \n")
-    print("[STARTED] Step 7: Get evaluation metrics \n")
+    return {"forecast_30days_validation_set": forecast_30days_validation_set}
 
-    # Step 7: Get evaluation metrics
-    combined_rmse_df = get_combined_rmse(forecast_7days_validation_set, forecast_14days_validation_set, forecast_30days_validation_set)
-    print("[COMPLETED] Step 7: Get evaluation metrics  \n")
-    print("[STARTED] Step 8. Get hyperparameters for the experiment for reference \n")
-    
 
-    # Step 8. Get hyperparameters for the experiment for reference
-    # Define the path to the lightning_logs directory
-    logs_dir = "lightning_logs"
+# Step 7: Get evaluation metrics (all horizon cuts in one vectorized pass)
+def evaluation_metrics(transformed_validation_forecast_values, forecast_30days_validation_set):
+    return {"combined_rmse_df": get_combined_rmse_from_forecast(transformed_validation_forecast_values, forecast_30days_validation_set['actual'].values)}
 
-    # experiment_no
-    experiment_no = get_experiment_number(logs_dir)
 
-    hyperparameters_path = f'lightning_logs/version_{experiment_no}/hparams.yaml'
+# Step 8. Get hyperparameters for the experiment for reference (runs alongside steps 4-7)
+def hyperparameters(training_record, experiment_no):
     experiment_id = f'exp_{experiment_no}'
-    hyperparameters_df = get_hyperparameters(hyperparameters_path, experiment_id)
-    print("[COMPLETED] Step 8. Get hyperparameters for the experiment for reference  \n")
-    print("[STARTED] Step 9: Extract key metrics for assessment using transformed values \n")
+    if training_record is not None:
+        # Disk-free training and ensembles: hyperparameters come from the training record, no hparams.yaml
+        hyperparameters_df = get_hyperparameters_from_dict(training_record['hyperparameters'], experiment_id)
+    else:
+        hyperparameters_path = f'lightning_logs/version_{experiment_no}/hparams.yaml'
+        hyperparameters_df = get_hyperparameters(hyperparameters_path, experiment_id)
+    return {"experiment_id": experiment_id, "hyperparameters_df": hyperparameters_df}
 
-    # Step 9: Extract key metrics for assessment using transformed values
 
+# Step 9: Extract key metrics for assessment using transformed values
+def key_metrics(transformed_validation_forecast_values, data, train_data):
     # Final balance predictions (use the last value of each transformed forecast array)
     final_median = transformed_validation_forecast_values['p50'][-1]
     final_p10 = transformed_validation_forecast_values['p10'][-1]
     final_p90 = transformed_validation_forecast_values['p90'][-1]
 
-
     # Extract actual final balance if available
+    actual_final = error = within_interval = None
     if len(data) > len(train_data):
         actual_final = data['balance'].iloc[-1]
         error = actual_final - final_p90
-        
+
         # Check if actual falls within the prediction interval
         within_interval = final_p10 <= actual_final <= final_p90
-    
-    print("[COMPLETED] Step 9: Extract key metrics for assessment using transformed values  \n")
-    print("[STARTED] Step 10: Get overall affordability assessment \n")
 
-    # Step 10: Get overall affordability assessment
-    affordability_assessment = assess_affordability(required_amount, final_p10, final_p90)
-    print("[COMPLETED] Step 10: Get overall affordability assessment  \n")
-    print("[STARTED] Step 11: Get overall assessment \n")
+    return {"final_p10": final_p10, "final_median": final_median, "final_p90": final_p90,
+            "actual_final": actual_final, "error": error, "within_interval": within_interval}
 
-    # Overall assessment 
-    # Step 11: Get overall assessment
-    experiment_id = f'exp_{experiment_no}'
 
-    overall_validation_forecast_assessment_df = get_overall_assessment(
+# Step 10: Get overall affordability assessment
+def affordability(required_amount, final_p10, final_p90, final_day_samples):
+    if AFFORDABILITY_MODE == "empirical":
+        return {"affordability_assessment": assess_affordability_from_samples(required_amount, final_day_samples)}
+    return {"affordability_assessment": assess_affordability(required_amount, final_p10, final_p90)}
+
+
+# Step 11: Get overall assessment
+def overall_assessment(experiment_id, required_amount, affordability_assessment, train_data, final_p10, final_median, final_p90,
+                       actual_final, error, within_interval, currency):
+    return {"overall_validation_forecast_assessment_df": get_overall_assessment(
         experiment_id,
-        required_amount, 
-        affordability_assessment, 
-        train_data, 
-        final_p10, 
-        final_median, 
-        final_p90, 
+        required_amount,
+        affordability_assessment,
+        train_data,
+        final_p10,
+        final_median,
+        final_p90,
         actual_final,
-        error, 
+        error,
         within_interval,
-        )
-    print("[COMPLETED] Step 11: Get overall assessment \n")
-    print("[STARTED] Step 12: Concatenate hyperparameters and overall validation assessment into a single dataframe \n")
-    # Step 12: Concatenate hyperparameters and overall validation assessment into a single dataframe
-    hyperparameters_and_overall_validation_assessment_df = pd.concat([hyperparameters_df, overall_validation_forecast_assessment_df], ignore_index=True)
-
-    print("[COMPLETED] Step 12: Concatenate hyperparameters and overall validation assessment into a single dataframe \n")
-    print("[STARTED] Step 13: Insert into database\n")
-
-    # Step 13: Insert into database
-    # insert in database 
-    # ................MODIFY TO HAVE UNIQUE ID FOR EACH APPLICANT................
-    #  1. Forecasts x 30 days 
-    #  2. feature engineered data (actual balance including 7days rolling average)
-    #  3. Converted to gbp
-    #  3. Hyperparameters & overall validation assessment
-
-    # Database tables 
+        currency,
+        )}
 
-    dbname='cwb-database',
 
-    #  delete/DROP later
-    'cwb_results' # old table for holding results
+# Step 12: Concatenate hyperparameters and overall validation assessment into a single dataframe
+def concatenate_results(hyperparameters_df, overall_validation_forecast_assessment_df):
+    return {"hyperparameters_and_overall_validation_assessment_df": pd.concat(
+        [hyperparameters_df, overall_validation_forecast_assessment_df], ignore_index=True)}
 
-    ##### Active tables
-    # Financial history 
-    fin_history_table_name = 'fin_history'
-    fin_history_enhanced_table_name = 'fin_history_enhanced' # Feature engineered data, applicant id, date, time etc
 
-    # Applicant Assessment and Model Evaluation 
-    cwb_combined_rmse_table_name = 'cwb_combined_rmse' # Combined results for validation and future set
-    cwb_validation_assessment_table_name = 'cwb_validation_assessment' # Assessment and Hyperparameters for validation set
-    # cwb_future_assessment_table_name = 'cwb_future_assessment' # Assessment and Hyperparameters for future set
-
-    # Forecasts
-    cwb_validation_forecasts_table_name = 'cwb_validation_forecasts' # 30 days forecast, date, actual balance
-    # gbp_cwb_validation_forecasts_table_name = 'gbp_cwb_validation_forecasts' # 30 days forecast, date, actual balance
-    # cwb_future_forecasts_table_name = 'cwb_future_forecasts'  # 30 days forecast, date
-    # gbp_cwb_future_forecasts_table_name = 'gbp_cwb_future_forecasts'  # 30 days forecast, date
-
-
-    # Insert into database
-
-    # Add meta data to Financial history enhanced
-    data_df = add_metadata_columns(data, applicant_id = applicant_id)
-
-    # Add metadata columns to combined RMSE
-    combined_rmse_df = add_metadata_columns(combined_rmse_df, applicant_id = applicant_id)
-
-    # Add meta data to relevant dataframes 
-    hyperparameters_and_overall_validation_assessment_df = add_metadata_columns(hyperparameters_and_overall_validation_assessment_df, applicant_id = applicant_id)
-
-    # Add metadata columns to validation forecasts
-    forecast_30days_validation_set_df = add_metadata_columns(forecast_30days_validation_set, applicant_id = applicant_id)
+# Step 12.1: Forecast in GBP for applicants in another currency (one broadcast multiply against the FX table)
+# Skipped when no FX rates are configured (CWB_FX_RATES_PATH)
+def gbp_conversion(forecast_30days_validation_set, currency):
+    if currency == BASE_CURRENCY or not GBP_CONVERSION:
+        return {"gbp_forecast_30days_validation_set": None}
+    return {"gbp_forecast_30days_validation_set": convert_forecast_frame_to_gbp(forecast_30days_validation_set, currency)}
 
 
+# Step 13: Insert into database - one stage per table, run side by side in a second phase once
+# every compute stage has succeeded, so a failed run leaves no partial rows behind
+# (queued for the background writer when write-behind is enabled)
+def write_fin_history_enhanced(applicant_id, data):
     # 1. Financial history enhanced
-    cwb_fin_history_enhanced_dict = get_column_name_and_datatype_dictionary(data_df)
-    cwb_fin_history_enhanced_sql_queries_and_values = prepare_sql_queries_and_values(cwb_fin_history_enhanced_dict, fin_history_enhanced_table_name, data_df)
-    insert_data_into_sql_data_base(*cwb_fin_history_enhanced_sql_queries_and_values)
-
-    # 2. Combined RMSE
-    cwb_rmse_dict = get_column_name_and_datatype_dictionary(combined_rmse_df)
-    cwb_rsme_sql_queries_and_values = prepare_sql_queries_and_values(cwb_rmse_dict, cwb_combined_rmse_table_name, combined_rmse_df)
-    insert_data_into_sql_data_base(*cwb_rsme_sql_queries_and_values)
-
-    # 3. Validation Assessment Results (and Hyperparameters)
-    cwb_validation_results_dict = get_column_name_and_datatype_dictionary(hyperparameters_and_overall_validation_assessment_df)
-    cwb_validation_results_sql_queries_and_values = prepare_sql_queries_and_values(cwb_validation_results_dict, cwb_validation_assessment_table_name, hyperparameters_and_overall_validation_assessment_df)
-    insert_data_into_sql_data_base(*cwb_validation_results_sql_queries_and_values)
-
-    # 4. Validation Forecasts
-    cwb_validation_forecasts_dict = get_column_name_and_datatype_dictionary(forecast_30days_validation_set_df)
-    cwb_validation_forecasts_sql_queries_and_values = prepare_sql_queries_and_values(cwb_validation_forecasts_dict, cwb_validation_forecasts_table_name, forecast_30days_validation_set_df)
-    insert_data_into_sql_data_base(*cwb_validation_forecasts_sql_queries_and_values)
-
+    write_results([(fin_history_enhanced_table_name, add_metadata_columns(data, applicant_id = applicant_id))])
 
 
+def write_combined_rmse(applicant_id, combined_rmse_df):
+    # 2. Combined RMSE
+    write_results([(cwb_combined_rmse_table_name, add_metadata_columns(combined_rmse_df, applicant_id = applicant_id))])
 
 
+def write_validation_assessment(applicant_id, hyperparameters_and_overall_validation_assessment_df):
+    # 3. Validation Assessment Results (and Hyperparameters)
+    write_results([(cwb_validation_assessment_table_name,
+                    add_metadata_columns(hyperparameters_and_overall_validation_assessment_df, applicant_id = applicant_id))])
 
 
+def write_validation_forecasts(applicant_id, forecast_30days_validation_set):
+    # 4. Validation Forecasts
+    write_results([(cwb_validation_forecasts_table_name, add_metadata_columns(forecast_30days_validation_set, applicant_id = applicant_id))])
+
+
+def write_forecast_sketches(applicant_id, validation_sample_paths, forecast_30days_validation_set):
+    # 5. Validation Forecast Sketches: the full sample distribution, so any later quantile or probability query needs no rerun
+    write_results([(cwb_validation_forecast_sketches_table_name, add_metadata_columns(
+        get_sketch_data_frame(validation_sample_paths, forecast_30days_validation_set['date']), applicant_id = applicant_id))])
+
+
+def write_gbp_validation_forecasts(applicant_id, gbp_forecast_30days_validation_set):
+    # 6. Validation Forecasts in GBP
+    if gbp_forecast_30days_validation_set is not None:
+        write_results([(gbp_cwb_validation_forecasts_table_name,
+                        add_metadata_columns(gbp_forecast_30days_validation_set, applicant_id = applicant_id))])
+
+
+# Cold start: a history too short to train on is answered from the pooled, re-anchored stored
+# forecasts of the nearest applicants in the similarity index. Nothing is trained or written
+# to the database. The stored sketches are per-day distributions, not paths, so there is no
+# repayment simulation.
+def neighbour_lookup(applicant_id, data, similarity_index):
+    pooled_values, neighbours = similarity_index.forecast(data, applicant_id)
+
+    # Quantiles of the pooled neighbour distribution, over the 30 days after the last known balance
+    final_day_samples = pooled_values[-1]
+    final_p10, final_median, final_p90 = np.quantile(final_day_samples, [0.1, 0.5, 0.9])
+    last_date = pd.to_datetime(data['date']).max()
+
+    return {
+        "forecast_dates": pd.date_range(last_date + pd.Timedelta(days=1), periods=len(pooled_values), freq="D").strftime('%Y-%m-%d').tolist(),
+        "forecast_values": np.quantile(pooled_values, QUANTILES, axis=1),
+        "final_day_samples": final_day_samples,
+        "final_p10": final_p10, "final_median": final_median, "final_p90": final_p90,
+        "neighbours": neighbours,
+    }
+
+
+# The stage graphs: intake first, then either the model pipeline and its table writes or the cold-start lookup
+INTAKE_STAGES = [
+    Stage("data_collection", data_collection, ["applicant_id"], ["data"]),
+    Stage("preflight", preflight, ["data"], ["preflight_errors"], memoize=True),
+    Stage("currency", detect_currency, ["data"], ["currency"]),
+]
+
+PREDICTION_STAGES = [
+    Stage("prepare_data", prepare_data, ["data"], ["train_data", "training_data", "scaler"], memoize=True),
+    Stage("training", training, ["training_data"], ["model", "training_record", "ensemble_forecasts", "experiment_no"], memoize=True),
+    Stage("forecasting", forecasting, ["model", "training_data", "ensemble_forecasts"], ["validation_forecasts"], memoize=True),
+    Stage("inverse_transform", inverse_transform, ["validation_forecasts", "scaler"],
+          ["transformed_validation_forecast_values", "validation_sample_paths", "final_day_samples"], memoize=True),
+    Stage("forecast_data_frames", forecast_data_frames, ["transformed_validation_forecast_values", "data"],
+          ["forecast_30days_validation_set"], memoize=True),
+    Stage("evaluation_metrics", evaluation_metrics, ["transformed_validation_forecast_values", "forecast_30days_validation_set"],
+          ["combined_rmse_df"], memoize=True),
+    Stage("hyperparameters", hyperparameters, ["training_record", "experiment_no"], ["experiment_id", "hyperparameters_df"], memoize=True),
+    Stage("key_metrics", key_metrics, ["transformed_validation_forecast_values", "data", "train_data"],
+          ["final_p10", "final_median", "final_p90", "actual_final", "error", "within_interval"], memoize=True),
+    Stage("affordability", affordability, ["required_amount", "final_p10", "final_p90", "final_day_samples"],
+          ["affordability_assessment"], memoize=True),
+    Stage("overall_assessment", overall_assessment,
+          ["experiment_id", "required_amount", "affordability_assessment", "train_data", "final_p10", "final_median", "final_p90",
+           "actual_final", "error", "within_interval", "currency"],
+          ["overall_validation_forecast_assessment_df"]),  # timestamped, never memoized
+    Stage("concatenate_results", concatenate_results, ["hyperparameters_df", "overall_validation_forecast_assessment_df"],
+          ["hyperparameters_and_overall_validation_assessment_df"]),
+    Stage("gbp_conversion", gbp_conversion, ["forecast_30days_validation_set", "currency"], ["gbp_forecast_30days_validation_set"], memoize=True),
+]
+
+WRITE_STAGES = [
+    Stage("write_fin_history_enhanced", write_fin_history_enhanced, ["applicant_id", "data"]),
+    Stage("write_combined_rmse", write_combined_rmse, ["applicant_id", "combined_rmse_df"]),
+    Stage("write_validation_assessment", write_validation_assessment, ["applicant_id", "hyperparameters_and_overall_validation_assessment_df"]),
+    Stage("write_validation_forecasts", write_validation_forecasts, ["applicant_id", "forecast_30days_validation_set"]),
+    Stage("write_forecast_sketches", write_forecast_sketches, ["applicant_id", "validation_sample_paths", "forecast_30days_validation_set"]),
+    Stage("write_gbp_validation_forecasts", write_gbp_validation_forecasts, ["applicant_id", "gbp_forecast_30days_validation_set"]),
+]
+
+COLD_START_STAGES = [
+    Stage("neighbour_lookup", neighbour_lookup, ["applicant_id", "data", "similarity_index"],
+          ["forecast_dates", "forecast_values", "final_day_samples", "final_p10", "final_median", "final_p90", "neighbours"]),
+    Stage("affordability", affordability, ["required_amount", "final_p10", "final_p90", "final_day_samples"], ["affordability_assessment"]),
+]
+
+
+def _run_prediction(applicant_id, required_amount, required_amounts, repayment_schedule, max_workers=PIPELINE_WORKERS):
 
+    print(f"Starting run_prediction with applicant_id={applicant_id}, required_amount={required_amount}\n")
+    run = PipelineRun({"applicant_id": applicant_id, "required_amount": required_amount}, max_workers, get_stage_cache())
+    values = run.execute(INTAKE_STAGES)
+
+    # Short histories are answered from the stored forecasts of similar applicants when cold start is enabled
+    errors = values["preflight_errors"]
+    if errors:
+        similarity_index = get_similarity_index() if is_cold_start_candidate(values["data"], errors) else None
+        # No index yet, or the applicant is the only one in it: nothing to pool, reject as before
+        if similarity_index is None or not similarity_index.has_neighbours(applicant_id):
+            raise PreflightValidationError(errors)
+        # Pooled neighbour forecasts carry no sample paths of this applicant to simulate instalments on
+        if repayment_schedule is not None:
+            raise ScheduleValidationError(["repayment simulation is not available for cold-start forecasts"])
+
+        print(f"[STARTED] Cold start: {len(values['data'])} days of history, pooling the nearest applicants' forecasts\n")
+        run.values["similarity_index"] = similarity_index
+        run.fingerprints["similarity_index"] = fingerprint(similarity_index)
+        values = run.execute(COLD_START_STAGES)
+        print("[COMPLETED] Cold start\n")
+        experiment_id = "cold_start"
+        forecast_dates, forecast_values = values["forecast_dates"], values["forecast_values"]
+    else:
+        # Instalment dates must fall in the forecast period (the last 30 days of history): checked before training
+        if repayment_schedule is not None:
+            validate_repayment_schedule(repayment_schedule, values["data"]['date'].tail(30))
+        values = run.execute(PREDICTION_STAGES)
+        values = run.execute(WRITE_STAGES)
+        experiment_id = values["experiment_id"]
+        forecast_dates = pd.to_datetime(values["forecast_30days_validation_set"]['date']).dt.strftime('%Y-%m-%d').tolist()
+        forecast_values = np.stack([values["transformed_validation_forecast_values"][name] for name in QUANTILE_NAMES])
+
+    print(run.format_report())
+
+    # Step 14: Return the assessment and 30-day quantile forecast to the caller
+    result = {
+        "applicant_id": applicant_id,
+        "experiment_id": experiment_id,
+        "required_amount": required_amount,
+        "currency": values["currency"],
+        "assessment": values["affordability_assessment"],
+        "final_forecast": {"p10": values["final_p10"], "p50": values["final_median"], "p90": values["final_p90"]},
+        "forecast": {
+            "dates": forecast_dates,
+            "names": QUANTILE_NAMES,
+            "quantiles": np.array(QUANTILES),
+            "values": forecast_values,
+        },
+        "timings": run.timings,
+        "pipeline": run.report(),
+        # Where the results went: written, queued for the background writer, or not stored (cold start)
+        "database": "not_stored" if errors else "queued" if get_write_behind_queue() is not None else "written",
+    }
+
+    # The forecast in GBP as well, when the applicant's balances are in another currency
+    if values.get("gbp_forecast_30days_validation_set") is not None:
+        gbp_forecast = values["gbp_forecast_30days_validation_set"]
+        result["forecast_gbp"] = {
+            "values": np.stack([gbp_forecast[name].to_numpy() for name in QUANTILE_NAMES]),
+            "fx_rates": gbp_forecast['fx_rate'].to_numpy(),
+            "fx_rate_clipped": gbp_forecast['fx_rate_clipped'].to_numpy(),
+        }
+
+    if errors:
+        result["cold_start"] = {"history_days": len(values["data"]), "neighbours": values["neighbours"]}
+
+    # Loss curve of the model, available when it was trained disk-free; per-member seeds and timings of an ensemble
+    training_record = values.get("training_record")
+    if training_record is not None and "members" in training_record:
+        result["ensemble"] = {key: training_record[key] for key in ("version", "members", "wall_seconds", "speedup")}
+    elif training_record is not None:
+        result["training"] = {key: training_record[key] for key in ("version", "loss_curve", "best_epoch", "best_train_loss")}
+
+    # Probability of meeting each requested amount, all from the same forecast
+    if required_amounts is not None:
+        result["affordability_curve"] = {
+            "amounts": np.asarray(required_amounts, dtype=float),
+            "probabilities": get_affordability_curve(values["final_day_samples"], required_amounts),
+        }
+
+    # Overdraft risk of each instalment of a repayment schedule, over every sample path
+    if repayment_schedule is not None:
+        due_days, amounts = get_schedule_due_days(repayment_schedule, forecast_dates)
+        result["repayment_simulation"] = {
+            "dates": [forecast_dates[day] for day in due_days],
+            **simulate_repayment_schedule(values["validation_sample_paths"], due_days, amounts),
+        }
+
+    return result
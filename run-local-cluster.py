@@ -0,0 +1,87 @@
+"""
+Run several run_ml_model workers behind the applicant-affinity router on this machine.
+
+Each worker is a functions-framework process on its own port (against the in-memory
+database unless --real-database is given); the router listens on --port and sends each
+applicant_id to the same worker via consistent hashing. Stop with Ctrl-C.
+
+Examples:
+    python run-local-cluster.py --workers 3
+    python run-local-cluster.py --workers 4 --env CWB_HISTORY_CACHE=1
+    python load-test-cwb-ml-api.py --url http://127.0.0.1:8080/ --concurrency 4   # drive it
+    python run-local-cluster.py --workers 3 --check-balance 10000                  # ring statistics only
+"""
+import os
+import sys
+import signal
+import argparse
+import subprocess
+
+from functions.applicant_router import HashRing, create_router_app, get_moved_keys
+
+
+def start_workers(count, base_port, extra_env, real_database):
+    env = {**os.environ, **extra_env}
+    if not real_database:
+        env["CWB_DB_BACKEND"] = "fake"
+
+    workers = []
+    for index in range(count):
+        port = base_port + index
+        process = subprocess.Popen(
+            [sys.executable, "-m", "functions_framework", "--target", "run_ml_model", "--source", "main.py",
+             "--host", "127.0.0.1", "--port", str(port)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            start_new_session=True,  # stopped by main(), keep them out of the terminal's signals
+        )
+        workers.append((f"http://127.0.0.1:{port}/", process))
+    return workers
+
+
+def check_balance(workers, num_keys, virtual_nodes):
+    """Print how evenly applicants spread over the workers and how many move when one leaves."""
+    keys = [str(100000000 + key) for key in range(num_keys)]
+    ring = HashRing(workers, virtual_nodes)
+    for worker, count in ring.get_distribution(keys).items():
+        print(f"{worker}: {count} applicants ({count / num_keys:.1%})")
+
+    smaller_ring = HashRing(workers[1:], virtual_nodes)
+    moved = get_moved_keys(ring, smaller_ring, keys)
+    print(f"Removing {workers[0]} moves {len(moved)} applicants ({len(moved) / num_keys:.1%}, ideal {1 / len(workers):.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8080, help="router port; workers use the following ports")
+    parser.add_argument("--virtual-nodes", type=int, default=None, help="points per worker (default CWB_ROUTER_VIRTUAL_NODES)")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the workers, repeatable")
+    parser.add_argument("--real-database", action="store_true", help="use the configured Postgres instead of the in-memory one")
+    parser.add_argument("--check-balance", type=int, metavar="N", help="print the ring balance for N applicants and exit")
+    args = parser.parse_args()
+
+    router_options = {"virtual_nodes": args.virtual_nodes} if args.virtual_nodes else {}
+
+    if args.check_balance:
+        worker_urls = [f"http://127.0.0.1:{args.port + 1 + index}/" for index in range(args.workers)]
+        check_balance(worker_urls, args.check_balance, args.virtual_nodes or HashRing().virtual_nodes)
+        return
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    workers = start_workers(args.workers, args.port + 1, extra_env, args.real_database)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # stop the workers on kill as well as Ctrl-C
+
+    try:
+        app = create_router_app([url for url, _ in workers], **router_options)
+        print(f"Router on http://127.0.0.1:{args.port}/ -> {[url for url, _ in workers]}")
+        app.run(host="127.0.0.1", port=args.port, threaded=True)
+    finally:
+        for _, process in workers:
+            process.terminate()
+        for _, process in workers:
+            process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()